@@ -1,11 +1,93 @@
 import os
 import numpy as np
 
+import streams
+from history import HistoryBuffer
+
+
+RANDOM_BLOCK_SIZE = 256
+
+
+def build_alias_table(probabilities):
+    """
+    Walker's alias table of a discrete distribution: draw k uniformly, keep k with probability prob[k],
+    otherwise take alias[k]. A draw then costs one uniform number and two table lookups.
+    """
+    n = len(probabilities)
+    scaled = np.array(probabilities, dtype=float)
+    scaled = scaled * n / scaled.sum()
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
+
+
+def sample_alias_table(prob, alias, uniform_samples):
+    """
+    Vectorized draw from alias tables; prob/alias rows are selected per sample and one uniform
+    number per sample picks both the column and the coin.
+    """
+    scaled = uniform_samples * prob.shape[-1]
+    column = np.minimum(scaled.astype(int), prob.shape[-1] - 1)
+    keep = (scaled - column) < np.take_along_axis(prob, column[..., None], axis=-1)[..., 0]
+    return np.where(keep, column, np.take_along_axis(alias, column[..., None], axis=-1)[..., 0])
+
+
+class RandomBlock:
+    """
+    Random draws pre-generated block_size at a time and handed out one per call, so a step costs a list
+    lookup instead of a fresh NumPy sampling call.
+    """
+    def __init__(self, block_size=RANDOM_BLOCK_SIZE):
+        self.block_size = block_size
+        self.draws = []
+        self.position = 0
+
+    # sampler is a NumPy sampling function taking a size keyword, e.g. np.random.poisson
+    def next(self, sampler, *args):
+        if self.position == len(self.draws):
+            self.draws = sampler(*args, size=self.block_size).tolist()
+            self.position = 0
+        draw = self.draws[self.position]
+        self.position += 1
+        return draw
+
+    # drop the remaining draws, e.g. when the distribution they were drawn from changes
+    def clear(self):
+        self.draws = []
+        self.position = 0
+
+
+def get_index_dtype(state_space_len):
+    if state_space_len <= np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
 
 class App:
-    def __init__(self):
-        self.app_state_history = []
+    # server_streams: the server's streams.ServerStreams, None to draw from the process-wide np.random
+    def __init__(self, server_streams=None):
+        self.app_state_history = HistoryBuffer(0, np.int32)
         self.current_state = None
+        self.streams = server_streams
+
+    # app states are recorded as state indices and mapped back to state values on export
+    def allocate_history(self, capacity, stride=1):
+        self.app_state_history = HistoryBuffer(capacity, get_index_dtype(self.get_state_space_len()), stride=stride)
+
+    def get_state_values(self):
+        raise NotImplementedError("This method should be overridden.")
 
     def apply_change(self, change_type):
         pass
@@ -26,12 +108,15 @@ class App:
         return float(self.current_state)
 
     def update_state(self, action):
-        self.app_state_history.append(self.get_current_state())
+        self.app_state_history.append(self.get_current_state_index())
+
+    def get_state_history(self):
+        return self.get_state_values()[self.app_state_history.to_array()]
 
     def print_state(self, server_id, path):
         file_path = os.path.join(path, f"server_{server_id}_app_states.txt")
         with open(file_path, 'w') as file:
-            for h in self.app_state_history:
+            for h in self.get_state_history().tolist():
                 file.write(f"{str(h)}\n")
 
 
@@ -41,17 +126,25 @@ State transition follows Markov process
 
 
 class MarkovApp(App):
-    def __init__(self, transition_matrix, utilities, initial_state):
-        super().__init__()
+    def __init__(self, transition_matrix, utilities, initial_state, server_streams=None):
+        super().__init__(server_streams)
         self.transition_matrix = transition_matrix
         self.utilities = utilities
-        self.current_state = initial_state
+        self.current_index = list(utilities).index(initial_state)
+        self.current_state = self.utilities[self.current_index]
+        alias_tables = [build_alias_table(probabilities) for probabilities in transition_matrix]
+        self.alias_prob = [prob.tolist() for prob, _ in alias_tables]
+        self.alias_index = [alias.tolist() for _, alias in alias_tables]
+        self.uniform_draws = RandomBlock()
 
     def get_state_space_len(self):
         return len(self.utilities)
 
     def get_current_state_index(self):
-        return self.utilities.index(self.current_state)
+        return self.current_index
+
+    def get_state_values(self):
+        return np.array(self.utilities, dtype=float)
 
     def get_sprinting_utility(self):
         return self.current_state
@@ -61,8 +154,15 @@ class MarkovApp(App):
 
     def update_state(self, action):
         super().update_state(action)
-        probabilities = self.transition_matrix[self.utilities.index(self.current_state)]
-        self.current_state = np.random.choice(self.utilities, p=probabilities)
+        if self.streams is None:
+            scaled = self.uniform_draws.next(np.random.random_sample) * len(self.utilities)
+        else:
+            scaled = float(self.streams.uniform(streams.APP)) * len(self.utilities)
+        column = min(int(scaled), len(self.utilities) - 1)
+        if scaled - column >= self.alias_prob[self.current_index][column]:
+            column = self.alias_index[self.current_index][column]
+        self.current_index = column
+        self.current_state = self.utilities[self.current_index]
 
 
 """
@@ -71,16 +171,24 @@ State transition follows Uniform distribution
 
 
 class UniformApp(App):
-    def __init__(self, utilities):
-        super().__init__()
+    def __init__(self, utilities, server_streams=None):
+        super().__init__(server_streams)
         self.utilities = utilities
-        self.current_state = np.random.choice(self.utilities)
+        if self.streams is None:
+            self.current_index = np.random.randint(len(self.utilities))
+        else:
+            self.current_index = int(self.streams.randint(len(self.utilities), streams.APP_INITIAL))
+        self.current_state = self.utilities[self.current_index]
+        self.index_draws = RandomBlock()
 
     def get_state_space_len(self):
         return len(self.utilities)
 
     def get_current_state_index(self):
-        return self.utilities.index(self.current_state)
+        return self.current_index
+
+    def get_state_values(self):
+        return np.array(self.utilities, dtype=float)
 
     def get_sprinting_utility(self):
         return self.current_state
@@ -90,7 +198,11 @@ class UniformApp(App):
 
     def update_state(self, action):
         super().update_state(action)
-        self.current_state = np.random.choice(self.utilities)
+        if self.streams is None:
+            self.current_index = self.index_draws.next(np.random.randint, len(self.utilities))
+        else:
+            self.current_index = int(self.streams.randint(len(self.utilities), streams.APP))
+        self.current_state = self.utilities[self.current_index]
 
 
 """
@@ -99,8 +211,8 @@ Queue application uses Poisson distribution to model events that occur randomly
 
 
 class QueueApp(App):
-    def __init__(self, arrival_tps, sprinting_tps, nominal_tps, max_queue_length=1000):
-        super().__init__()
+    def __init__(self, arrival_tps, sprinting_tps, nominal_tps, max_queue_length=1000, server_streams=None):
+        super().__init__(server_streams)
         self.current_state = 0
         self.current_queue_length = 0
         self.arrival_tps = arrival_tps
@@ -110,6 +222,9 @@ class QueueApp(App):
         self.next_departure_not_sprinting = nominal_tps
         self.next_departure_sprinting = sprinting_tps
         self.next_arrival = arrival_tps
+        self.arrival_draws = RandomBlock()
+        self.departure_not_sprinting_draws = RandomBlock()
+        self.departure_sprinting_draws = RandomBlock()
 
     def get_state_space_len(self):
         return self.max_queue_length + 1
@@ -117,6 +232,9 @@ class QueueApp(App):
     def get_current_state_index(self):
         return self.current_state
 
+    def get_state_values(self):
+        return np.arange(self.max_queue_length + 1, dtype=float)
+
     def get_sprinting_utility(self):
         new_queue_length = max(0, self.current_queue_length + self.next_arrival - self.next_departure_sprinting)
         # return -min(new_queue_length, self.max_queue_length)
@@ -135,21 +253,33 @@ class QueueApp(App):
             departed_tasks = self.next_departure_sprinting
         self.current_queue_length = max(0, self.current_queue_length + arrived_tasks - departed_tasks)
         self.current_state = min(self.current_queue_length, self.max_queue_length)
-        self.next_arrival = np.random.poisson(self.arrival_tps)
-        self.next_departure_not_sprinting = np.random.poisson(self.nominal_tps)
-        self.next_departure_sprinting = np.random.poisson(self.sprinting_tps)
+        if self.streams is None:
+            self.next_arrival = self.arrival_draws.next(np.random.poisson, self.arrival_tps)
+            self.next_departure_not_sprinting = self.departure_not_sprinting_draws.next(np.random.poisson,
+                                                                                        self.nominal_tps)
+            self.next_departure_sprinting = self.departure_sprinting_draws.next(np.random.poisson,
+                                                                                self.sprinting_tps)
+        else:
+            self.next_arrival = int(self.streams.poisson(self.arrival_tps, streams.APP_ARRIVAL))
+            self.next_departure_not_sprinting = int(self.streams.poisson(self.nominal_tps,
+                                                                         streams.APP_DEPARTURE_NOT_SPRINTING))
+            self.next_departure_sprinting = int(self.streams.poisson(self.sprinting_tps,
+                                                                     streams.APP_DEPARTURE_SPRINTING))
 
     def apply_change(self, change_type):
         if change_type == 0:
             self.arrival_tps *= 1.3
+            self.arrival_draws.clear()
         elif change_type == 1:
             self.nominal_tps /= 1.5
             self.sprinting_tps /= 1.5
+            self.departure_not_sprinting_draws.clear()
+            self.departure_sprinting_draws.clear()
 
 
 class SparkApp(App):
-    def __init__(self, gains, initial_index):
-        super().__init__()
+    def __init__(self, gains, initial_index, server_streams=None):
+        super().__init__(server_streams)
         self.gains = gains
         self.max_gain = np.array(gains).max()
         self.current_state = self.gains[initial_index] / self.max_gain
@@ -162,6 +292,9 @@ class SparkApp(App):
     def get_current_state_index(self):
         return self.current_index
 
+    def get_state_values(self):
+        return np.array(self.gains) / self.max_gain
+
     def get_sprinting_utility(self):
         return self.current_state
 
@@ -176,3 +309,212 @@ class SparkApp(App):
         elif self.current_index < self.state_space_len - 1:
             self.current_index += 1
         self.current_state = self.gains[self.current_index] / self.max_gain
+
+
+"""
+Fleet variants of the applications above: the state of every server's application is held in NumPy arrays
+and the whole fleet is advanced with one batched step per iteration.
+"""
+
+
+class AppFleet:
+    # server_streams: streams.ServerStreams of the fleet's servers, None to draw from the process-wide np.random
+    def __init__(self, num_apps, server_streams=None):
+        self.num_apps = num_apps
+        self.app_state_history = HistoryBuffer(0, np.int32, (num_apps,))
+        self.current_state = None
+        self.streams = server_streams
+
+    # app states are recorded as state indices and mapped back to state values on export
+    def allocate_history(self, capacity, stride=1):
+        self.app_state_history = HistoryBuffer(capacity, get_index_dtype(self.get_state_space_len()),
+                                               (self.num_apps,), stride)
+
+    def get_state_values(self):
+        raise NotImplementedError("This method should be overridden.")
+
+    def apply_change(self, change_type):
+        pass
+
+    def get_state_space_len(self):
+        pass
+
+    def get_current_state_index(self):
+        pass
+
+    def get_sprinting_utility(self):
+        raise NotImplementedError("This method should be overridden.")
+
+    def get_nominal_utility(self):
+        raise NotImplementedError("This method should be overridden.")
+
+    def get_current_state(self):
+        return self.current_state.astype(float)
+
+    def update_state(self, actions):
+        self.app_state_history.append(self.get_current_state_index())
+
+    # (iterations, num_apps) array of recorded state values
+    def get_state_history(self):
+        return self.get_state_values()[self.app_state_history.to_array()]
+
+    def print_state(self, server_ids, path):
+        history = self.get_state_history().T
+        for server_id, server_history in zip(server_ids, history):
+            file_path = os.path.join(path, f"server_{server_id}_app_states.txt")
+            with open(file_path, 'w') as file:
+                for h in server_history.tolist():
+                    file.write(f"{str(h)}\n")
+
+
+class MarkovAppFleet(AppFleet):
+    def __init__(self, transition_matrix, utilities, initial_indices, server_streams=None):
+        super().__init__(len(initial_indices), server_streams)
+        self.transition_matrix = np.array(transition_matrix)
+        self.utilities = np.array(utilities)
+        alias_tables = [build_alias_table(probabilities) for probabilities in self.transition_matrix]
+        self.alias_prob = np.array([prob for prob, _ in alias_tables])
+        self.alias_index = np.array([alias for _, alias in alias_tables])
+        self.current_index = np.array(initial_indices)
+        self.current_state = self.utilities[self.current_index]
+
+    def get_state_space_len(self):
+        return len(self.utilities)
+
+    def get_current_state_index(self):
+        return self.current_index
+
+    def get_state_values(self):
+        return self.utilities.astype(float)
+
+    def get_sprinting_utility(self):
+        return self.current_state
+
+    def get_nominal_utility(self):
+        return 0
+
+    def update_state(self, actions):
+        super().update_state(actions)
+        if self.streams is None:
+            uniform_samples = np.random.rand(self.num_apps)
+        else:
+            uniform_samples = self.streams.uniform(streams.APP)
+        self.current_index = sample_alias_table(self.alias_prob[self.current_index],
+                                                self.alias_index[self.current_index], uniform_samples)
+        self.current_state = self.utilities[self.current_index]
+
+
+class UniformAppFleet(AppFleet):
+    def __init__(self, utilities, num_apps, server_streams=None):
+        super().__init__(num_apps, server_streams)
+        self.utilities = np.array(utilities)
+        if self.streams is None:
+            self.current_index = np.random.randint(len(self.utilities), size=self.num_apps)
+        else:
+            self.current_index = self.streams.randint(len(self.utilities), streams.APP_INITIAL)
+        self.current_state = self.utilities[self.current_index]
+
+    def get_state_space_len(self):
+        return len(self.utilities)
+
+    def get_current_state_index(self):
+        return self.current_index
+
+    def get_state_values(self):
+        return self.utilities.astype(float)
+
+    def get_sprinting_utility(self):
+        return self.current_state
+
+    def get_nominal_utility(self):
+        return 0
+
+    def update_state(self, actions):
+        super().update_state(actions)
+        if self.streams is None:
+            self.current_index = np.random.randint(len(self.utilities), size=self.num_apps)
+        else:
+            self.current_index = self.streams.randint(len(self.utilities), streams.APP)
+        self.current_state = self.utilities[self.current_index]
+
+
+class QueueAppFleet(AppFleet):
+    def __init__(self, arrival_tps, sprinting_tps, nominal_tps, num_apps, max_queue_length=1000,
+                 server_streams=None):
+        super().__init__(num_apps, server_streams)
+        self.current_state = np.zeros(self.num_apps, dtype=int)
+        self.current_queue_length = np.zeros(self.num_apps, dtype=int)
+        self.arrival_tps = arrival_tps
+        self.sprinting_tps = sprinting_tps
+        self.nominal_tps = nominal_tps
+        self.max_queue_length = max_queue_length
+        self.next_departure_not_sprinting = np.full(self.num_apps, nominal_tps)
+        self.next_departure_sprinting = np.full(self.num_apps, sprinting_tps)
+        self.next_arrival = np.full(self.num_apps, arrival_tps)
+
+    def get_state_space_len(self):
+        return self.max_queue_length + 1
+
+    def get_current_state_index(self):
+        return self.current_state
+
+    def get_state_values(self):
+        return np.arange(self.max_queue_length + 1, dtype=float)
+
+    def get_sprinting_utility(self):
+        return - np.maximum(0, self.current_queue_length + self.next_arrival - self.next_departure_sprinting)
+
+    def get_nominal_utility(self):
+        return - np.maximum(0, self.current_queue_length + self.next_arrival - self.next_departure_not_sprinting)
+
+    def update_state(self, actions):
+        super().update_state(actions)
+        departed_tasks = np.where(actions == 0, self.next_departure_sprinting, self.next_departure_not_sprinting)
+        self.current_queue_length = np.maximum(0, self.current_queue_length + self.next_arrival - departed_tasks)
+        self.current_state = np.minimum(self.current_queue_length, self.max_queue_length)
+        if self.streams is None:
+            self.next_arrival = np.random.poisson(self.arrival_tps, self.num_apps)
+            self.next_departure_not_sprinting = np.random.poisson(self.nominal_tps, self.num_apps)
+            self.next_departure_sprinting = np.random.poisson(self.sprinting_tps, self.num_apps)
+        else:
+            self.next_arrival = self.streams.poisson(self.arrival_tps, streams.APP_ARRIVAL)
+            self.next_departure_not_sprinting = self.streams.poisson(self.nominal_tps,
+                                                                     streams.APP_DEPARTURE_NOT_SPRINTING)
+            self.next_departure_sprinting = self.streams.poisson(self.sprinting_tps, streams.APP_DEPARTURE_SPRINTING)
+
+    def apply_change(self, change_type):
+        if change_type == 0:
+            self.arrival_tps *= 1.3
+        elif change_type == 1:
+            self.nominal_tps /= 1.5
+            self.sprinting_tps /= 1.5
+
+
+class SparkAppFleet(AppFleet):
+    def __init__(self, gains, initial_indices, server_streams=None):
+        super().__init__(len(initial_indices), server_streams)
+        self.gains = np.array(gains)
+        self.max_gain = self.gains.max()
+        self.current_index = np.array(initial_indices)
+        self.current_state = self.gains[self.current_index] / self.max_gain
+        self.state_space_len = len(self.gains)
+
+    def get_state_space_len(self):
+        return self.state_space_len
+
+    def get_current_state_index(self):
+        return self.current_index
+
+    def get_state_values(self):
+        return self.gains / self.max_gain
+
+    def get_sprinting_utility(self):
+        return self.current_state
+
+    def get_nominal_utility(self):
+        return 0
+
+    def update_state(self, actions):
+        super().update_state(actions)
+        self.current_index = (self.current_index + 1) % self.state_space_len
+        self.current_state = self.gains[self.current_index] / self.max_gain
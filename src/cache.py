@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import uuid
+
+"""
+Result cache: finished simulations and DP solutions are stored on local disk under cache_dir, one file per entry,
+named by a SHA-256 key of what determines the result: the config resolved for one app type and sub-type (values
+of other app types removed), the seed and a hash of the source code. Entries are written atomically, so processes
+of a sweep can share the cache. Reading an entry marks it as recently used; once the entries take more than
+cache_size_mb the least recently used ones are removed. cache_size_mb 0 disables the cache.
+"""
+
+# keys that change how a run is executed but not its result. num_workers and transport stay in the key: in rng_mode
+# "process" the worker layout decides which generator every server draws from
+EXECUTION_KEYS = ["folder_name", "threads_per_worker", "pin_cpus", "socket_address", "spawn_workers",
+                  "checkpoint_interval", "results_format", "cache_dir", "cache_size_mb"]
+
+code_version = None
+
+
+# hash of the source files of this package, so that entries of older code are never used
+def get_code_version():
+    global code_version
+    if code_version is None:
+        digest = hashlib.sha256()
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        for file_name in sorted(os.listdir(source_dir)):
+            if file_name.endswith(".py"):
+                with open(os.path.join(source_dir, file_name), 'rb') as file:
+                    digest.update(file_name.encode() + b"\0" + file.read() + b"\0")
+        code_version = digest.hexdigest()
+    return code_version
+
+
+def get_file_hash(file_name):
+    with open(file_name, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+# config values for one app type and sub-type: dicts keyed by app type or sub-type are replaced by their entry
+def resolve_config(config, app_type, app_sub_type):
+    if isinstance(config, dict):
+        if app_type in config:
+            return resolve_config(config[app_type], app_type, app_sub_type)
+        if app_sub_type in config:
+            return resolve_config(config[app_sub_type], app_type, app_sub_type)
+        return {key: resolve_config(value, app_type, app_sub_type) for key, value in config.items()}
+    return config
+
+
+# key of a result: kind tells apart results of different functions, inputs must be JSON serializable
+def get_key(kind, inputs):
+    canonical = json.dumps({"kind": kind, "inputs": inputs, "code_version": get_code_version()}, sort_keys=True,
+                           separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+# key of a simulation run, from the config without its execution settings
+def get_simulation_key(kind, config, app_type, app_sub_type, policy_type, threshold_in, seed):
+    config = {key: value for key, value in config.items() if key not in EXECUTION_KEYS}
+    inputs = {"config": resolve_config(config, app_type, app_sub_type), "app_type": app_type,
+              "app_sub_type": app_sub_type, "policy_type": policy_type, "threshold": threshold_in, "seed": seed}
+    if app_type == "spark":
+        inputs["gain_file"] = get_file_hash("data/gain.txt")
+    # dp_policy runs take their thresholds from the results of dp.solve_all if there are any
+    if policy_type == "dp_policy" and config.get("dp_results_file") and os.path.exists(config["dp_results_file"]):
+        inputs["dp_results_file"] = get_file_hash(config["dp_results_file"])
+    return get_key(kind, inputs)
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    # path of the entry, marked as recently used, or None
+    def lookup(self, key):
+        path = self.get_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, key):
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            return None
+
+    # copy the file stored under key to file_path; False if there is no such entry
+    def get_file(self, key, file_path):
+        path = self.lookup(key)
+        if path is None:
+            return False
+        try:
+            shutil.copyfile(path, file_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, value):
+        self.write(key, lambda tmp_path: self.dump(value, tmp_path))
+
+    def put_file(self, key, file_path):
+        self.write(key, lambda tmp_path: shutil.copyfile(file_path, tmp_path))
+
+    @staticmethod
+    def dump(value, file_path):
+        with open(file_path, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def write(self, key, write_file):
+        tmp_path = os.path.join(self.cache_dir, f".{key}.{uuid.uuid4().hex}.tmp")
+        write_file(tmp_path)
+        os.replace(tmp_path, self.get_path(key))
+        self.evict()
+
+    # remove least recently used entries until the cache fits into max_size bytes
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def create_cache(config):
+    if config["cache_size_mb"] <= 0:
+        return None
+    return ResultCache(config["cache_dir"], config["cache_size_mb"] * 2 ** 20)
@@ -0,0 +1,111 @@
+import os
+import pickle
+import shutil
+import sys
+import threading
+
+import numpy as np
+import torch
+
+"""
+Checkpoints: the Coordinator and every Worker pickle themselves at the same period boundary into
+<path>/checkpoints/<iteration>/, together with the numpy and torch RNG states of their process. Objects are serialized
+in the simulation thread, so the snapshot is consistent, and written to disk by a background thread. A checkpoint is
+complete once the coordinator and all workers have written their file; the previous one is kept until then. Only the
+coordinator removes old checkpoints, so processes never race on the same directory.
+"""
+
+CHECKPOINT_DIR_NAME = "checkpoints"
+
+
+def get_checkpoint_dir(path, iteration):
+    return os.path.join(path, CHECKPOINT_DIR_NAME, f"{iteration:09d}")
+
+
+def get_rng_states():
+    return np.random.get_state(), torch.get_rng_state()
+
+
+def set_rng_states(rng_states):
+    np_state, torch_state = rng_states
+    np.random.set_state(np_state)
+    torch.set_rng_state(torch_state)
+
+
+class CheckpointWriter:
+    # num_workers: given for the coordinator, which removes the checkpoints older than the latest complete one
+    def __init__(self, path, name, num_workers=None):
+        self.path = path
+        self.file_name = f"{name}.pkl"
+        self.num_workers = num_workers
+        self.thread = None
+
+    def save(self, iteration, obj):
+        data = pickle.dumps((obj, get_rng_states()), protocol=pickle.HIGHEST_PROTOCOL)
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(iteration, data))
+        self.thread.start()
+
+    def write(self, iteration, data):
+        checkpoint_dir = get_checkpoint_dir(self.path, iteration)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        file_path = os.path.join(checkpoint_dir, self.file_name)
+        with open(file_path + ".tmp", 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file_path + ".tmp", file_path)
+        if self.num_workers is not None:
+            self.remove_old_checkpoints()
+
+    # every process writes its checkpoints in order, so none of them writes into a checkpoint older than a complete one
+    def remove_old_checkpoints(self):
+        latest_iteration = get_latest_complete_checkpoint(self.path, self.num_workers)
+        if latest_iteration is None:
+            return
+        for iteration in get_checkpoint_iterations(self.path):
+            if iteration < latest_iteration:
+                shutil.rmtree(get_checkpoint_dir(self.path, iteration), ignore_errors=True)
+
+    # the process must not exit before the last checkpoint is on disk
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def get_checkpoint_iterations(path):
+    checkpoints_path = os.path.join(path, CHECKPOINT_DIR_NAME)
+    if not os.path.exists(checkpoints_path):
+        return []
+    return sorted(int(dir_name) for dir_name in os.listdir(checkpoints_path))
+
+
+# checkpoints of an earlier run in the same folder must not be mistaken for checkpoints of a new one
+def remove_checkpoints(path):
+    shutil.rmtree(os.path.join(path, CHECKPOINT_DIR_NAME), ignore_errors=True)
+
+
+def get_checkpoint_file_names(num_workers):
+    return ["coordinator.pkl"] + [f"worker_{i}.pkl" for i in range(num_workers)]
+
+
+def get_latest_complete_checkpoint(path, num_workers):
+    for iteration in reversed(get_checkpoint_iterations(path)):
+        checkpoint_files = os.listdir(get_checkpoint_dir(path, iteration))
+        if all(file_name in checkpoint_files for file_name in get_checkpoint_file_names(num_workers)):
+            return iteration
+    return None
+
+
+def find_latest_checkpoint(path, num_workers):
+    iteration = get_latest_complete_checkpoint(path, num_workers)
+    if iteration is None:
+        sys.exit("No complete checkpoint found!")
+    return iteration
+
+
+# returns the pickled object and the RNG states to restore in the process that continues it
+def load_checkpoint(path, iteration, name):
+    with open(os.path.join(get_checkpoint_dir(path, iteration), f"{name}.pkl"), 'rb') as file:
+        return pickle.load(file)
@@ -1,19 +1,270 @@
+import argparse
+import contextlib
+import copy
+import io
+import itertools
 import json
+import os
 import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+from scipy.sparse import bmat, csc_matrix, csr_matrix, diags, identity, issparse, vstack
+from scipy.sparse.linalg import LinearOperator, MatrixRankWarning, splu, spsolve
 from scipy.stats import skellam
 
+import cache
+
 
 server_state = np.array([0, 1])
 server_state_len = 2
 error = 0.0001
+# chains with at least this many states are solved as sparse matrices, queues with at least this many lengths get
+# banded transition matrices
+SPARSE_MIN_SIZE = 500
 
 
 def cost(fs, min_frac, max_frac):
     return min(max((fs - min_frac) / (max_frac - min_frac), 0), 1)
 
 
+# stationary distribution of a column stochastic chain[s2][s1]: "direct" solves (chain - I) p = 0 with sum(p) = 1
+# (sparse LU for large chains) and falls back to power iteration if the chain has no unique stationary distribution;
+# "power" iterates p <- chain p from initial (uniform if None) until the L2 change is below tolerance. Sparse chains
+# are factored in their own order, which should keep them banded (see SparseTransitions)
+def get_stationary_distribution(chain, method="direct", initial=None, tolerance=error):
+    if method == "direct":
+        p = solve_stationary_distribution(chain, tolerance)
+        if p is not None:
+            return p
+    elif method != "power":
+        sys.exit("Unknown stationary distribution solver!")
+    return iterate_stationary_distribution(chain, initial, tolerance)
+
+
+def solve_stationary_distribution(chain, tolerance=error):
+    size = chain.shape[0]
+    # the rows of chain - I sum to zero, so one of them can be replaced by the normalization
+    if issparse(chain):
+        a = vstack([(chain - identity(size)).tocsr()[:-1], np.ones((1, size))], format="csc")
+    else:
+        a = chain - np.eye(size)
+        a[-1] = 1
+    b = np.zeros(size)
+    b[-1] = 1
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", MatrixRankWarning)
+        try:
+            if issparse(a):
+                # chain - I is column diagonally dominant, so the LU needs no pivoting that could break the band;
+                # the row of ones only fills in the last row of L
+                p = splu(a, permc_spec="NATURAL", diag_pivot_thresh=0).solve(b)
+            elif size >= SPARSE_MIN_SIZE:
+                p = spsolve(csc_matrix(a), b)
+            else:
+                p = np.linalg.solve(a, b)
+        except (np.linalg.LinAlgError, RuntimeError):
+            return None
+    if not np.all(np.isfinite(p)) or np.sqrt(((chain @ p - p) ** 2).sum()) > tolerance:
+        return None
+    return p
+
+
+def iterate_stationary_distribution(chain, initial=None, tolerance=error):
+    p = np.ones(chain.shape[0]) / chain.shape[0] if initial is None else initial
+    difference = 1
+    while difference > tolerance:
+        new_p = chain @ p
+        difference = np.sqrt(((p - new_p) ** 2).sum())
+        p = new_p
+    return p
+
+
+# sum over next states s2 of trans[s2][s1] * values[s2] for every s1; rows are added in order of s2 like a loop
+# over s2 would, so the rounding is the same
+def expectation(trans, values):
+    return (trans * values[:, None]).sum(axis=0)
+
+
+# start + all terms (in row-major order), added one after the other like a loop would
+def sequential_sum(terms, start=0.0):
+    return np.cumsum(np.concatenate([[start], np.ravel(terms)]))[-1]
+
+
+class DenseTransitions:
+    """
+    Transition probabilities of the app states as a dense tran_prob[s2][s1][a] tensor (a = 0: sprinting, 1: nominal)
+    """
+    def __init__(self, tran_prob):
+        self.tran_prob = tran_prob
+        self.app_state_len = tran_prob.shape[0]
+        # transition rows of every app state, for in-place updates
+        self.rows = [np.ascontiguousarray(tran_prob[:, :, a].T) for a in range(2)]
+
+    def get_tran_prob(self):
+        return self.tran_prob
+
+    # sum over s2 of tran_prob[s2][s1][a] * values[s2] for every s1
+    def expectation(self, a, values):
+        return expectation(self.tran_prob[:, :, a], values)
+
+    # the same for one s1
+    def row_expectation(self, a, s1, values):
+        return self.rows[a][s1] @ values
+
+    # chain of (server state, app state) under the policy given by actions (0: sprint in that app state), as a
+    # column stochastic 2S x 2S matrix over [active states, cooling states]
+    def get_policy_chain(self, actions, prob_cooling):
+        trans_action = self.tran_prob[:, np.arange(self.app_state_len), actions.astype(int)]
+        trans_ns = self.tran_prob[:, :, 1]
+        return np.block([[trans_action * actions, (1 - prob_cooling) * trans_ns],
+                         [trans_action * (1 - actions), prob_cooling * trans_ns]])
+
+    # transition matrix of the same chain by rows: model @ v is the expectation of v after one step
+    def get_policy_model(self, actions, prob_cooling):
+        trans_s, trans_ns = self.rows
+        sprint = (actions == 0)[:, None]
+        return np.block([[np.where(sprint, 0, trans_ns), np.where(sprint, trans_s, 0)],
+                         [(1 - prob_cooling) * trans_ns, prob_cooling * trans_ns]])
+
+    def get_stationary_distribution(self, actions, prob_cooling, method="direct", initial=None):
+        return get_stationary_distribution(self.get_policy_chain(actions, prob_cooling), method, initial)
+
+    # values of the policy: solution of (I - discount_factor * P) v = rewards
+    def evaluate_policy(self, actions, prob_cooling, discount_factor, rewards):
+        model = self.get_policy_model(actions, prob_cooling)
+        return np.linalg.solve(np.eye(len(rewards)) - discount_factor * model, rewards)
+
+
+class SparseTransitions(DenseTransitions):
+    """
+    Transition probabilities as sparse matrices rows[a][s1][s2], for apps that only move to a few app states from
+    any state (the band of queue length changes of Queue). Memory and the time of a sweep are O(nonzeros) instead of
+    O(S^2), stationary distributions and policy values are solved by sparse LU.
+    """
+    def __init__(self, rows):
+        self.rows = [csr_matrix(matrix) for matrix in rows]
+        self.app_state_len = self.rows[0].shape[0]
+        # order of the linear solves, [(active, 0), (cooling, 0), (active, 1), ...]: it keeps the policy chain
+        # banded, where the block order [active states, cooling states] is not, so its LU factors hardly fill in
+        self.order = np.arange(2 * self.app_state_len).reshape(server_state_len, self.app_state_len).T.ravel()
+
+    def get_tran_prob(self):
+        return np.stack([matrix.T.toarray() for matrix in self.rows], axis=2)
+
+    def expectation(self, a, values):
+        return self.rows[a] @ values
+
+    def row_expectation(self, a, s1, values):
+        matrix = self.rows[a]
+        start, end = matrix.indptr[s1], matrix.indptr[s1 + 1]
+        return matrix.data[start:end] @ values[matrix.indices[start:end]]
+
+    def get_policy_chain(self, actions, prob_cooling):
+        return self.get_policy_model(actions, prob_cooling).T.tocsc()
+
+    def get_policy_model(self, actions, prob_cooling):
+        trans_s, trans_ns = self.rows
+        sprint = diags((actions == 0).astype(float))
+        nominal = diags((actions != 0).astype(float))
+        return bmat([[nominal @ trans_ns, sprint @ trans_s],
+                     [(1 - prob_cooling) * trans_ns, prob_cooling * trans_ns]], format="csr")
+
+    def interleave(self, matrix):
+        return csr_matrix(matrix)[self.order][:, self.order].tocsc()
+
+    def get_stationary_distribution(self, actions, prob_cooling, method="direct", initial=None):
+        chain = self.interleave(self.get_policy_chain(actions, prob_cooling))
+        if initial is not None:
+            initial = initial[self.order]
+        p = np.empty(len(self.order))
+        p[self.order] = get_stationary_distribution(chain, method, initial)
+        return p
+
+    def evaluate_policy(self, actions, prob_cooling, discount_factor, rewards):
+        model = self.get_policy_model(actions, prob_cooling)
+        # I - discount_factor * P is diagonally dominant (by rows) as well
+        lu = splu(self.interleave(identity(len(rewards)) - discount_factor * model), permc_spec="NATURAL",
+                  diag_pivot_thresh=0)
+        v = np.empty(len(rewards))
+        v[self.order] = lu.solve(rewards[self.order])
+        return v
+
+
+class RankOneTransitions(DenseTransitions):
+    """
+    Transition probabilities that do not depend on the current app state or action: tran_prob[s2][s1][a] = probs[s2]
+    (Uniform, Spark). The policy chain P = U W^T then has rank two, with U giving the server state a step moves to
+    and W the next app state, so a sweep is O(S), the stationary distribution is W times the one of the 2 x 2 chain
+    U^T W and policy values follow from the Woodbury identity.
+    """
+    def __init__(self, probs):
+        self.probs = np.asarray(probs, dtype=float)
+        self.app_state_len = len(self.probs)
+
+    def get_tran_prob(self):
+        return np.repeat(np.repeat(self.probs[:, None, None], self.app_state_len, axis=1), 2, axis=2)
+
+    # the same for every s1, added in order of s2 like expectation
+    def expectation(self, a, values):
+        return np.full(self.app_state_len, sequential_sum(self.probs * values))
+
+    def row_expectation(self, a, s1, values):
+        return self.probs @ values
+
+    # U and W of the chain over [active states, cooling states], both 2S x 2
+    def get_factors(self, actions, prob_cooling):
+        size = self.app_state_len
+        u = np.zeros((2 * size, 2))
+        u[:size, 0] = actions
+        u[:size, 1] = 1 - actions
+        u[size:, 0] = 1 - prob_cooling
+        u[size:, 1] = prob_cooling
+        w = np.zeros((2 * size, 2))
+        w[:size, 0] = self.probs
+        w[size:, 1] = self.probs
+        return u, w
+
+    def get_policy_chain(self, actions, prob_cooling):
+        u, w = self.get_factors(actions, prob_cooling)
+        return LinearOperator((len(u), len(u)), matvec=lambda p: w @ (u.T @ np.ravel(p)))
+
+    def get_policy_model(self, actions, prob_cooling):
+        u, w = self.get_factors(actions, prob_cooling)
+        return LinearOperator((len(u), len(u)), matvec=lambda v: u @ (w.T @ np.ravel(v)))
+
+    # initial does not matter, the 2 x 2 chain is solved exactly
+    def get_stationary_distribution(self, actions, prob_cooling, method="direct", initial=None):
+        u, w = self.get_factors(actions, prob_cooling)
+        return w @ get_stationary_distribution(u.T @ w, method)
+
+    # (I - d U W^T)^-1 r = r + d U (I - d W^T U)^-1 W^T r
+    def evaluate_policy(self, actions, prob_cooling, discount_factor, rewards):
+        u, w = self.get_factors(actions, prob_cooling)
+        return rewards + discount_factor * u @ np.linalg.solve(np.eye(2) - discount_factor * w.T @ u, w.T @ rewards)
+
+
+# row-form transition matrix [s1][s2] of a queue whose length changes by Skellam(arrival_tps, tps) per step, clipped
+# to [0, app_state_len - 1]. Changes of probability below band_tolerance are folded into the nearest kept change, so
+# the matrix is banded (plus the boundary columns)
+def get_queue_rows(app_state_len, arrival_tps, tps, band_tolerance):
+    offsets = np.arange(- app_state_len + 1, app_state_len)
+    pmf = skellam.pmf(offsets, arrival_tps, tps)
+    band = np.flatnonzero(pmf >= band_tolerance)
+    if len(band) == 0:
+        sys.exit("dp_queue_band_tolerance is larger than every transition probability!")
+    offsets = offsets[band[0]:band[-1] + 1]
+    pmf = pmf[band[0]:band[-1] + 1]
+    pmf[0] += skellam.cdf(offsets[0] - 1, arrival_tps, tps)
+    pmf[-1] += skellam.sf(offsets[-1], arrival_tps, tps)
+    lengths = np.arange(app_state_len, dtype=np.int32)
+    next_lengths = np.clip(lengths[:, None] + offsets.astype(np.int32)[None, :], 0, app_state_len - 1)
+    return csr_matrix((np.tile(pmf, app_state_len), (np.repeat(lengths, len(offsets)), next_lengths.ravel())),
+                      shape=(app_state_len, app_state_len))
+
+
 class App:
 
     def get_app_state_len(self) -> int:
@@ -28,37 +279,37 @@ class App:
     def get_tran_prob(self) -> np.ndarray:
         pass
 
+    # transition operator of the app states (DenseTransitions or one of its structured subclasses)
+    def get_transitions(self):
+        return self.transitions
+
     def get_state(self, index):
         raise NotImplementedError
 
-    def calculate_app_state_probs(self, action, prob_cooling):
-        dim = (server_state_len, self.get_app_state_len())
-        p = np.ones(dim) / (server_state_len * self.get_app_state_len())
-        difference = 1
-        trans = self.get_tran_prob()
-        while difference > error:
-            new_p = np.zeros(dim)
-
-            for s2 in range(self.get_app_state_len()):
-                for s1 in range(self.get_app_state_len()):
-                    new_p[0][s2] += p[0][s1] * action[s1] * trans[s2][s1][int(action[s1])]
-                    new_p[0][s2] += p[1][s1] * (1 - prob_cooling) * trans[s2][s1][1]
-
-                    new_p[1][s2] += p[0][s1] * (1 - action[s1]) * trans[s2][s1][int(action[s1])]
-                    new_p[1][s2] += p[1][s1] * prob_cooling * trans[s2][s1][1]
-            
-            difference = np.sqrt(((p - new_p) ** 2).sum())
-            p = new_p.copy()
+    def get_sprinting_utilities(self):
+        return np.array([self.get_sprinting_utility(index) for index in range(self.get_app_state_len())], dtype=float)
 
-        return p
+    def get_nominal_utilities(self):
+        return np.array([self.get_nominal_utility(index) for index in range(self.get_app_state_len())], dtype=float)
+
+    # chain of (server state, app state) under the policy given by action (0: sprint in that app state), see
+    # DenseTransitions.get_policy_chain
+    def get_policy_chain(self, action, prob_cooling):
+        return self.get_transitions().get_policy_chain(action, prob_cooling)
+
+    # initial: previous distribution, warm start of power iteration
+    def calculate_app_state_probs(self, action, prob_cooling, method="direct", initial=None):
+        if initial is not None:
+            initial = np.ravel(initial)
+        p = self.get_transitions().get_stationary_distribution(action, prob_cooling, method, initial)
+        return p.reshape(server_state_len, self.get_app_state_len())
 
 
 class Uniform(App):
     def __init__(self, app_utilities):
         self.app_state = app_utilities
         self.app_state_len = len(app_utilities)
-        dim = (self.app_state_len, self.app_state_len, 2)
-        self.tran_prob = np.ones(dim) * (1 / self.app_state_len)
+        self.transitions = RankOneTransitions(np.ones(self.app_state_len) * (1 / self.app_state_len))
 
     def get_app_state_len(self):
         return self.app_state_len
@@ -73,7 +324,7 @@ class Uniform(App):
         return 0
 
     def get_tran_prob(self):
-        return self.tran_prob
+        return self.transitions.get_tran_prob()
 
 
 class Markov(App):
@@ -87,6 +338,7 @@ class Markov(App):
             for j in range(self.app_state_len):
                 self.tran_prob[j][i][0] = transition_matrix[i][j]
                 self.tran_prob[j][i][1] = transition_matrix[i][j]
+        self.transitions = DenseTransitions(self.tran_prob)
 
     def get_app_state_len(self):
         return self.app_state_len
@@ -105,33 +357,21 @@ class Markov(App):
 
 
 class Queue(App):
-    def __init__(self, arrival_tps, sprinting_tps, nominal_tps, max_queue_length, utility_normalization_factor):
+    def __init__(self, arrival_tps, sprinting_tps, nominal_tps, max_queue_length, utility_normalization_factor,
+                 band_tolerance=0):
         self.app_state = np.arange(max_queue_length)
         self.app_state_len = max_queue_length
         self.arrival_tps = arrival_tps
         self.nominal_tps = nominal_tps
         self.sprinting_tps = sprinting_tps
         self.utility_normalization_factor = utility_normalization_factor
-        dim = (self.app_state_len, self.app_state_len, 2)
-        self.tran_prob = np.zeros(dim)
-        for i in range(self.app_state_len):
-            for j in range(self.app_state_len):
-                probability_s = skellam.pmf(j - i, arrival_tps, sprinting_tps)
-                probability_ns = skellam.pmf(j - i, arrival_tps, nominal_tps)
-                self.tran_prob[j][i][0] += probability_s
-                self.tran_prob[j][i][1] += probability_ns
-
-            probability_e_s = skellam.cdf(- i - 1, arrival_tps, sprinting_tps)
-            probability_e_ns = skellam.cdf(- i - 1, arrival_tps, nominal_tps)
-            self.tran_prob[0][i][0] += probability_e_s
-            self.tran_prob[0][i][1] += probability_e_ns
-
-            probability_f_s = skellam.sf(self.app_state_len - i - 1, arrival_tps, sprinting_tps)
-            probability_f_ns = skellam.sf(self.app_state_len - i - 1, arrival_tps, nominal_tps)
-            self.tran_prob[-1][i][0] += probability_f_s
-            self.tran_prob[-1][i][1] += probability_f_ns
-
-        # print(self.tran_prob.sum(axis=0))
+        self.tran_prob = None
+        # the sparse matrices only pay off for long queues, short ones keep the exact dense tensor
+        if self.app_state_len >= SPARSE_MIN_SIZE:
+            self.transitions = SparseTransitions([get_queue_rows(self.app_state_len, arrival_tps, tps, band_tolerance)
+                                                  for tps in [sprinting_tps, nominal_tps]])
+        else:
+            self.transitions = DenseTransitions(self.get_tran_prob())
 
     def get_app_state_len(self):
         return self.app_state_len
@@ -147,7 +387,20 @@ class Queue(App):
         new_queue_length = max(0, self.app_state[index] + self.arrival_tps - self.nominal_tps)
         return - self.utility_normalization_factor * min(new_queue_length, self.app_state_len - 1)
 
+    # dense tensor, only built on request
     def get_tran_prob(self):
+        if self.tran_prob is None:
+            dim = (self.app_state_len, self.app_state_len, 2)
+            self.tran_prob = np.zeros(dim)
+            # tran_prob[j][i] only depends on the offset j - i, so the distribution is evaluated once per offset
+            offsets = np.arange(- self.app_state_len + 1, self.app_state_len)
+            lengths = np.arange(self.app_state_len)
+            for a, tps in enumerate([self.sprinting_tps, self.nominal_tps]):
+                pmf = skellam.pmf(offsets, self.arrival_tps, tps)
+                self.tran_prob[:, :, a] = pmf[lengths[:, None] - lengths[None, :] + self.app_state_len - 1]
+                # the mass of queue lengths below 0 and above the largest one goes to the boundary states
+                self.tran_prob[0, :, a] += skellam.cdf(- lengths - 1, self.arrival_tps, tps)
+                self.tran_prob[-1, :, a] += skellam.sf(self.app_state_len - lengths - 1, self.arrival_tps, tps)
         return self.tran_prob
 
 
@@ -157,12 +410,7 @@ class Spark(App):
         # prob = [float(num) for num in prob]
         self.app_state = app_utilities
         self.app_state_len = len(app_utilities)
-        dim = (self.app_state_len, self.app_state_len, 2)
-        self.tran_prob = np.zeros(dim)
-        for i in range(self.app_state_len):
-            for j in range(self.app_state_len):
-                self.tran_prob[i][j][0] = prob[i]
-                self.tran_prob[i][j][1] = prob[i]
+        self.transitions = RankOneTransitions(prob)
 
     def get_app_state_len(self):
         return self.app_state_len
@@ -177,26 +425,53 @@ class Spark(App):
         return 0
 
     def get_tran_prob(self):
-        return self.tran_prob
-
-
-def run_dp(config_file_name, app_type_id, app_sub_type_id):
-    with open(config_file_name, 'r') as f:
-        config = json.load(f)
-
-    min_frac = config["coordinator_config"]["min_frac"]
-    max_frac = config["coordinator_config"]["max_frac"]
-    app_type = config["app_types"][app_type_id]
-    app_sub_type = config["app_sub_types"][app_type][app_sub_type_id]
-    discount_factor = config["ac_discount_factor"][app_type][app_sub_type]
-    prob_cooling = config["servers_config"]["cooling_prob"]
+        return self.transitions.get_tran_prob()
+
+
+# config values the DP solution depends on
+DP_CONFIG_KEYS = ["dp_error", "dp_error_change", "dp_solver", "dp_evaluation_sweeps", "dp_stationary_solver",
+                  "dp_outer_solver", "dp_outer_tolerance", "dp_outer_max_iterations", "dp_anderson_memory",
+                  "ac_discount_factor", "app_utilities", "utility_normalization_factor",
+                  "markov_app_transition_matrices", "queue_app_arrival_tps", "queue_app_arrival_tps_change",
+                  "queue_app_sprinting_tps", "queue_app_nominal_tps", "dp_queue_max_queue_length",
+                  "dp_queue_band_tolerance"]
+
+
+class PolicyCache:
+    """
+    Stationary distribution, fraction of sprinters and expected utility (without costs) of the threshold policies
+    seen by value iteration, keyed by the bitmask of sprinting app states. The actions settle after a few sweeps, so
+    most sweeps reuse an entry; a new policy warm starts power iteration from the latest distribution.
+    """
+    def __init__(self, app, prob_cooling, stationary_solver):
+        self.app = app
+        self.prob_cooling = prob_cooling
+        self.stationary_solver = stationary_solver
+        self.sprinting_utilities = app.get_sprinting_utilities()
+        self.nominal_utilities = app.get_nominal_utilities()
+        self.entries = {}
+        self.probs = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, actions):
+        key = np.packbits(actions == 0).tobytes()
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        probs = self.app.calculate_app_state_probs(actions, self.prob_cooling, self.stationary_solver, self.probs)
+        frac_sprinters = sequential_sum(probs[0] * (1 - actions))
+        utility = sequential_sum(np.column_stack([probs[0] * (1 - actions) * self.sprinting_utilities,
+                                                  probs[0] * actions * self.nominal_utilities,
+                                                  probs[1] * self.nominal_utilities]))
+        self.probs = probs
+        self.entries[key] = (probs, frac_sprinters, utility)
+        return self.entries[key]
+
+
+def get_app(config, app_type, app_sub_type):
     add_change = config["servers_config"]["change"]
-    if add_change == 1:
-        error_1 = config["dp_error_change"][app_type][app_sub_type]
-    else:
-        error_1 = config["dp_error"][app_type][app_sub_type]
-    print(error_1)
-
     app_utilities = config["app_utilities"]
 
     if app_type == "uniform":
@@ -213,7 +488,9 @@ def run_dp(config_file_name, app_type_id, app_sub_type_id):
         sprinting_tps = config["queue_app_sprinting_tps"][app_sub_type]
         nominal_tps = config["queue_app_nominal_tps"][app_sub_type]
         utility_normalization_factor = config["utility_normalization_factor"][app_type][app_sub_type]
-        app = Queue(arrival_tps, sprinting_tps, nominal_tps, 20, utility_normalization_factor)
+        max_queue_length = config["dp_queue_max_queue_length"][app_sub_type]
+        app = Queue(arrival_tps, sprinting_tps, nominal_tps, max_queue_length, utility_normalization_factor,
+                    config["dp_queue_band_tolerance"])
         # sys.exit()
     elif app_type == "spark":
         with open('data/gain.txt') as file:
@@ -256,81 +533,405 @@ def run_dp(config_file_name, app_type_id, app_sub_type_id):
         app = Spark(app_utilities, prob)
     else:
         sys.exit("App model is not supported")
-
-    trans = app.get_tran_prob()
-    app_state_len = app.get_app_state_len()
-    dim = (server_state_len, app_state_len)
-    #v = np.random.rand(server_state_len, app_state_len)
-    v = np.zeros(dim)
-    new_v = np.zeros(dim)
-    actions = np.ones(app_state_len)
-    q_s = np.zeros(app_state_len)
-    q_ns = np.zeros(app_state_len)
+    return app
+
+
+class DPProblem:
+    """
+    Single-server MDP of one app type and sub-type: server state 0 (active) or 1 (cooling) times the app state. The
+    fleet only enters through the cost of the fraction of sprinters, which is subtracted from every reward.
+    """
+    def __init__(self, app, discount_factor, prob_cooling, min_frac, max_frac, stationary_solver,
+                 solver="value_iteration", evaluation_sweeps=20):
+        self.app = app
+        self.transitions = app.get_transitions()
+        self.app_state_len = app.get_app_state_len()
+        self.sprinting_utilities = app.get_sprinting_utilities()
+        self.nominal_utilities = app.get_nominal_utilities()
+        self.discount_factor = discount_factor
+        self.prob_cooling = prob_cooling
+        self.min_frac = min_frac
+        self.max_frac = max_frac
+        self.policy_cache = PolicyCache(app, prob_cooling, stationary_solver)
+        # "value_iteration" (Jacobi sweeps), "gauss_seidel" (in-place sweeps), "policy_iteration" (greedy policy,
+        # evaluated exactly by a linear solve) or "modified_policy_iteration" (greedy policy, evaluated by
+        # evaluation_sweeps sweeps in total)
+        self.solver = solver
+        self.evaluation_sweeps = evaluation_sweeps
+
+        # convergence diagnostics: steps of the solver, Bellman sweeps, exact policy evaluations, the L2 change of v
+        # in every step and the number of steps that changed the policy
+        self.steps = 0
+        self.sweeps = 0
+        self.evaluations = 0
+        self.residuals = []
+        self.policy_changes = 0
+        self.actions = None
+
+    def get_cost(self, frac_sprinters):
+        return cost(frac_sprinters, self.min_frac, self.max_frac)
+
+    # one Jacobi sweep: new values and greedy actions (0: sprint) for a fixed cost
+    def bellman_update(self, v, total_cost):
+        self.sweeps += 1
+        discount_factor = self.discount_factor
+        next_active_ns = self.transitions.expectation(1, v[0])
+        next_inactive_s = self.transitions.expectation(0, v[1])
+        next_inactive_ns = self.transitions.expectation(1, v[1])
+
+        q_s = self.sprinting_utilities - total_cost + discount_factor * next_inactive_s
+        q_ns = self.nominal_utilities - total_cost + discount_factor * next_active_ns
+
+        new_v = np.zeros(v.shape)
+        new_v[1] = self.nominal_utilities - total_cost
+        new_v[1] += discount_factor * (self.prob_cooling * next_inactive_ns + (1 - self.prob_cooling) * next_active_ns)
+
+        sprint = q_s > q_ns
+        new_v[0] = np.where(sprint, q_s, q_ns)
+        return new_v, np.where(sprint, 0.0, 1.0)
+
+    # Gauss-Seidel sweep: the values of every state are overwritten as soon as they are computed, active states first
+    def gauss_seidel_update(self, v, total_cost):
+        self.sweeps += 1
+        discount_factor = self.discount_factor
+        row_expectation = self.transitions.row_expectation
+        v = v.copy()
+        actions = np.ones(self.app_state_len)
+        for s1 in range(self.app_state_len):
+            q_s = self.sprinting_utilities[s1] - total_cost + discount_factor * row_expectation(0, s1, v[1])
+            q_ns = self.nominal_utilities[s1] - total_cost + discount_factor * row_expectation(1, s1, v[0])
+            if q_s > q_ns:
+                v[0][s1] = q_s
+                actions[s1] = 0
+            else:
+                v[0][s1] = q_ns
+        for s1 in range(self.app_state_len):
+            v[1][s1] = self.nominal_utilities[s1] - total_cost + discount_factor * (
+                self.prob_cooling * row_expectation(1, s1, v[1]) +
+                (1 - self.prob_cooling) * row_expectation(1, s1, v[0]))
+        return v, actions
+
+    # rewards and transition matrix of the policy given by actions, over [active states, cooling states]
+    def get_policy_model(self, actions, total_cost):
+        return self.get_rewards(actions, total_cost), self.transitions.get_policy_model(actions, self.prob_cooling)
+
+    def get_rewards(self, actions, total_cost):
+        return np.concatenate([np.where(actions == 0, self.sprinting_utilities, self.nominal_utilities),
+                               self.nominal_utilities]) - total_cost
+
+    # values of the policy: solution of (I - discount_factor * P) v = r
+    def evaluate_policy(self, actions, total_cost):
+        self.evaluations += 1
+        v = self.transitions.evaluate_policy(actions, self.prob_cooling, self.discount_factor,
+                                             self.get_rewards(actions, total_cost))
+        return v.reshape(server_state_len, self.app_state_len)
+
+    # one step of the solver: new values and the greedy actions they were computed with
+    def step(self, v, total_cost):
+        if self.solver == "value_iteration":
+            new_v, actions = self.bellman_update(v, total_cost)
+        elif self.solver == "gauss_seidel":
+            new_v, actions = self.gauss_seidel_update(v, total_cost)
+        elif self.solver == "policy_iteration":
+            _, actions = self.bellman_update(v, total_cost)
+            new_v = self.evaluate_policy(actions, total_cost)
+        elif self.solver == "modified_policy_iteration":
+            new_v, actions = self.bellman_update(v, total_cost)
+            rewards, model = self.get_policy_model(actions, total_cost)
+            for _ in range(self.evaluation_sweeps - 1):
+                self.sweeps += 1
+                new_v = (rewards + self.discount_factor * (model @ new_v.ravel())).reshape(v.shape)
+        else:
+            sys.exit("Unknown DP solver!")
+
+        self.steps += 1
+        self.residuals.append(np.sqrt(((new_v - v) ** 2).sum()))
+        if self.actions is not None and np.any(actions != self.actions):
+            self.policy_changes += 1
+        self.actions = actions
+        return new_v, actions
+
+    # solve the MDP with a fixed cost until a step changes v by at most tolerance (L2)
+    def solve_mdp(self, total_cost, v, tolerance):
+        diff = tolerance + 1
+        while diff > tolerance:
+            v, actions = self.step(v, total_cost)
+            diff = self.residuals[-1]
+        return v, actions
+
+
+# fixed point f = g(f) of a map of [0, 1] into itself, by "bisection" on g(f) - f, "secant" steps or "anderson"
+# acceleration over the latest anderson_memory iterates; returns (f, g(f), number of evaluations of g)
+def solve_fixed_point(g, method, tolerance, max_iterations, anderson_memory=3):
+    if method == "bisection":
+        low, high = 0.0, 1.0
+        for itr in range(1, max_iterations + 1):
+            f = (low + high) / 2
+            g_f = g(f)
+            # g is piecewise constant, the fixed point can sit on a jump
+            if abs(g_f - f) <= tolerance or high - low <= tolerance:
+                break
+            if g_f > f:
+                low = f
+            else:
+                high = f
+        return f, g_f, itr
+
+    fs = []
+    gs = []
+    f = 0.0
+    for itr in range(1, max_iterations + 1):
+        g_f = g(f)
+        if abs(g_f - f) <= tolerance:
+            break
+        fs.append(f)
+        gs.append(g_f)
+        if method == "secant":
+            fs, gs = fs[-2:], gs[-2:]
+        elif method == "anderson":
+            fs, gs = fs[-anderson_memory - 1:], gs[-anderson_memory - 1:]
+        else:
+            sys.exit("Unknown outer solver!")
+        residuals = np.array(gs) - np.array(fs)
+        if len(fs) == 1 or not np.any(np.diff(residuals)):
+            f = g_f
+        elif method == "secant":
+            f = fs[-1] - residuals[-1] * (fs[-1] - fs[-2]) / (residuals[-1] - residuals[-2])
+        else:
+            # gamma = argmin |r_k - sum_i gamma_i (r_i+1 - r_i)|, f = g_k - sum_i gamma_i (g_i+1 - g_i)
+            gamma = np.linalg.lstsq(np.diff(residuals)[None, :], residuals[-1:], rcond=None)[0]
+            f = g_f - np.diff(gs) @ gamma
+        f = float(np.clip(f, 0, 1))
+    return f, g_f, itr
+
+
+# naive alternation: one solver step with the cost of the previous fraction of sprinters, then the fraction of
+# sprinters of the new greedy policy, until a step changes v by at most error_1
+def alternate(problem, error_1):
+    v = np.zeros((server_state_len, problem.app_state_len))
+    actions = np.ones(problem.app_state_len)
     frac_sprinters = 0
     avg_reward = 0
 
     itr = 0
     diff = 10
     while diff > error_1:
-        print(diff)
         itr += 1
-        total_cost = cost(frac_sprinters, min_frac, max_frac)
-
-        for s1 in range(app_state_len):
-
-            next_active_ns = 0
-            next_inactive_s = 0
-            next_inactive_ns = 0
-
-            for s2 in range(app_state_len):
-                next_active_ns += trans[s2][s1][1] * v[0][s2]
-                next_inactive_s += trans[s2][s1][0] * v[1][s2]
-                next_inactive_ns += trans[s2][s1][1] * v[1][s2]
+        total_cost = problem.get_cost(frac_sprinters)
+        new_v, actions = problem.step(v, total_cost)
 
-            q_s[s1] = app.get_sprinting_utility(s1) - total_cost + discount_factor * next_inactive_s
-            q_ns[s1] = app.get_nominal_utility(s1) - total_cost + discount_factor * next_active_ns
+        probs, frac_sprinters, policy_utility = problem.policy_cache.get(actions)
+        avg_reward = policy_utility - total_cost
 
-            new_v[1][s1] = app.get_nominal_utility(s1) - total_cost
-            new_v[1][s1] += discount_factor * (prob_cooling * next_inactive_ns + (1 - prob_cooling) * next_active_ns)
-
-            if q_s[s1] > q_ns[s1]:
-                new_v[0][s1] = q_s[s1]
-                actions[s1] = 0
-            else:
-                new_v[0][s1] = q_ns[s1]
-                actions[s1] = 1
-
-        probs = app.calculate_app_state_probs(actions, prob_cooling)
-        frac_sprinters = 0
-        avg_reward = - total_cost
-        for s1 in range(app_state_len):
-            frac_sprinters += probs[0][s1] * (1 - actions[s1])
-            avg_reward += probs[0][s1] * (1 - actions[s1]) * app.get_sprinting_utility(s1)
-            avg_reward += probs[0][s1] * actions[s1] * app.get_nominal_utility(s1)
-            avg_reward += probs[1][s1] * app.get_nominal_utility(s1)
-
-        diff = np.sqrt(((new_v - v) ** 2).sum())
+        diff = problem.residuals[-1]
         if itr % 500 == 0:
             print(itr)
-            # print(probs.sum(0))
-            # print(probs.sum(1))
-            # print(actions)
             print("total costs", total_cost)
             print("avg rewards", avg_reward)
             print("frac_sprinters", frac_sprinters)
             print("main loop diff", diff)
-        v = new_v.copy()
+        v = new_v
+    return v, actions, frac_sprinters, avg_reward, itr
+
+
+# frac_sprinters as a scalar fixed point: every evaluation solves the MDP for the cost of f (value iteration down to
+# error_1, warm started from the previous values shifted to the new cost) and returns the fraction of sprinters of
+# its greedy policy
+def solve_mean_field(problem, error_1, method, tolerance, max_iterations, anderson_memory):
+    state = {"v": np.zeros((server_state_len, problem.app_state_len)), "cost": 0}
+
+    def mean_field_map(frac_sprinters):
+        total_cost = problem.get_cost(frac_sprinters)
+        # the cost is paid in every state, so the values move by the change of its discounted sum
+        v = state["v"] - (total_cost - state["cost"]) / (1 - problem.discount_factor)
+        state["v"], state["actions"] = problem.solve_mdp(total_cost, v, error_1)
+        state["cost"] = total_cost
+        return problem.policy_cache.get(state["actions"])[1]
+
+    f, frac_sprinters, outer_iterations = solve_fixed_point(mean_field_map, method, tolerance, max_iterations,
+                                                            anderson_memory)
+    print(f"{method}: {outer_iterations} outer iterations, |g(f) - f| = {abs(frac_sprinters - f)}")
+    avg_reward = problem.policy_cache.get(state["actions"])[2] - problem.get_cost(frac_sprinters)
+    return state["v"], state["actions"], frac_sprinters, avg_reward, outer_iterations
+
+
+class DPResult:
+    """
+    Solution of solve_dp with the convergence diagnostics of its DPProblem, whatever solver produced it
+    """
+    def __init__(self, problem, v, actions, frac_sprinters, avg_reward, outer_iterations, wall_time):
+        self.solver = problem.solver
+        self.v = v
+        self.actions = actions
+        # servers sprint in states >= threshold, a policy that never sprints has no such state
+        num_nominal = int(actions.sum())
+        self.threshold = problem.app.get_state(num_nominal) if num_nominal < len(actions) else float("inf")
+        self.frac_sprinters = frac_sprinters
+        self.avg_reward = avg_reward
+        self.app_utilities = problem.app.app_state
+        self.iterations = problem.steps
+        self.sweeps = problem.sweeps
+        self.evaluations = problem.evaluations
+        self.residuals = np.array(problem.residuals)
+        self.policy_changes = problem.policy_changes
+        self.outer_iterations = outer_iterations
+        self.wall_time = wall_time
+        self.policy_cache_hits = problem.policy_cache.hits
+        self.policy_cache_misses = problem.policy_cache.misses
+
+    def print_diagnostics(self):
+        print(f"{self.solver}: {self.iterations} iterations ({self.sweeps} sweeps, {self.evaluations} policy "
+              f"evaluations, {self.policy_changes} policy changes), final residual {self.residuals[-1]}, "
+              f"{self.outer_iterations} outer iterations in {self.wall_time} seconds")
+        num_policies = self.policy_cache_hits + self.policy_cache_misses
+        print(f"Policy cache: {self.policy_cache_hits} hits out of {num_policies} "
+              f"({self.policy_cache_hits / max(num_policies, 1):.2%}), "
+              f"{self.policy_cache_misses} stationary distributions solved")
+
+
+def solve_dp(config, app_type, app_sub_type):
+    start_time = time.time()
+    min_frac = config["coordinator_config"]["min_frac"]
+    max_frac = config["coordinator_config"]["max_frac"]
+    discount_factor = config["ac_discount_factor"][app_type][app_sub_type]
+    prob_cooling = config["servers_config"]["cooling_prob"]
+    if config["servers_config"]["change"] == 1:
+        error_1 = config["dp_error_change"][app_type][app_sub_type]
+    else:
+        error_1 = config["dp_error"][app_type][app_sub_type]
+    print(error_1)
 
-    print(v)
-    print(itr)
-    print(frac_sprinters)
-    print(actions)
-    print('DP threshold is:', app.get_state(int(actions.sum())))
-    print(app_utilities)
-    print(avg_reward)
+    app = get_app(config, app_type, app_sub_type)
+    problem = DPProblem(app, discount_factor, prob_cooling, min_frac, max_frac, config["dp_stationary_solver"],
+                        config["dp_solver"], config["dp_evaluation_sweeps"])
+    outer_solver = config["dp_outer_solver"]
+    if outer_solver == "alternate":
+        v, actions, frac_sprinters, avg_reward, outer_iterations = alternate(problem, error_1)
+    else:
+        v, actions, frac_sprinters, avg_reward, outer_iterations = solve_mean_field(
+            problem, error_1, outer_solver, config["dp_outer_tolerance"], config["dp_outer_max_iterations"],
+            config["dp_anderson_memory"])
+
+    return DPResult(problem, v, actions, frac_sprinters, avg_reward, outer_iterations, time.time() - start_time)
+
+
+# DP solution of one app type and sub-type; solutions are cached by the config values they depend on (see cache.py)
+def get_dp_result(config, app_type, app_sub_type):
+    result_cache = cache.create_cache(config)
+    if result_cache is not None:
+        inputs = {key: config[key] for key in DP_CONFIG_KEYS}
+        inputs["min_frac"] = config["coordinator_config"]["min_frac"]
+        inputs["max_frac"] = config["coordinator_config"]["max_frac"]
+        inputs["cooling_prob"] = config["servers_config"]["cooling_prob"]
+        inputs["change"] = config["servers_config"]["change"]
+        inputs = cache.resolve_config(inputs, app_type, app_sub_type)
+        inputs["app_type"] = app_type
+        inputs["app_sub_type"] = app_sub_type
+        if app_type == "spark":
+            inputs["gain_file"] = cache.get_file_hash("data/gain.txt")
+        key = cache.get_key("run_dp", inputs)
+        result = result_cache.get(key)
+        if result is not None:
+            return result
+    result = solve_dp(config, app_type, app_sub_type)
+    if result_cache is not None:
+        result_cache.put(key, result)
+    return result
 
 
-if __name__ == "__main__":
-    config_file = "configs/config.json"
-    run_dp(config_file, 3, 4)
+def run_dp(config_file_name, app_type_id, app_sub_type_id):
+    with open(config_file_name, 'r') as f:
+        config = json.load(f)
+    app_type = config["app_types"][app_type_id]
+    app_sub_type = config["app_sub_types"][app_type][app_sub_type_id]
+    result = get_dp_result(config, app_type, app_sub_type)
+
+    print(result.v)
+    print(result.iterations)
+    print(result.frac_sprinters)
+    print(result.actions)
+    print('DP threshold is:', result.threshold)
+    print(result.app_utilities)
+    print(result.avg_reward)
+    result.print_diagnostics()
+    return result
+
+
+# one job of solve_all: the solution of one app type and sub-type for servers_config.change = change
+# a job that fails returns its error instead, so that it does not abort the others
+def solve_job(config, app_type, app_sub_type, change):
+    config = copy.deepcopy(config)
+    config["servers_config"]["change"] = change
+    # the progress prints of the solvers of parallel jobs would interleave
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = get_dp_result(config, app_type, app_sub_type)
+    except (Exception, SystemExit) as e:
+        return {"app_type": app_type, "app_sub_type": app_sub_type, "change": change, "error": repr(e)}
+    # JSON has no infinity, a policy that never sprints is written as null
+    threshold = None if np.isinf(result.threshold) else np.asarray(result.threshold).item()
+    return {"app_type": app_type, "app_sub_type": app_sub_type, "change": change,
+            "threshold": threshold, "frac_sprinters": float(result.frac_sprinters),
+            "avg_reward": float(result.avg_reward), "v": result.v.tolist(), "actions": result.actions.tolist(),
+            "solver": result.solver, "iterations": result.iterations, "outer_iterations": result.outer_iterations,
+            "wall_time": result.wall_time}
+
+
+# solves every sub-type of the given app types (all if None) with and without change, one job per core, and writes
+# the solutions to output_file_name (config dp_results_file if None). The file has dp_threshold and
+# dp_threshold_change tables shaped like those of the config, which get_threshold of multiprocessing_MARL uses for
+# dp_policy runs, and a list of solutions with value functions, actions and solve times. Solutions already in the
+# file for other app types are kept, and so are those of jobs that fail. A policy that never sprints has threshold
+# null (inf for get_threshold)
+def solve_all(config_file_name, app_type_ids=None, num_processes=0, output_file_name=None):
+    with open(config_file_name, 'r') as f:
+        config = json.load(f)
+    if output_file_name is None:
+        output_file_name = config["dp_results_file"]
+    if app_type_ids is None:
+        app_type_ids = range(len(config["app_types"]))
+    jobs = [(config["app_types"][app_type_id], app_sub_type, change) for app_type_id in app_type_ids
+            for app_sub_type in config["app_sub_types"][config["app_types"][app_type_id]] for change in [0, 1]]
+    if num_processes <= 0:
+        num_processes = len(os.sched_getaffinity(0))
+    num_processes = min(num_processes, len(jobs))
+    with ProcessPoolExecutor(num_processes) as executor:
+        solutions = list(executor.map(solve_job, itertools.repeat(config), *zip(*jobs)))
+    for solution in solutions:
+        if "error" in solution:
+            print(f"{solution['app_type']} {solution['app_sub_type']} change {solution['change']} failed: "
+                  f"{solution['error']}")
+    solutions = [solution for solution in solutions if "error" not in solution]
+
+    dp_results = {"dp_threshold": {}, "dp_threshold_change": {}, "solutions": []}
+    if os.path.exists(output_file_name):
+        with open(output_file_name, 'r') as f:
+            dp_results = json.load(f)
+    solved = {(solution["app_type"], solution["app_sub_type"], solution["change"]) for solution in solutions}
+    dp_results["solutions"] = [solution for solution in dp_results["solutions"] if (
+        solution["app_type"], solution["app_sub_type"], solution["change"]) not in solved] + solutions
+    for solution in solutions:
+        table = "dp_threshold_change" if solution["change"] == 1 else "dp_threshold"
+        dp_results[table].setdefault(solution["app_type"], {})[solution["app_sub_type"]] = solution["threshold"]
+        print(f"{solution['app_type']} {solution['app_sub_type']} change {solution['change']}: threshold "
+              f"{solution['threshold']}, {solution['iterations']} iterations in {solution['wall_time']:.3f} seconds")
+    with open(output_file_name, 'w') as f:
+        json.dump(dp_results, f, indent=2)
+    return dp_results
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', nargs='?', default="configs/config.json")
+    parser.add_argument('app_type_id', type=int, nargs='?', default=3)
+    parser.add_argument('app_sub_type_id', type=int, nargs='?', default=4)
+    # solve every sub-type of --app-types (all if not given) with and without change, see solve_all
+    parser.add_argument('--all', action='store_true')
+    parser.add_argument('--app-types', type=int, nargs='+')
+    parser.add_argument('--processes', type=int, default=0)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    if args.all:
+        solve_all(args.config_file, args.app_types, args.processes, args.output)
+    else:
+        run_dp(args.config_file, args.app_type_id, args.app_sub_type_id)
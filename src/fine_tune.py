@@ -1,6 +1,16 @@
 import optuna
 import json
-import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import multiprocessing_MARL as marl
+import sweep
+
+"""
+Tunes the AC hyperparameters of several sub-types at once. Every sub-type has its own study in one journal file, so
+any number of processes can work on the same study; trials pass their parameters to sweep.simulate as config
+overrides, and the per-period rewards it reports let the pruner stop hopeless trials early. The config file is only
+written once, with the best parameters of every study, at the end.
+"""
 
 
 def format(obj, indent_level=0):
@@ -37,98 +47,103 @@ def format(obj, indent_level=0):
         return json.dumps(obj)
 
 
-def objective(trial, config_file_name, app_type_id, app_type_sub_id, policy_id):
-    # Load the configuration file
+def suggest_params(trial, add_noise):
+    suffix = "noise" if add_noise else "no_noise"
+    params = {"a": trial.suggest_int("a", 2, 10, step=2), "b": trial.suggest_int("b", 2, 10, step=2),
+              "ac_discount_factor": trial.suggest_categorical("ac_discount_factor", [0.99, 0.999, 0.9999]),
+              "std_max": trial.suggest_float("std_max", 0.01, 0.1, step=0.01)}
+    params[f"c_lr_{suffix}"] = trial.suggest_categorical(f"c_lr_{suffix}", [0.001, 0.002, 0.003, 0.004, 0.005,
+                                                                              0.006, 0.007, 0.008, 0.009])
+    params[f"state_normalization_factor_{suffix}"] = trial.suggest_float(f"state_normalization_factor_{suffix}",
+                                                                         0.01, 0.1, step=0.01)
+    return params
+
+
+# config overrides for the parameters of a trial (or the best ones of a study)
+def get_overrides(params, app_type, app_sub_type, add_noise):
+    suffix = "noise" if add_noise else "no_noise"
+    c_lr = params[f"c_lr_{suffix}"]
+    a_lr = c_lr / params["b"]
+    values = {f"std_max_{suffix}": params["std_max"], f"c_lr_{suffix}": c_lr, f"a_lr_{suffix}": a_lr,
+              f"sprinters_decay_factor_{suffix}": 1 - a_lr * params["a"],
+              f"state_normalization_factor_{suffix}": params[f"state_normalization_factor_{suffix}"],
+              "ac_discount_factor": params["ac_discount_factor"]}
+    return {key: {app_type: {app_sub_type: value}} for key, value in values.items()}
+
+
+def objective(trial, config, app_type_id, app_type_sub_id, policy_id):
+    app_type, app_sub_type, _ = marl.get_run_types(config, app_type_id, app_type_sub_id, policy_id)
+    add_noise = config["coordinator_config"]["add_noise"]
+    overrides = get_overrides(suggest_params(trial, add_noise), app_type, app_sub_type, add_noise)
+
+    def report(period, average_reward):
+        trial.report(average_reward, period)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+
+    result = sweep.simulate(sweep.merge_config(config, overrides), app_type_id, app_type_sub_id, policy_id,
+                            report=report)
+    return result["average_reward"]
+
+
+# JournalFileBackend is new in optuna 4, older versions only have JournalFileStorage
+def get_storage(storage_file_name):
+    journal = getattr(optuna.storages, "journal", None)
+    if journal is not None and hasattr(journal, "JournalFileBackend"):
+        return optuna.storages.JournalStorage(journal.JournalFileBackend(storage_file_name))
+    return optuna.storages.JournalStorage(optuna.storages.JournalFileStorage(storage_file_name))
+
+
+# no pruning during the first quarter of the periods, while the AC policies are still learning
+def create_pruner(config):
+    return optuna.pruners.MedianPruner(n_startup_trials=5,
+                                       n_warmup_steps=config["coordinator_config"]["total_iterations"] // 4)
+
+
+def get_study_name(config, app_type_id, app_type_sub_id, policy_id):
+    app_type, app_sub_type, policy_type = marl.get_run_types(config, app_type_id, app_type_sub_id, policy_id)
+    return f"{policy_type}_{app_type}_{app_sub_type}"
+
+
+# one of the processes working on a study; together they stop once the study has n_trials trials
+def optimize(config, storage_file_name, app_type_id, app_type_sub_id, policy_id, n_trials):
+    study = optuna.load_study(study_name=get_study_name(config, app_type_id, app_type_sub_id, policy_id),
+                              storage=get_storage(storage_file_name), pruner=create_pruner(config))
+    study.optimize(lambda trial: objective(trial, config, app_type_id, app_type_sub_id, policy_id),
+                   callbacks=[optuna.study.MaxTrialsCallback(n_trials, states=None)])
+
+
+def main(config_file_name, app_type_id, app_type_sub_ids, policy_id, n_trials, num_processes=0,
+         storage_file_name="fine_tune.log"):
     with open(config_file_name, 'r') as f:
         config = json.load(f)
-    app_type = config["app_types"][app_type_id]
-    app_sub_type = config["app_sub_types"][app_type][app_type_sub_id]
-    a = trial.suggest_int("a", 2, 10, step=2)
-    b = trial.suggest_int("b", 2, 10, step=2)
-    config["ac_discount_factor"][app_type][app_sub_type] = trial.suggest_categorical("ac_discount_factor",
-                                                                                     [0.99, 0.999, 0.9999])
-    add_noise = config["coordinator_config"]["add_noise"]
-    if add_noise:
-        config["std_max_noise"][app_type][app_sub_type] = trial.suggest_float("std_max", 0.01, 0.1, step=0.01)
-        config["c_lr_noise"][app_type][app_sub_type] = trial.suggest_categorical("c_lr_noise", [0.001, 0.002, 0.003,
-                                                                                                0.004, 0.005, 0.006,
-                                                                                                0.007, 0.008, 0.009])
-        config['a_lr_noise'][app_type][app_sub_type] = config["c_lr_noise"][app_type][app_sub_type] / b
-        config["sprinters_decay_factor_noise"][app_type][app_sub_type] = 1 - config["a_lr_noise"][app_type][
-            app_sub_type] * a
-        config["state_normalization_factor_noise"][app_type][app_sub_type] = trial.suggest_float(
-            "state_normalization_factor_noise", 0.01, 0.1, step=0.01)
-    else:
-        config["std_max_no_noise"][app_type][app_sub_type] = trial.suggest_float("std_max", 0.01, 0.1, step=0.01)
-        config["c_lr_no_noise"][app_type][app_sub_type] = trial.suggest_categorical("c_lr_no_noise",
-                                                                                    [0.001, 0.002, 0.003,
-                                                                                     0.004, 0.005, 0.006,
-                                                                                     0.007, 0.008, 0.009])
-        config['a_lr_no_noise'][app_type][app_sub_type] = config["c_lr_no_noise"][app_type][app_sub_type] / b
-        config["sprinters_decay_factor_no_noise"][app_type][app_sub_type] = 1 - config["a_lr_no_noise"][app_type][
-            app_sub_type] * a
-        config["state_normalization_factor_no_noise"][app_type][app_sub_type] = trial.suggest_float(
-            "state_normalization_factor_no_noise", 0.01, 0.1, step=0.01)
-    # Update the parameters in the config
+    storage = get_storage(storage_file_name)
+    for app_type_sub_id in app_type_sub_ids:
+        optuna.create_study(study_name=get_study_name(config, app_type_id, app_type_sub_id, policy_id),
+                            storage=storage, direction='maximize', load_if_exists=True)
+
+    # the processes are shared evenly by the studies, which all run at the same time
+    if num_processes <= 0:
+        num_processes = len(marl.get_available_cpus())
+    processes_per_study = max(num_processes // len(app_type_sub_ids), 1)
+    with ProcessPoolExecutor(num_processes, initializer=marl.set_process_resources, initargs=(1,)) as executor:
+        futures = [executor.submit(optimize, config, storage_file_name, app_type_id, app_type_sub_id, policy_id,
+                                   n_trials)
+                   for app_type_sub_id in app_type_sub_ids for _ in range(processes_per_study)]
+        for future in futures:
+            future.result()
 
+    add_noise = config["coordinator_config"]["add_noise"]
+    for app_type_sub_id in app_type_sub_ids:
+        app_type, app_sub_type, _ = marl.get_run_types(config, app_type_id, app_type_sub_id, policy_id)
+        study = optuna.load_study(study_name=get_study_name(config, app_type_id, app_type_sub_id, policy_id),
+                                  storage=storage)
+        print(f"{app_type} {app_sub_type}: {study.best_params}")
+        # Update the parameters in the config
+        config = sweep.merge_config(config, get_overrides(study.best_params, app_type, app_sub_type, add_noise))
     with open(config_file_name, 'w') as f:
         f.write(format(config))
 
-    subprocess.run(
-        ['python3', '~/Documents/Project/MARL/src/multiprocessing_MARL.py', str(app_type_id), str(app_type_sub_id),
-         str(policy_id)], check=True)
-    result = subprocess.run(
-        ['python3', '~/Documents/Project/MARL/src/plot_images.py', str(app_type_id), str(app_type_sub_id),
-         str(policy_id)],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-    # Extract the average reward from the output
-    for line in result.stdout.decode().split('\n'):
-        avg_reward = float(line)
-        break
-    else:
-        raise RuntimeError('Average reward not found in output')
-
-    return avg_reward
-
-
-# Load the existing configuration file
-
-config_file_name = '~/Documents/Project/MARL/configs/config.json'
-with open(config_file_name, 'r') as f:
-    config = json.load(f)
-
-app_type_id = 3
-app_type_sub_ids = [0, 1, 2, 3, 4]
-policy_id = 0
-add_noise = config["coordinator_config"]["add_noise"]
-app_type = config["app_types"][app_type_id]
-for app_type_sub_id in app_type_sub_ids:
-    app_sub_type = config["app_sub_types"][app_type][app_type_sub_id]
-    policy_type = config["policy_types"][policy_id]
-    study = optuna.create_study(direction='maximize')
-    study.optimize(lambda trial: objective(trial, config_file_name, app_type_id, app_type_sub_id, policy_id),
-                   n_trials=50)
-    print(study.best_params)
-    # Get the best parameters
-    best_params = study.best_params
-    # Update the parameters in the config
-    if add_noise:
-        config["c_lr_noise"][app_type][app_sub_type] = best_params["c_lr_noise"]
-        config['a_lr_noise'][app_type][app_sub_type] = config["c_lr_noise"][app_type][app_sub_type] / best_params["b"]
-        config['sprinters_decay_factor_noise'][app_type][app_sub_type] = 1 - config["a_lr_noise"][app_type][
-            app_sub_type] * best_params["a"]
-        config["state_normalization_factor_noise"][app_type][app_sub_type] = best_params[
-            "state_normalization_factor_noise"]
-        config["std_max_noise"][app_type][app_sub_type] = best_params["std_max"]
-    else:
-        config["c_lr_no_noise"][app_type][app_sub_type] = best_params["c_lr_no_noise"]
-        config['a_lr_no_noise'][app_type][app_sub_type] = config["c_lr_no_noise"][app_type][app_sub_type] / best_params[
-            "b"]
-        config['sprinters_decay_factor_no_noise'][app_type][app_sub_type] = 1 - config["a_lr_no_noise"][app_type][
-            app_sub_type] * best_params["a"]
-        config["state_normalization_factor_no_noise"][app_type][app_sub_type] = best_params[
-            "state_normalization_factor_no_noise"]
-        config["std_max_no_noise"][app_type][app_sub_type] = best_params["std_max"]
-    config["ac_discount_factor"][app_type][app_sub_type] = best_params["ac_discount_factor"]
-    with open("configs/config.json", 'w') as f:
-        f.write(format(config))
+
+if __name__ == "__main__":
+    main("configs/config.json", 3, [0, 1, 2, 3, 4], 0, 50)
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class HistoryBuffer:
+    """
+    Preallocated, typed per-iteration record. Rows are written in place; the buffer only grows (doubling) if more
+    rows than the preallocated capacity are appended, so memory per server is predictable when the capacity is
+    sized from total_iterations * period. With stride > 1 only every stride-th appended row is kept.
+    """
+    def __init__(self, capacity, dtype=np.float32, row_shape=(), stride=1):
+        self.data = np.empty((capacity,) + tuple(row_shape), dtype=dtype)
+        self.size = 0
+        self.stride = stride
+        self.count = 0
+
+    def append(self, row):
+        self.count += 1
+        if (self.count - 1) % self.stride != 0:
+            return
+        if self.size == len(self.data):
+            self.grow()
+        self.data[self.size] = row
+        self.size += 1
+
+    def grow(self):
+        data = np.empty((max(1, 2 * len(self.data)),) + self.data.shape[1:], dtype=self.data.dtype)
+        data[:self.size] = self.data[:self.size]
+        self.data = data
+
+    # filled part of the buffer as a view, without copying
+    def to_array(self):
+        return self.data[:self.size]
+
+    # pickles (checkpoints) only carry the filled rows; the preallocated capacity is restored on load
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = self.to_array().copy()
+        state["capacity"] = len(self.data)
+        return state
+
+    def __setstate__(self, state):
+        filled = state.pop("data")
+        capacity = state.pop("capacity")
+        self.__dict__.update(state)
+        self.data = np.empty((max(capacity, len(filled)),) + filled.shape[1:], dtype=filled.dtype)
+        self.data[:self.size] = filled
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.to_array()[index]
+
+    def __iter__(self):
+        return iter(self.to_array())
+
+
+def get_sample_len(num_iterations, stride):
+    return -(-num_iterations // stride)
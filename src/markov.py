@@ -1,24 +1,14 @@
 import numpy as np
 import torch
 
-from src import applications, policies, multiprocessing_MARL, servers
+from src import applications, dp, policies, multiprocessing_MARL, servers
 
 multiprocessing_MARL.set_seed(42)
 
 
-def calculate_app_state_probs(server_state_len, trans):
-    p = np.ones(server_state_len) / server_state_len
-    difference = 1
-    while difference > 0.0001:
-        new_p = np.zeros(server_state_len)
-        for s2 in range(server_state_len):
-            for s1 in range(server_state_len):
-                new_p[s2] += p[s1] * trans[s1][s2]
-
-        difference = ((p - new_p) ** 2).sum()
-        p = new_p.copy()
-
-    return p
+# stationary distribution of the row stochastic trans[s1][s2] (power iteration stops at an L2 change of 0.01)
+def calculate_app_state_probs(server_state_len, trans, method="direct"):
+    return dp.get_stationary_distribution(np.asarray(trans).T, method, tolerance=0.01)
 
 
 def calculate_app_state_values(server_state_len, trans, dff):
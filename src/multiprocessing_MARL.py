@@ -1,17 +1,32 @@
 import sys
-from multiprocessing import Process, Queue
+from multiprocessing import Process
 import numpy as np
 import torch
+from scipy.signal import lfilter
 import time
 import os
 import json
 
 import applications
+import cache
+import checkpoint
+import history
 import policies
+import results
 import servers
+import streams
+import transports
 
 import argparse
 
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+BLAS_THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS",
+                         "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
 
 def set_seed(seed):
     torch.manual_seed(seed)
@@ -26,7 +41,8 @@ Coordinator: Communicates with workers and aggregates servers actions to determi
 
 
 class Coordinator:
-    def __init__(self, coordinator_config, w2c_queues, c2w_queues, num_workers, num_servers, sprinters_decay_factor, var):
+    def __init__(self, coordinator_config, transport, num_workers, num_servers, sprinters_decay_factor, var,
+                 results_format="text", checkpoint_interval=0, noise_seed=None):
 
         # Sprinters parameters
         self.frac_sprinters = 0  # Initialize num_sprinting
@@ -47,8 +63,7 @@ class Coordinator:
 
         # Worker and server parameters
         self.num_workers = num_workers
-        self.w2c_queues = w2c_queues
-        self.c2w_queues = c2w_queues
+        self.transport = transport
         self.num_servers = num_servers
         self.costs = np.zeros(self.num_servers)
 
@@ -73,8 +88,62 @@ class Coordinator:
             self.var = var
             self.sigma = np.sqrt(self.var)
         self.add_noise = coordinator_config["add_noise"]
+        # the noise has its own generator: drawn from the global one, it would be interleaved with the draws of
+        # workers in the same process differently per sync mode and transport. Without a seed, the seed is drawn
+        # from the global generator, so that set_seed still makes runs reproducible
+        if noise_seed is None:
+            noise_seed = np.random.randint(2 ** 31)
+        self.noise_rng = np.random.default_rng(noise_seed)
         self.count_sprint_epoch = np.zeros(self.num_servers)
 
+        # "iteration": one round trip with the workers per iteration,
+        # "period": workers run a whole period on their own and reply with a period x servers action block
+        self.sync_mode = coordinator_config["sync_mode"]
+
+        # "ordered": wait for the workers one after the other,
+        # "as_completed": take replies in arrival order and record per-worker latencies; a worker that has not
+        # replied straggler_timeout seconds after the broadcast is covered by its last actions if they are at most
+        # max_staleness sync rounds (broadcasts) old, whatever the sync_mode (straggler_timeout 0: always wait)
+        self.gather_mode = coordinator_config["gather_mode"]
+        self.straggler_timeout = coordinator_config["straggler_timeout"]
+        self.max_staleness = coordinator_config["max_staleness"]
+        # time and sync round of the broadcasts that replies can still come for, in period mode iterations advance
+        # by period per round; only the rounds since the oldest last reply of a worker are kept
+        self.broadcast_times = {}
+        self.broadcast_rounds = {}
+        self.num_broadcasts = 0
+        self.last_broadcast_iteration = -1
+        self.worker_latencies = [history.HistoryBuffer(0, np.float64) for _ in range(self.num_workers)]
+        self.worker_stale_rounds = np.zeros(self.num_workers, dtype=np.int64)
+        self.worker_last_actions = [None] * self.num_workers
+        self.worker_last_iterations = -np.ones(self.num_workers, dtype=np.int64)
+
+        self.results_format = results_format
+
+        # checkpoint every checkpoint_interval iterations (a multiple of the period), 0: never
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_writer = None
+        # RNG states to restore when resuming from a checkpoint
+        self.rng_states = None
+        # called with the number of completed periods at every period boundary (see sweep.simulate)
+        self.period_callback = None
+
+    # checkpoints hold the simulation state only, the transport is rebuilt on resume
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["transport"] = None
+        state["checkpoint_writer"] = None
+        state["period_callback"] = None
+        return state
+
+    def save_checkpoint(self):
+        if self.checkpoint_interval > 0 and self.current_iteration % self.checkpoint_interval == 0:
+            self.checkpoint_writer.save(self.current_iteration, self)
+
+    def report_period(self):
+        if self.period_callback is not None:
+            self.period_callback(self.current_iteration // self.period)
+
     #   Whether system trips or not
     def calculate_costs(self):
         self.costs = self.calculate_local_costs() + self.calculate_global_costs()
@@ -94,7 +163,7 @@ class Coordinator:
         self.count_sprint_epoch[np.where(actions == 0)] += 1
         self.frac_sprinters = (self.num_servers - actions.sum()) / self.num_servers
         if self.add_noise == 1:
-            self.frac_sprinters += np.random.normal(loc=0, scale=self.sigma)
+            self.frac_sprinters += self.noise_rng.normal(loc=0, scale=self.sigma)
 
         self.current_iteration += 1
         self.avg_frac_sprinters *= self.sprinters_decay_factor
@@ -102,26 +171,159 @@ class Coordinator:
         self.avg_frac_sprinters_corrected = self.avg_frac_sprinters / (
                 1 - self.sprinters_decay_factor ** self.current_iteration)
 
+    # Same as aggregate_actions for every row of a block of consecutive iterations, in one vectorized pass
+    def aggregate_action_block(self, actions_block):
+        block_len = len(actions_block)
+        self.count_sprint_epoch += (actions_block == 0).sum(axis=0)
+        frac_sprinters = (self.num_servers - actions_block.sum(axis=1)) / self.num_servers
+        if self.add_noise == 1:
+            frac_sprinters += self.noise_rng.normal(loc=0, scale=self.sigma, size=block_len)
+
+        # avg <- decay * avg + (1 - decay) * frac, as a first order linear filter started from the current average
+        decay = self.sprinters_decay_factor
+        avg_frac_sprinters, _ = lfilter([1 - decay], [1, -decay], frac_sprinters, zi=[decay * self.avg_frac_sprinters])
+        bias_corrections = np.array([1 - decay ** (self.current_iteration + t) for t in range(1, block_len + 1)])
+
+        self.frac_sprinters = frac_sprinters[-1]
+        self.current_iteration += block_len
+        self.avg_frac_sprinters = avg_frac_sprinters[-1]
+        avg_frac_sprinters_corrected = avg_frac_sprinters / bias_corrections
+        self.avg_frac_sprinters_corrected = avg_frac_sprinters_corrected[-1]
+        self.avg_frac_sprinters_list.extend(avg_frac_sprinters_corrected.tolist())
+
     # Main function for coordinator
     def run_coordinator(self, path):
-        actions_array = np.zeros(self.num_servers)
-        server_ids = np.arange(0, self.num_servers)
-        workers_server_ids = np.array_split(server_ids, self.num_workers)
+        if self.rng_states is not None:
+            checkpoint.set_rng_states(self.rng_states)
+            self.rng_states = None
+        if self.checkpoint_interval > 0:
+            self.checkpoint_writer = checkpoint.CheckpointWriter(path, "coordinator", self.num_workers)
+
+        self.simulate()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+
+        if self.results_format == "binary":
+            self.write_frac_sprinters(path)
+        else:
+            self.print_frac_sprinters(path)
+        if self.gather_mode == "as_completed":
+            self.print_worker_latencies(path)
+
+    # run the remaining iterations, results stay in memory
+    def simulate(self):
+        if self.sync_mode == "period":
+            self.run_periods()
+        else:
+            self.run_iterations()
+
+    def broadcast(self):
+        if self.gather_mode == "as_completed":
+            self.broadcast_times[self.current_iteration] = time.perf_counter()
+            self.broadcast_rounds[self.current_iteration] = self.num_broadcasts
+            self.num_broadcasts += 1
+            self.last_broadcast_iteration = self.current_iteration
+        self.transport.broadcast(self.fr, self.cst, self.current_iteration)
+
+    def gather(self, actions_array):
+        if self.gather_mode == "as_completed":
+            self.gather_as_completed(actions_array)
+        else:
+            self.transport.gather(actions_array)
+
+    def receive_reply(self, timeout):
+        reply = self.transport.receive_reply(timeout)
+        if reply is not None:
+            worker_id, iteration, actions = reply
+            self.worker_latencies[worker_id].append(time.perf_counter() - self.broadcast_times[iteration])
+            self.worker_last_actions[worker_id] = actions
+            self.worker_last_iterations[worker_id] = iteration
+        return reply
+
+    def gather_as_completed(self, actions_array):
+        iteration = self.current_iteration
+        pending = set(range(self.num_workers))
+        timed_out = self.straggler_timeout <= 0
+        deadline = self.broadcast_times[iteration] + self.straggler_timeout
+
+        while pending:
+            if timed_out:
+                reply = self.receive_reply(None)
+            else:
+                reply = self.receive_reply(max(deadline - time.perf_counter(), 0))
+                timed_out = reply is None
+            # a late worker keeps running through its backlog, every reply brings its last actions closer
+            for worker_id in list(pending):
+                last_iteration = self.worker_last_iterations[worker_id]
+                if last_iteration == iteration:
+                    pending.discard(worker_id)
+                elif (timed_out and last_iteration >= 0 and
+                      self.broadcast_rounds[iteration] - self.broadcast_rounds[last_iteration] <= self.max_staleness):
+                    pending.discard(worker_id)
+                    self.worker_stale_rounds[worker_id] += 1
+
+        for worker_id, ids in enumerate(self.transport.workers_server_ids):
+            actions_array[..., ids] = self.worker_last_actions[worker_id]
+
+        # every worker replies in order, so no reply is left for the broadcasts before its last reply; a worker more
+        # than max_staleness rounds behind is waited for, which bounds the rounds kept
+        oldest_iteration = self.worker_last_iterations.min()
+        for old_iteration in [i for i in self.broadcast_times if i < oldest_iteration]:
+            del self.broadcast_times[old_iteration]
+            del self.broadcast_rounds[old_iteration]
+
+    # wait for the replies of late workers before stopping them, so that nothing is left in flight
+    def drain_replies(self):
+        if self.gather_mode != "as_completed" or self.last_broadcast_iteration < 0:
+            return
+        while np.any(self.worker_last_iterations < self.last_broadcast_iteration):
+            self.receive_reply(None)
+
+    def stop(self):
+        self.drain_replies()
+        self.transport.stop()
+
+    # Latency percentiles (seconds from broadcast to reply) and number of rounds covered by stale actions
+    def print_worker_latencies(self, path):
+        file_path = os.path.join(path, "worker_latency.txt")
+        with open(file_path, 'w+') as file:
+            file.write("worker p50 p90 p99 max stale_rounds\n")
+            for worker_id in range(self.num_workers):
+                p50, p90, p99, p100 = np.percentile(self.worker_latencies[worker_id].to_array(), [50, 90, 99, 100])
+                line = f"{worker_id} {p50} {p90} {p99} {p100} {self.worker_stale_rounds[worker_id]}"
+                file.write(line + "\n")
+                print(f"Worker {line}")
+
+    # fr and cst only change at period boundaries, so a period of lock-step iterations can be run by the workers
+    # on their own and aggregated afterwards with the same result
+    def run_periods(self):
+        actions_block = np.zeros((self.period, self.num_servers))
 
         while self.current_iteration < self.total_iterations:
-            # Split the array into self.num_workers parts
-            # workers_costs = np.array_split(self.costs, self.num_workers)
-            workers_costs = np.array_split(self.cst, self.num_workers)
+            self.broadcast()
+            self.gather(actions_block)
 
-            # Now, iterate over the queues and reshaped states
-            for q, costs in zip(self.c2w_queues, workers_costs):
-                # q.put((self.avg_frac_sprinters_corrected, costs, self.current_iteration))
-                q.put((self.fr, costs, self.current_iteration))
+            self.aggregate_action_block(actions_block)
+            self.calculate_costs()
+
+            self.fr = self.avg_frac_sprinters_corrected
+            self.cst = self.costs
+            self.count_sprint_epoch = np.zeros(self.num_servers)
+            self.save_checkpoint()
+            self.report_period()
+
+        self.stop()
+
+    def run_iterations(self):
+        actions_array = np.zeros(self.num_servers)
+
+        while self.current_iteration < self.total_iterations:
+            # send every worker its part of the costs
+            # self.transport.broadcast(self.avg_frac_sprinters_corrected, self.costs, self.current_iteration)
+            self.broadcast()
 
             # get information from workers
-            for q, ids in zip(self.w2c_queues, workers_server_ids):
-                actions = q.get()
-                actions_array[ids] = actions
+            self.gather(actions_array)
 
             self.aggregate_actions(actions_array)
             self.calculate_costs()
@@ -133,12 +335,16 @@ class Coordinator:
                 self.cst = self.costs
                 self.itr = 0
                 self.count_sprint_epoch = np.zeros(self.num_servers)
+                self.save_checkpoint()
+                self.report_period()
 
         # Send stop to all
-        for q in self.c2w_queues:
-            q.put('stop')
+        self.stop()
 
-        self.print_frac_sprinters(path)
+    def write_frac_sprinters(self, path):
+        store = results.ResultsStore(os.path.join(path, results.RESULTS_FILE_NAME), 'r+')
+        store["frac_sprinters"][:] = self.avg_frac_sprinters_list
+        store.flush()
 
     # Record fractional number of sprinters in each iteration
     def print_frac_sprinters(self, path):
@@ -155,176 +361,561 @@ Workers: Manages several servers
 
 
 class Worker:
-    def __init__(self, servers_list, w2c_queue, c2w_queue):
-        self.num_servers = len(servers_list)
+    def __init__(self, servers_list, endpoint, fleet=None, results_format="text", worker_id=0, sample_stride=0,
+                 block_len=1, checkpoint_interval=0):
+        # a fleet (servers.ServerFleet) replaces the list of server objects with one batched step
+        self.fleet = fleet
+        self.results_format = results_format
+        self.worker_id = worker_id
+        # sampled recording mode: running sum of this worker's rewards every sample_stride iterations
+        self.sample_stride = sample_stride
+        self.reward_sums = history.HistoryBuffer(0, np.float64)
+        self.num_servers = len(servers_list) if fleet is None else fleet.num_servers
         self.servers_list = servers_list
-        self.w2c_queue = w2c_queue
-        self.c2w_queue = c2w_queue
+        # worker side of the transport (see transports.py)
+        self.endpoint = endpoint
+        # number of consecutive iterations run per message from the coordinator (period in period sync mode)
+        self.block_len = block_len
+        # same checkpoint boundaries as the coordinator
+        self.checkpoint_interval = checkpoint_interval
+        self.next_iteration = 0
+        self.rng_states = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["endpoint"] = None
+        return state
 
     def run_worker(self, path):
+        if self.rng_states is not None:
+            checkpoint.set_rng_states(self.rng_states)
+            self.rng_states = None
+        checkpoint_writer = None
+        if self.checkpoint_interval > 0:
+            checkpoint_writer = checkpoint.CheckpointWriter(path, f"worker_{self.worker_id}")
+        start_iteration = self.next_iteration
+
         while True:
-            actions = np.ones(self.num_servers)
+            # state after next_iteration - 1 iterations, taken before running the iterations of the next message
+            if checkpoint_writer is not None and self.next_iteration > start_iteration and \
+                    self.next_iteration % self.checkpoint_interval == 0:
+                checkpoint_writer.save(self.next_iteration, self)
             # Get info from coordinator
-            info = self.c2w_queue.get()
-            if info == 'stop':
-                for server in self.servers_list:
-                    server.print_rewards_and_app_states(path)
+            info = self.endpoint.receive()
+            if info is None:
+                if checkpoint_writer is not None:
+                    checkpoint_writer.wait()
+                if self.results_format == "binary":
+                    self.write_results(path)
+                else:
+                    self.print_results(path)
                 break
 
             frac_sprinters, costs, iteration = info
-            for i, server in enumerate(self.servers_list):
-                action = server.run_server(costs[i], frac_sprinters, iteration)
-                actions[i] = action
+            actions = self.run_block(frac_sprinters, costs, iteration)
             # Send infor to coordinator
-            self.w2c_queue.put(actions)
+            self.endpoint.send(actions)
 
+    # run the block_len iterations of one message from the coordinator
+    def run_block(self, frac_sprinters, costs, iteration):
+        if self.block_len == 1:
+            actions = self.step(frac_sprinters, costs, iteration)
+        else:
+            actions = np.array([self.step(frac_sprinters, costs, iteration + t) for t in range(self.block_len)])
+        self.next_iteration = iteration + self.block_len
+        return actions
+
+    # run one iteration of all servers of this worker and return their actions
+    def step(self, frac_sprinters, costs, iteration):
+        actions = np.ones(self.num_servers)
+        if self.fleet is not None:
+            actions = self.fleet.run_servers(costs, frac_sprinters, iteration)
+        for i, server in enumerate(self.servers_list):
+            action = server.run_server(costs[i], frac_sprinters, iteration)
+            actions[i] = action
+        if self.sample_stride > 0 and iteration % self.sample_stride == 0:
+            self.reward_sums.append(self.get_latest_reward_sum())
+        return actions
+
+    # sum of the rewards recorded by all servers of this worker in the latest sampled iteration
+    def get_latest_reward_sum(self):
+        reward_sum = 0
+        if self.fleet is not None:
+            reward_sum += self.fleet.reward_history[-1].sum(dtype=np.float64)
+        for server in self.servers_list:
+            reward_sum += float(server.reward_history[-1])
+        return reward_sum
+
+    # mean reward over the servers of this worker every sample_size iterations, as plot_images reads it from the
+    # results files; in sampled mode the samples are the recorded reward sums. num_samples: only the latest ones
+    def get_mean_rewards(self, sample_size, num_samples=None):
+        if self.sample_stride > 0:
+            reward_sums = self.reward_sums.to_array()
+            if num_samples is not None:
+                reward_sums = reward_sums[max(len(reward_sums) - num_samples, 0):]
+            return reward_sums / self.num_servers
+        start = 0
+        if num_samples is not None:
+            num_iterations = self.next_iteration
+            start = max(history.get_sample_len(num_iterations, sample_size) - num_samples, 0) * sample_size
+        rewards = []
+        if self.fleet is not None:
+            rewards.append(self.fleet.reward_history.to_array()[start::sample_size].astype(float))
+        for server in self.servers_list:
+            rewards.append(server.reward_history.to_array()[start::sample_size, None].astype(float))
+        return np.concatenate(rewards, axis=1).mean(axis=1)
+
+    def print_results(self, path):
+        if self.fleet is not None:
+            self.fleet.print_rewards_and_app_states(path)
+        for server in self.servers_list:
+            server.print_rewards_and_app_states(path)
+
+    # write this worker's rows of the binary results store created by main()
+    def write_results(self, path):
+        store = results.ResultsStore(os.path.join(path, results.RESULTS_FILE_NAME), 'r+')
+        if self.fleet is not None:
+            self.fleet.write_results(store)
+        for server in self.servers_list:
+            server.write_results(store)
+        if self.sample_stride > 0:
+            store["worker_reward_sums"][self.worker_id] = self.reward_sums.to_array()
+        store.flush()
+
+
+def load_spark_gains(app_sub_type):
+    gain_names = {"s1": "als_gain", "s2": "kmeans_gain", "s3": "lr_gain", "s4": "pr_gain", "s5": "svm_gain"}
+    if app_sub_type not in gain_names:
+        sys.exit("Invalid sub type!")
+    with open("data/gain.txt") as file:
+        for line in file:
+            if gain_names[app_sub_type] in line.strip():
+                gains = line.strip().split(":")[1].split("\t")
+                break
+    return np.array(gains).astype(float)
 
-def main(config_file_name, app_type_id, app_sub_type_id, policy_id, threshold_in):
-    start_time = time.time()
-    with open(config_file_name, 'r') as f:
-        config = json.load(f)
-    folder_name = config["folder_name"]
-    coordinator_config = config["coordinator_config"]
+
+# seed of the coordinator noise: the run seed, else rng_seed in rng_mode "server", else drawn by the Coordinator
+def get_noise_seed(config, seed):
+    if seed is not None:
+        return seed
+    if config["rng_mode"] == "server":
+        return config["rng_seed"]
+    return None
+
+
+# "process": servers draw from the global generators of their worker process, so results depend on the worker layout,
+# "server": every server draws from its own streams.ServerStreams, keyed by rng_seed and its server id
+def get_server_streams(config, server_ids):
+    if config["rng_mode"] == "server":
+        return streams.ServerStreams(config["rng_seed"], server_ids)
+    return None
+
+
+# random initial state index of every app
+def get_initial_indices(state_space_len, num_apps, server_streams):
+    if server_streams is None:
+        return np.random.choice(state_space_len, size=num_apps)
+    return server_streams.randint(state_space_len, streams.APP_INITIAL)
+
+
+def create_app_fleet(config, app_type, app_sub_type, num_apps, server_streams=None):
+    app_utilities = config["app_utilities"]
+    if app_type == "markov":
+        transition_matrix = config["markov_app_transition_matrices"][app_sub_type]
+        initial_indices = get_initial_indices(len(app_utilities), num_apps, server_streams)
+        return applications.MarkovAppFleet(transition_matrix, app_utilities, initial_indices, server_streams)
+    elif app_type == "uniform":
+        return applications.UniformAppFleet(app_utilities, num_apps, server_streams)
+    elif app_type == "queue":
+        if config["servers_config"]["change"] == 1:
+            arrival_tps = config["queue_app_arrival_tps_change"][app_sub_type]
+        else:
+            arrival_tps = config["queue_app_arrival_tps"][app_sub_type]
+        sprinting_tps = config["queue_app_sprinting_tps"][app_sub_type]
+        nominal_tps = config["queue_app_nominal_tps"][app_sub_type]
+        max_queue_length = config["queue_app_max_queue_length"][app_sub_type]
+        return applications.QueueAppFleet(arrival_tps, sprinting_tps, nominal_tps, num_apps, max_queue_length,
+                                          server_streams)
+    elif app_type == "spark":
+        gains = load_spark_gains(app_sub_type)
+        initial_indices = get_initial_indices(gains.size, num_apps, server_streams)
+        return applications.SparkAppFleet(gains, initial_indices, server_streams)
+    else:
+        sys.exit("wrong app type!")
+
+
+def get_threshold(config, policy_type, app_type, app_sub_type, threshold_in):
+    if threshold_in != -1:
+        return threshold_in
+    if policy_type == "thr_policy":
+        return config["threshold"][app_type][app_sub_type]
+    table = "dp_threshold_change" if config["servers_config"]["change"] == 1 else "dp_threshold"
+    dp_thresholds = load_dp_thresholds(config["dp_results_file"])
+    if app_sub_type in dp_thresholds.get(table, {}).get(app_type, {}):
+        return dp_thresholds[table][app_type][app_sub_type]
+    return config[table][app_type][app_sub_type]
+
+
+dp_results = {}
+
+
+# threshold tables written by dp.solve_all, empty if there is no such file; read once per file version since every
+# server of a dp_policy run looks up its threshold. A policy that never sprints is stored as null, its threshold is inf
+def load_dp_thresholds(file_name):
+    if not file_name or not os.path.exists(file_name):
+        return {}
+    version = os.stat(file_name).st_mtime_ns
+    if file_name not in dp_results or dp_results[file_name][0] != version:
+        with open(file_name, 'r') as f:
+            results_file = json.load(f)
+        tables = {}
+        for table in ["dp_threshold", "dp_threshold_change"]:
+            tables[table] = {}
+            for app_type, thresholds in results_file[table].items():
+                tables[table][app_type] = {app_sub_type: float("inf") if threshold is None else threshold
+                                           for app_sub_type, threshold in thresholds.items()}
+        dp_results[file_name] = (version, tables)
+    return dp_results[file_name][1]
+
+
+def get_ac_hyperparameters(config, app_type, app_sub_type):
+    if config["coordinator_config"]["add_noise"]:
+        a_lr = config["a_lr_noise"][app_type][app_sub_type]
+        c_lr = config["c_lr_noise"][app_type][app_sub_type]
+        state_normalization_factor = config["state_normalization_factor_noise"][app_type][app_sub_type]
+        std_max = config["std_max_noise"][app_type][app_sub_type]
+    else:
+        a_lr = config["a_lr_no_noise"][app_type][app_sub_type]
+        c_lr = config["c_lr_no_noise"][app_type][app_sub_type]
+        state_normalization_factor = config["state_normalization_factor_no_noise"][app_type][app_sub_type]
+        std_max = config["std_max_no_noise"][app_type][app_sub_type]
+    a_h1_size = config["ac_policy_config"]["a_h1_size"]
+    c_h1_size = config["ac_policy_config"]["c_h1_size"]
+    df = config["ac_discount_factor"][app_type][app_sub_type]
+    mini_batch_size = config["ac_policy_config"]["mini_batch_size"]
+    return a_lr, c_lr, state_normalization_factor, std_max, a_h1_size, c_h1_size, df, mini_batch_size
+
+
+# history length and stride of per-server records: every iteration, or every sample_stride-th in sampled mode
+def get_history_len_and_stride(config):
+    period = config["coordinator_config"]["period"]
+    num_iterations = config["coordinator_config"]["total_iterations"] * period
+    if config["recording_mode"] == "sampled":
+        stride = get_sample_stride(config)
+        return history.get_sample_len(num_iterations, stride), stride
+    return num_iterations, 1
+
+
+# default stride matches the sample size used by plot_images
+def get_sample_stride(config):
+    if config["sample_stride"] > 0:
+        return config["sample_stride"]
+    return int(config["coordinator_config"]["period"] / 3)
+
+
+def get_available_cpus():
+    return sorted(os.sched_getaffinity(0))
+
+
+# num_workers 0 picks as many workers as fit in the available cores, keeping one core for the coordinator
+def get_num_workers(config):
+    if config["num_workers"] > 0:
+        return config["num_workers"]
+    threads_per_worker = max(config["threads_per_worker"], 1)
+    num_workers = (len(get_available_cpus()) - 1) // threads_per_worker
+    return int(np.clip(num_workers, 1, config["num_servers"]))
+
+
+# cpus of the coordinator and of each worker: the coordinator takes the first available core and the workers
+# get consecutive blocks of threads_per_worker cores after it (wrapping around if there are not enough cores)
+def get_cpu_assignment(num_workers, threads_per_worker):
+    cpus = get_available_cpus()
+    threads_per_worker = max(threads_per_worker, 1)
+    worker_cpus = []
+    for i in range(num_workers):
+        start = 1 + i * threads_per_worker
+        worker_cpus.append([cpus[(start + j) % len(cpus)] for j in range(threads_per_worker)])
+    return [cpus[0]], worker_cpus
+
+
+# Limit the torch and BLAS thread pools of the calling process and optionally pin it to cpus
+def set_process_resources(num_threads, cpus=None):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if num_threads <= 0:
+        return
+    torch.set_num_threads(num_threads)
+    if threadpool_limits is not None:
+        threadpool_limits(num_threads)
+    else:
+        # pools that are already running keep their size, but anything initialized from now on is limited
+        for variable in BLAS_THREAD_VARIABLES:
+            os.environ[variable] = str(num_threads)
+
+
+def run_with_resources(target, num_threads, cpus, *args):
+    set_process_resources(num_threads, cpus)
+    target(*args)
+
+
+def create_server(config, app_type, app_sub_type, policy_type, threshold_in, server_id):
     servers_config = config["servers_config"]
-    num_workers = config["num_workers"]
-    num_servers = config["num_servers"]
-    app_type = config["app_types"][app_type_id]
-    assert app_sub_type_id < len(config["app_sub_types"][app_type])
-    app_sub_type = config["app_sub_types"][app_type][app_sub_type_id]
-    policy_type = config["policy_types"][policy_id]
     app_utilities = config["app_utilities"]
-    add_noise = coordinator_config["add_noise"]
     add_change = servers_config["change"]
-    period = coordinator_config["period"]
+    period = config["coordinator_config"]["period"]
     utility_normalization_factor = config["utility_normalization_factor"][app_type][app_sub_type]
-    var = coordinator_config["var"]
-    if add_noise:
-        sprinters_decay_factor = config["sprinters_decay_factor_noise"][app_type][app_sub_type]
+    history_len, history_stride = get_history_len_and_stride(config)
+    server_streams = get_server_streams(config, server_id)
+
+    if app_type == "markov":
+        transition_matrix = config["markov_app_transition_matrices"][app_sub_type]
+        if server_streams is None:
+            initial_state = np.random.choice(app_utilities)
+        else:
+            initial_state = app_utilities[server_streams.randint(len(app_utilities), streams.APP_INITIAL)]
+        app = applications.MarkovApp(transition_matrix, app_utilities, initial_state, server_streams)
+    elif app_type == "uniform":
+        app = applications.UniformApp(app_utilities, server_streams)
+    elif app_type == "queue":
+        if add_change == 1:
+            arrival_tps = config["queue_app_arrival_tps_change"][app_sub_type]
+        else:
+            arrival_tps = config["queue_app_arrival_tps"][app_sub_type]
+        sprinting_tps = config["queue_app_sprinting_tps"][app_sub_type]
+        nominal_tps = config["queue_app_nominal_tps"][app_sub_type]
+        max_queue_length = config["queue_app_max_queue_length"][app_sub_type]
+        app = applications.QueueApp(arrival_tps, sprinting_tps, nominal_tps, max_queue_length, server_streams)
+    elif app_type == "spark":
+        gains = load_spark_gains(app_sub_type)
+        if server_streams is None:
+            initial_index = np.random.choice(np.arange(np.array(gains).size))
+        else:
+            initial_index = int(server_streams.randint(np.array(gains).size, streams.APP_INITIAL))
+        app = applications.SparkApp(gains, initial_index, server_streams)
+    else:
+        sys.exit("wrong app type!")
+
+    if policy_type == "ac_policy":
+        (a_lr, c_lr, state_normalization_factor, std_max, a_h1_size, c_h1_size, df,
+         mini_batch_size) = get_ac_hyperparameters(config, app_type, app_sub_type)
+        policy = policies.ACPolicy(1, 3, a_h1_size, c_h1_size, a_lr, c_lr, df, std_max, mini_batch_size,
+                                   server_streams)
+        server = servers.ACServer(server_id, period, policy, app, servers_config,
+                                  state_normalization_factor, utility_normalization_factor, history_len,
+                                  history_stride, server_streams)
+    elif policy_type == "thr_policy" or policy_type == "dp_policy":
+        threshold = get_threshold(config, policy_type, app_type, app_sub_type, threshold_in)
+        policy = policies.ThrPolicy(threshold)
+        server = servers.ThrServer(server_id, period, policy, app, servers_config, utility_normalization_factor,
+                                   history_len, history_stride, server_streams)
+    elif policy_type == "ql_policy":
+        dim = (2, app.get_state_space_len())
+        epsilon = config["ql_policy_config"]["epsilon"]
+        learning_rate = config["ql_lr"][app_type][app_sub_type]
+        discount_factor = config["ql_policy_config"]["discount_factor"]
+        policy = policies.QLPolicy(dim, discount_factor, learning_rate, epsilon, server_streams)
+        server = servers.QLServer(server_id, period, policy, app, servers_config, utility_normalization_factor,
+                                  history_len, history_stride, server_streams)
     else:
-        sprinters_decay_factor = config["sprinters_decay_factor_no_noise"][app_type][app_sub_type]
+        sys.exit("Wrong policy type!")
+
+    return server
+
+
+def create_server_fleet(config, app_type, app_sub_type, policy_type, threshold_in, server_ids):
+    servers_config = config["servers_config"]
+    period = config["coordinator_config"]["period"]
+    utility_normalization_factor = config["utility_normalization_factor"][app_type][app_sub_type]
+    history_len, history_stride = get_history_len_and_stride(config)
+    server_streams = get_server_streams(config, np.array(server_ids))
+
+    app_fleet = create_app_fleet(config, app_type, app_sub_type, len(server_ids), server_streams)
+    if policy_type == "ac_policy":
+        (a_lr, c_lr, state_normalization_factor, std_max, a_h1_size, c_h1_size, df,
+         mini_batch_size) = get_ac_hyperparameters(config, app_type, app_sub_type)
+        policy = policies.ACEnsemblePolicy(len(server_ids), 1, 3, a_h1_size, c_h1_size, a_lr, c_lr, df, std_max,
+                                           mini_batch_size, server_streams)
+        fleet = servers.ACServerFleet(server_ids, period, policy, app_fleet, servers_config,
+                                      state_normalization_factor, utility_normalization_factor, history_len,
+                                      history_stride, server_streams)
+    elif policy_type == "thr_policy" or policy_type == "dp_policy":
+        threshold = get_threshold(config, policy_type, app_type, app_sub_type, threshold_in)
+        policy = policies.ThrPolicy(threshold)
+        fleet = servers.ThrServerFleet(server_ids, period, policy, app_fleet, servers_config,
+                                       utility_normalization_factor, history_len, history_stride, server_streams)
+    elif policy_type == "ql_policy":
+        dim = (2, app_fleet.get_state_space_len())
+        epsilon = config["ql_policy_config"]["epsilon"]
+        learning_rate = config["ql_lr"][app_type][app_sub_type]
+        discount_factor = config["ql_policy_config"]["discount_factor"]
+        policy = policies.QLFleetPolicy(len(server_ids), dim, discount_factor, learning_rate, epsilon,
+                                        server_streams)
+        fleet = servers.QLServerFleet(server_ids, period, policy, app_fleet, servers_config,
+                                      utility_normalization_factor, history_len, history_stride, server_streams)
+    else:
+        sys.exit("Wrong policy type!")
+    return fleet
+
 
-    path = f"{folder_name}/{num_servers}_server/{policy_type}/{app_type}_{app_sub_type}"
+def get_results_path(config, policy_type, app_type, app_sub_type):
+    path = f"{config['folder_name']}/{config['num_servers']}_server/{policy_type}/{app_type}_{app_sub_type}"
     if not os.path.exists(path):
         os.makedirs(path)
+    return path
 
-    w2c_queues = [Queue() for _ in range(num_workers)]
-    c2w_queues = [Queue() for _ in range(num_workers)]
 
-    servers_list = []
-    worker_processors = []
+# number of iterations a worker runs per message from the coordinator
+def get_block_len(config):
+    if config["coordinator_config"]["sync_mode"] == "period":
+        return config["coordinator_config"]["period"]
+    return 1
 
-    coordinator = Coordinator(coordinator_config, w2c_queues, c2w_queues, num_workers, num_servers,
-                              sprinters_decay_factor, var)
-
-    for i in range(num_servers):
-        if app_type == "markov":
-            transition_matrix = config["markov_app_transition_matrices"][app_sub_type]
-            app = applications.MarkovApp(transition_matrix, app_utilities, np.random.choice(app_utilities))
-        elif app_type == "uniform":
-            app = applications.UniformApp(app_utilities)
-        elif app_type == "queue":
-            if add_change == 1:
-                arrival_tps = config["queue_app_arrival_tps_change"][app_sub_type]
-            else:
-                arrival_tps = config["queue_app_arrival_tps"][app_sub_type]
-            sprinting_tps = config["queue_app_sprinting_tps"][app_sub_type]
-            nominal_tps = config["queue_app_nominal_tps"][app_sub_type]
-            max_queue_length = config["queue_app_max_queue_length"][app_sub_type]
-            app = applications.QueueApp(arrival_tps, sprinting_tps, nominal_tps, max_queue_length)
-        elif app_type == "spark":
-            with open("data/gain.txt") as file:
-                if app_sub_type == "s1":
-                    for line in file:
-                        if "als_gain" in line.strip():
-                            gains = line.strip().split(":")[1].split("\t")
-                            break
-                elif app_sub_type == "s2":
-                    for line in file:
-                        if "kmeans_gain" in line.strip():
-                            gains = line.strip().split(":")[1].split("\t")
-                            break
-                elif app_sub_type == "s3":
-                    for line in file:
-                        if "lr_gain" in line.strip():
-                            gains = line.strip().split(":")[1].split("\t")
-                            break
-                elif app_sub_type == "s4":
-                    for line in file:
-                        if "pr_gain" in line.strip():
-                            gains = line.strip().split(":")[1].split("\t")
-                            break
-                elif app_sub_type == "s5":
-                    for line in file:
-                        if "svm_gain" in line.strip():
-                            gains = line.strip().split(":")[1].split("\t")
-                            break
-                else:
-                    sys.exit("Invalid sub type!")
 
-                gains = np.array(gains).astype(float)
-                app = applications.SparkApp(gains, np.random.choice(np.arange(np.array(gains).size)))
-        else:
-            sys.exit("wrong app type!")
-
-        if policy_type == "ac_policy":
-            if add_noise:
-                a_lr = config["a_lr_noise"][app_type][app_sub_type]
-                c_lr = config["c_lr_noise"][app_type][app_sub_type]
-                state_normalization_factor = config["state_normalization_factor_noise"][app_type][app_sub_type]
-                std_max = config["std_max_noise"][app_type][app_sub_type]
-            else:
-                a_lr = config["a_lr_no_noise"][app_type][app_sub_type]
-                c_lr = config["c_lr_no_noise"][app_type][app_sub_type]
-                state_normalization_factor = config["state_normalization_factor_no_noise"][app_type][app_sub_type]
-                std_max = config["std_max_no_noise"][app_type][app_sub_type]
-            a_h1_size = config["ac_policy_config"]["a_h1_size"]
-            c_h1_size = config["ac_policy_config"]["c_h1_size"]
-            df = config["ac_discount_factor"][app_type][app_sub_type]
-            mini_batch_size = config["ac_policy_config"]["mini_batch_size"]
-            policy = policies.ACPolicy(1, 3, a_h1_size, c_h1_size, a_lr, c_lr, df, std_max, mini_batch_size)
-            server = servers.ACServer(i, period, policy, app, servers_config,
-                                      state_normalization_factor, utility_normalization_factor)
-        elif policy_type == "thr_policy":
-            threshold = threshold_in
-            if threshold == -1:
-                threshold = config["threshold"][app_type][app_sub_type]
-            policy = policies.ThrPolicy(threshold)
-            server = servers.ThrServer(i, period, policy, app, servers_config, utility_normalization_factor)
-        elif policy_type == "dp_policy":
-            threshold = threshold_in
-            if threshold == -1:
-                if add_change == 1:
-                    threshold = config["dp_threshold_change"][app_type][app_sub_type]
-                else:
-                    threshold = config["dp_threshold"][app_type][app_sub_type]
-            policy = policies.ThrPolicy(threshold)
-            server = servers.ThrServer(i, period, policy, app, servers_config, utility_normalization_factor)
-        elif policy_type == "ql_policy":
-            dim = (2, app.get_state_space_len())
-            epsilon = config["ql_policy_config"]["epsilon"]
-            learning_rate = config["ql_lr"][app_type][app_sub_type]
-            discount_factor = config["ql_policy_config"]["discount_factor"]
-            policy = policies.QLPolicy(dim, discount_factor, learning_rate, epsilon)
-            server = servers.QLServer(i, period, policy, app, servers_config, utility_normalization_factor)
-        else:
-            sys.exit("Wrong policy type!")
+def get_checkpoint_interval(config):
+    return config["checkpoint_interval"] * config["coordinator_config"]["period"]
+
+
+def create_worker(config, app_type, app_sub_type, policy_type, threshold_in, server_ids, endpoint, worker_id):
+    results_format = config["results_format"]
+    sample_stride = get_sample_stride(config) if config["recording_mode"] == "sampled" else 0
+    block_len = get_block_len(config)
+    checkpoint_interval = get_checkpoint_interval(config)
+    if config["fleet_engine"] == 1:
+        fleet = create_server_fleet(config, app_type, app_sub_type, policy_type, threshold_in, server_ids)
+        return Worker([], endpoint, fleet=fleet, results_format=results_format, worker_id=worker_id,
+                      sample_stride=sample_stride, block_len=block_len, checkpoint_interval=checkpoint_interval)
+    servers_list = [create_server(config, app_type, app_sub_type, policy_type, threshold_in, server_id)
+                    for server_id in server_ids]
+    return Worker(servers_list, endpoint, results_format=results_format, worker_id=worker_id,
+                  sample_stride=sample_stride, block_len=block_len, checkpoint_interval=checkpoint_interval)
+
+
+# worker as of the checkpoint taken after iteration - 1
+def load_worker(path, iteration, endpoint, worker_id):
+    worker, rng_states = checkpoint.load_checkpoint(path, iteration, f"worker_{worker_id}")
+    worker.endpoint = endpoint
+    worker.rng_states = rng_states
+    return worker
+
 
-        servers_list.append(server)
+# total_iterations is taken from the config, so a finished run can be extended
+def load_coordinator(path, iteration, transport, coordinator_config):
+    coordinator, rng_states = checkpoint.load_checkpoint(path, iteration, "coordinator")
+    coordinator.transport = transport
+    coordinator.rng_states = rng_states
+    coordinator.total_iterations_dp = coordinator_config["total_iterations"]
+    coordinator.total_iterations = coordinator.total_iterations_dp * coordinator.period
+    return coordinator
+
+
+def get_run_types(config, app_type_id, app_sub_type_id, policy_id):
+    app_type = config["app_types"][app_type_id]
+    assert app_sub_type_id < len(config["app_sub_types"][app_type])
+    app_sub_type = config["app_sub_types"][app_type][app_sub_type_id]
+    policy_type = config["policy_types"][policy_id]
+    return app_type, app_sub_type, policy_type
+
+
+def get_sprinters_decay_factor(config, app_type, app_sub_type):
+    if config["coordinator_config"]["add_noise"]:
+        return config["sprinters_decay_factor_noise"][app_type][app_sub_type]
+    return config["sprinters_decay_factor_no_noise"][app_type][app_sub_type]
+
+
+# key of the cached results store of a run, or None if the run cannot be reproduced: only seeded runs with the binary
+# results store are cached, and not if stragglers can be covered by stale actions
+def get_run_cache_key(config, app_type, app_sub_type, policy_type, threshold_in, seed):
+    if seed is None or config["results_format"] != "binary" or config["coordinator_config"]["straggler_timeout"] > 0:
+        return None
+    return cache.get_simulation_key("main", config, app_type, app_sub_type, policy_type, threshold_in, seed)
+
+
+# resume: continue from the latest complete checkpoint in the results folder of this run
+# seed: seed the generators first; the results store of a seeded run is cached (see cache.py)
+def main(config_file_name, app_type_id, app_sub_type_id, policy_id, threshold_in, resume=False, seed=None):
+    start_time = time.time()
+    with open(config_file_name, 'r') as f:
+        config = json.load(f)
+    if seed is not None:
+        set_seed(seed)
+    coordinator_config = config["coordinator_config"]
+    num_workers = get_num_workers(config)
+    num_servers = config["num_servers"]
+    threads_per_worker = config["threads_per_worker"]
+    app_type, app_sub_type, policy_type = get_run_types(config, app_type_id, app_sub_type_id, policy_id)
+    var = coordinator_config["var"]
+    results_format = config["results_format"]
+    recording_mode = config["recording_mode"]
+    sample_stride = get_sample_stride(config) if recording_mode == "sampled" else 0
+    # sampled series can only be stored in the binary results store
+    assert recording_mode == "full" or results_format == "binary"
+    # replies in arrival order need tagged replies, the shared memory transport has none
+    assert coordinator_config["gather_mode"] == "ordered" or config["transport"] != "shared_memory"
+    sprinters_decay_factor = get_sprinters_decay_factor(config, app_type, app_sub_type)
+
+    path = get_results_path(config, policy_type, app_type, app_sub_type)
+
+    result_cache = cache.create_cache(config)
+    cache_key = None if resume or result_cache is None else \
+        get_run_cache_key(config, app_type, app_sub_type, policy_type, threshold_in, seed)
+    if cache_key is not None and result_cache.get_file(cache_key, os.path.join(path, results.RESULTS_FILE_NAME)):
+        print(f"Results restored from the cache in {time.time() - start_time} seconds")
+        return
 
     ids_list = np.array_split(np.arange(0, num_servers), num_workers)
-    for i in range(0, num_workers):
-        worker = Worker(servers_list[ids_list[i][0]:ids_list[i][-1] + 1], w2c_queues[i], c2w_queues[i])
-        worker_processor = Process(target=worker.run_worker, args=(path,))
+    transport = transports.create_transport(config["transport"], ids_list, get_block_len(config),
+                                            config["socket_address"])
+
+    coordinator_cpus, worker_cpus = get_cpu_assignment(num_workers, threads_per_worker)
+    if config["pin_cpus"] != 1:
+        coordinator_cpus, worker_cpus = None, [None] * num_workers
+
+    worker_processors = []
+
+    if resume:
+        resume_iteration = checkpoint.find_latest_checkpoint(path, num_workers)
+        print(f"Resuming from iteration {resume_iteration}")
+        coordinator = load_coordinator(path, resume_iteration, transport, coordinator_config)
+    else:
+        checkpoint.remove_checkpoints(path)
+        coordinator = Coordinator(coordinator_config, transport, num_workers, num_servers,
+                                  sprinters_decay_factor, var, results_format, get_checkpoint_interval(config),
+                                  get_noise_seed(config, seed))
+
+    if results_format == "binary":
+        metadata = {"app_type": app_type, "app_sub_type": app_sub_type, "policy_type": policy_type,
+                    "num_servers": num_servers, "period": coordinator_config["period"],
+                    "total_iterations": coordinator_config["total_iterations"], "sample_stride": max(sample_stride, 1)}
+        results.create_results_store(os.path.join(path, results.RESULTS_FILE_NAME), num_servers,
+                                     coordinator.total_iterations, metadata,
+                                     history.get_sample_len(coordinator.total_iterations, max(sample_stride, 1)),
+                                     num_workers)
+
+    # with spawn_workers 0 the workers are started separately with remote_worker.py (socket transport only)
+    num_local_workers = num_workers if config["spawn_workers"] == 1 else 0
+    for i in range(0, num_local_workers):
+        if resume:
+            worker = load_worker(path, resume_iteration, transport.get_worker_endpoint(i), i)
+        else:
+            worker = create_worker(config, app_type, app_sub_type, policy_type, threshold_in, ids_list[i],
+                                   transport.get_worker_endpoint(i), i)
+        worker_processor = Process(target=run_with_resources,
+                                   args=(worker.run_worker, threads_per_worker, worker_cpus[i], path))
         worker_processors.append(worker_processor)
         worker_processor.start()
 
-    coordinator_processor = Process(target=coordinator.run_coordinator, args=(path,))
+    coordinator_processor = Process(target=run_with_resources,
+                                    args=(coordinator.run_coordinator, 1, coordinator_cpus, path))
     coordinator_processor.start()
 
     for worker_processor in worker_processors:
         worker_processor.join()
 
     coordinator_processor.join()
+    transport.close()
+    if cache_key is not None:
+        result_cache.put_file(cache_key, os.path.join(path, results.RESULTS_FILE_NAME))
 
     end_time = time.time()
     total_time = end_time - start_time
@@ -4,6 +4,8 @@ import numpy as np
 import json
 import argparse
 
+import results
+
 
 def main(config_file_name, app_type_id, app_type_sub_id, policy_id):
     with open(config_file_name, 'r') as f:
@@ -35,8 +37,20 @@ def main(config_file_name, app_type_id, app_type_sub_id, policy_id):
     path = f"{folder_name}/{num_servers}_server/{policy_type}/{app_type}_{app_sub_type}"
     if not os.path.exists(path):
         os.mkdir(path)
-    frac_sprinters_path = os.path.join(path, "frac_sprinters.txt")
-    frac_sprinters = np.loadtxt(frac_sprinters_path)
+    # binary results store written with "results_format": "binary", opened lazily; otherwise the text files
+    store = None
+    if config["results_format"] == "binary":
+        store = results.ResultsStore(os.path.join(path, results.RESULTS_FILE_NAME))
+    # server series of a store recorded in sampled mode are already decimated by its sample stride
+    stride = 1
+    if store is not None:
+        stride = store.metadata.get("sample_stride", 1)
+        if stride > 1:
+            sample_size = stride
+        frac_sprinters = np.array(store["frac_sprinters"])
+    else:
+        frac_sprinters_path = os.path.join(path, "frac_sprinters.txt")
+        frac_sprinters = np.loadtxt(frac_sprinters_path)
     total_iter = frac_sprinters.shape[0]
     #print(total_iter)
     #print(sample_size)
@@ -50,13 +64,16 @@ def main(config_file_name, app_type_id, app_type_sub_id, policy_id):
     plt.savefig(os.path.join(path, "frac_sprinter.png"))
     plt.close()
 
-    rewards_from_servers = np.zeros([num_servers, int(np.ceil(total_iter / sample_size))])
-    for i in range(num_servers):
-        reward_file_path = os.path.join(path, f"server_{i}_rewards.txt")
-        rewards = np.loadtxt(reward_file_path)
-        rewards = rewards[np.arange(0, total_iter, sample_size)]
-        rewards_from_servers[i] = rewards
-    mean_rewards = rewards_from_servers.mean(axis=0)
+    if store is not None:
+        mean_rewards = results.get_mean_rewards(store, np.arange(0, total_iter, sample_size))
+    else:
+        rewards_from_servers = np.zeros([num_servers, int(np.ceil(total_iter / sample_size))])
+        for i in range(num_servers):
+            reward_file_path = os.path.join(path, f"server_{i}_rewards.txt")
+            rewards = np.loadtxt(reward_file_path)
+            rewards = rewards[np.arange(0, total_iter, sample_size)]
+            rewards_from_servers[i] = rewards
+        mean_rewards = rewards_from_servers.mean(axis=0)
 
     plt.figure(figsize=(25, 10))
     plt.plot(mean_rewards)
@@ -68,7 +85,7 @@ def main(config_file_name, app_type_id, app_type_sub_id, policy_id):
     plt.close()
     #print(len(mean_rewards))
     #   calculate average reward over rounds for different policy
-    average_reward = mean_rewards[len(mean_rewards) - 100:].mean()
+    average_reward = results.get_average_reward(mean_rewards, config["tail_window"])
     file_path = os.path.join(path, "different_policy_avg_rewards.txt")
     with open(file_path, 'w+') as file:
         file.write(f"{average_reward}\n")
@@ -78,19 +95,23 @@ def main(config_file_name, app_type_id, app_type_sub_id, policy_id):
 
     if app_type_id == 2:
         # Iterate over all 10 servers
-        x = list(range(1, total_iter + 1))
+        x = list(range(1, total_iter + 1, stride))
         plt.figure(figsize=(40, 20))
-        decay_factor = 0.999
-        total = np.zeros((num_servers, total_iter))
+        # one sample spans stride iterations in sampled mode
+        decay_factor = 0.999 ** stride
+        total = np.zeros((num_servers, len(x)))
         for server_id in range(num_servers):
             itr = 1
             avg_length = 0
             y = []  # Initialize the y-axis
-            file_path = os.path.join(path, f"server_{server_id}_app_states.txt")
-            with open(file_path, 'r') as file:
-                lines = file.readlines()
+            if store is not None:
+                lines = store["app_states"][server_id].tolist()
+            else:
+                file_path = os.path.join(path, f"server_{server_id}_app_states.txt")
+                with open(file_path, 'r') as file:
+                    lines = file.readlines()
             for line in lines:
-                avg_length = decay_factor * avg_length + (1 - decay_factor) * float(line.strip())
+                avg_length = decay_factor * avg_length + (1 - decay_factor) * float(str(line).strip())
                 y.append(avg_length / (1 - decay_factor ** itr))
                 itr += 1
             total[server_id] = y
@@ -2,6 +2,8 @@ import numpy as np
 import torch
 from torch import nn, optim
 from torch.distributions import Normal
+
+import streams
 # import torch.nn.functional as fun
 # import numpy as np
 
@@ -40,7 +42,8 @@ class Actor(nn.Module):
         self.optimizer = optim.AdamW(self.parameters(), lr=lr)
         self.std_max = std_max
 
-    def forward(self, x):
+    # noise: standard normal draw to use instead of sampling from the global torch generator
+    def forward(self, x, noise=None):
         # x2 = x ** 2
         # x = torch.cat((x2, x))
         x = torch.relu(self.actor_layer1(x))
@@ -49,7 +52,7 @@ class Actor(nn.Module):
         # std = torch.clamp(std, min=0, max=self.std_max)
         std = self.std_max
         dist = Normal(loc=mean, scale=std)
-        u = dist.sample()
+        u = dist.sample() if noise is None else (mean + std * noise).detach()
         # a = torch.tanh(u)
         log_prob = dist.log_prob(u)
         # log_prob -= torch.log(1 - a.pow(2) + 1e-6)
@@ -58,6 +61,11 @@ class Actor(nn.Module):
         # return a * 0.5 + 0.5, log_prob
         return u, log_prob
 
+    # log probability of an already sampled action, same computation as in forward
+    def get_log_prob(self, x, u):
+        mean, std = self.get_mean_std(x)
+        return Normal(loc=mean, scale=std).log_prob(u)
+
     def get_mean_std(self, x):
         # x2 = x ** 2
         # x = torch.cat((x2, x))
@@ -70,6 +78,125 @@ class Actor(nn.Module):
         return mean, std
 
 
+# Actor and Critic of one server initialized from their own torch seed, leaving the global generator untouched
+def create_seeded_networks(seed, a_input_size, c_input_size, a_h1_size, c_h1_size, a_lr, c_lr, std_max):
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(seed)
+        actor = Actor(a_input_size, a_h1_size, a_lr, std_max)
+        critic = Critic(c_input_size, c_h1_size, c_lr)
+    return actor, critic
+
+
+"""
+Ensemble networks: the parameters of num_models independent networks are stacked into batched tensors,
+so all models are evaluated with one batched matrix multiplication per layer.
+"""
+
+
+class EnsembleLinear(nn.Module):
+    def __init__(self, num_models, in_features, out_features):
+        super().__init__()
+        # same initialization as nn.Linear, drawn independently for every model
+        bound = 1 / np.sqrt(in_features)
+        self.weight = nn.Parameter(torch.empty(num_models, in_features, out_features).uniform_(-bound, bound))
+        self.bias = nn.Parameter(torch.empty(num_models, 1, out_features).uniform_(-bound, bound))
+
+    # x: (num_models, batch_size, in_features)
+    def forward(self, x):
+        return torch.baddbmm(self.bias, x, self.weight)
+
+    # set the parameters of one model to those of an nn.Linear
+    @torch.no_grad()
+    def copy_model(self, model_index, linear):
+        self.weight[model_index] = linear.weight.T
+        self.bias[model_index, 0] = linear.bias
+
+
+class EnsembleAdamW:
+    """
+    AdamW over stacked ensemble parameters (first dimension indexes the model). Every model keeps its own step
+    counter, so models masked out of a step are left untouched exactly as if their optimizer was not stepped.
+    """
+    def __init__(self, params, num_models, lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2):
+        self.params = list(params)
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.weight_decay = weight_decay
+        self.steps = torch.zeros(num_models)
+        self.exp_avg = [torch.zeros_like(p) for p in self.params]
+        self.exp_avg_sq = [torch.zeros_like(p) for p in self.params]
+
+    def zero_grad(self):
+        for p in self.params:
+            p.grad = None
+
+    @torch.no_grad()
+    def step(self, mask=None):
+        if mask is None:
+            mask = torch.ones_like(self.steps, dtype=torch.bool)
+        beta1, beta2 = self.betas
+        self.steps += mask
+        steps = self.steps.clamp(min=1)
+        bias_correction1 = 1 - beta1 ** steps
+        bias_correction2_sqrt = (1 - beta2 ** steps).sqrt()
+        for p, exp_avg, exp_avg_sq in zip(self.params, self.exp_avg, self.exp_avg_sq):
+            if p.grad is None:
+                continue
+            shape = (-1,) + (1,) * (p.dim() - 1)
+            m = mask.view(shape)
+            grad = p.grad
+            p.copy_(torch.where(m, p * (1 - self.lr * self.weight_decay), p))
+            exp_avg.copy_(torch.where(m, exp_avg.lerp(grad, 1 - beta1), exp_avg))
+            exp_avg_sq.copy_(torch.where(m, exp_avg_sq * beta2 + (1 - beta2) * grad * grad, exp_avg_sq))
+            denom = exp_avg_sq.sqrt() / bias_correction2_sqrt.view(shape) + self.eps
+            update = (self.lr / bias_correction1).view(shape) * exp_avg / denom
+            p.sub_(torch.where(m, update, torch.zeros_like(update)))
+
+
+class EnsembleCritic(nn.Module):
+    def __init__(self, num_models, input_size, h1_size, lr):
+        super().__init__()
+        self.critic_layer1 = EnsembleLinear(num_models, input_size, h1_size)
+        self.critic_layer2 = EnsembleLinear(num_models, h1_size, h1_size)
+        self.critic_layer3 = EnsembleLinear(num_models, h1_size, 1)
+        self.optimizer = EnsembleAdamW(self.parameters(), num_models, lr=lr)
+
+    # x: (num_models, input_size), returns one state value per model
+    def forward(self, x):
+        x = torch.relu(self.critic_layer1(x.unsqueeze(1)))
+        x = torch.relu(self.critic_layer2(x))
+        state_value = self.critic_layer3(x)
+        return state_value.view(-1)
+
+
+class EnsembleActor(nn.Module):
+    def __init__(self, num_models, input_size, h1_size, lr, std_max):
+        super().__init__()
+        self.actor_layer1 = EnsembleLinear(num_models, input_size, h1_size)
+        self.actor_layer2_mean = EnsembleLinear(num_models, h1_size, 1)
+        self.optimizer = EnsembleAdamW(self.parameters(), num_models, lr=lr)
+        self.std_max = std_max
+
+    # x: (num_models, input_size), returns one sampled action and its log probability per model
+    def forward(self, x, noise=None):
+        mean, std = self.get_mean_std(x)
+        dist = Normal(loc=mean, scale=std)
+        u = dist.sample() if noise is None else (mean + std * noise).detach()
+        log_prob = dist.log_prob(u)
+        return u, log_prob
+
+    def get_log_prob(self, x, u):
+        mean, std = self.get_mean_std(x)
+        return Normal(loc=mean, scale=std).log_prob(u)
+
+    def get_mean_std(self, x):
+        x = torch.relu(self.actor_layer1(x.unsqueeze(1)))
+        mean = self.actor_layer2_mean(x).view(-1)
+        std = self.std_max
+        return mean, std
+
+
 class Policy:
     def get_new_action(self, state):
         pass
@@ -78,10 +205,41 @@ class Policy:
         pass
 
 
+class ACGraphState:
+    """
+    The pending terms of an unfinished mini-batch (state values and log probabilities) carry autograd graphs,
+    which pickling (checkpoints) drops. Actor-Critic policies keep the network inputs and sampled actions behind
+    them, so a loaded policy rebuilds the same terms with its current parameters, which are the ones they were
+    computed with since the parameters only change at the end of a mini-batch.
+    """
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["log_prob"] = None
+        state["log_probs"] = []
+        state["c_values"] = [None if x is not None else v for v, x in zip(self.c_values, self.critic_inputs)]
+        if self.critic_input is not None:
+            state["state_value"] = None
+        if "a_values" in state:
+            state["a_values"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.c_values = [self.critic(x) if x is not None else v for v, x in zip(self.c_values, self.critic_inputs)]
+        self.log_probs = [self.actor.get_log_prob(x, u) for x, u in self.actor_inputs]
+        if "a_values" in state:
+            self.a_values = [v for v, mask in zip(self.c_values, self.masks) if mask]
+        if self.critic_input is not None:
+            self.state_value = self.critic(self.critic_input)
+        if self.actor_input is not None:
+            self.log_prob = self.actor.get_log_prob(*self.actor_input)
+
+
 class QLPolicy(Policy):
     # def __init__(self, dim, discount_factor, learning_rate, epsilon, window):
-    def __init__(self, dim, discount_factor, learning_rate, epsilon):
+    def __init__(self, dim, discount_factor, learning_rate, epsilon, server_streams=None):
         self.q = (-20 / (1 - discount_factor)) * np.ones(dim + (2,))
+        self.streams = server_streams
         # self.q = np.zeros(dim + (2,))
         self.df = discount_factor
         self.lr = learning_rate
@@ -94,6 +252,10 @@ class QLPolicy(Policy):
         # self.g = 0
 
     def get_new_action(self, state):
+        if self.streams is not None:
+            if self.streams.uniform(streams.POLICY_EXPLORE) <= self.e:
+                return int(self.streams.randint(2, streams.POLICY_ACTION))
+            return self.printable_action(state)
         if np.random.uniform() <= self.e:
             return np.random.choice([0, 1])
         elif self.q[state][0] >= self.q[state][1]:
@@ -131,10 +293,48 @@ class QLPolicy(Policy):
         self.q[old_state][action] += self.lr * (delta - self.q[old_state][action])
 
 
-class ACPolicy(Policy):
-    def __init__(self, a_input_size, c_input_size, a_h1_size, c_h1_size, a_lr, c_lr, df, std_max, mini_batch_size=1):
-        self.actor = Actor(a_input_size, a_h1_size, a_lr, std_max)
-        self.critic = Critic(c_input_size, c_h1_size, c_lr)
+# Tabular Q-learning for num_policies servers: every server's table is one slice of a (N, 2, S, 2) array and a
+# state is a pair of arrays (server states, app state indices) with one entry per server.
+class QLFleetPolicy(Policy):
+    def __init__(self, num_policies, dim, discount_factor, learning_rate, epsilon, server_streams=None):
+        self.num_policies = num_policies
+        self.streams = server_streams
+        self.q = (-20 / (1 - discount_factor)) * np.ones((num_policies,) + dim + (2,))
+        self.rows = np.arange(num_policies)
+        self.df = discount_factor
+        self.lr = learning_rate
+        self.e = epsilon
+
+    def get_new_action(self, state):
+        if self.streams is None:
+            explore = np.random.uniform(size=self.num_policies) <= self.e
+            random_actions = np.random.randint(2, size=self.num_policies)
+        else:
+            explore = self.streams.uniform(streams.POLICY_EXPLORE) <= self.e
+            random_actions = self.streams.randint(2, streams.POLICY_ACTION)
+        return np.where(explore, random_actions, self.printable_action(state))
+
+    def printable_action(self, state):
+        q = self.q[(self.rows,) + tuple(state)]
+        return np.where(q[:, 0] >= q[:, 1], 0, 1)
+
+    def update_policy(self, old_state, action, reward, new_state):
+        q_new = self.q[(self.rows,) + tuple(new_state)]
+        delta = reward + self.df * q_new.max(axis=1)
+        index = (self.rows,) + tuple(old_state) + (action.astype(int),)
+        self.q[index] += self.lr * (delta - self.q[index])
+
+
+class ACPolicy(ACGraphState, Policy):
+    def __init__(self, a_input_size, c_input_size, a_h1_size, c_h1_size, a_lr, c_lr, df, std_max, mini_batch_size=1,
+                 server_streams=None):
+        self.streams = server_streams
+        if server_streams is None:
+            self.actor = Actor(a_input_size, a_h1_size, a_lr, std_max)
+            self.critic = Critic(c_input_size, c_h1_size, c_lr)
+        else:
+            self.actor, self.critic = create_seeded_networks(int(server_streams.torch_seeds()), a_input_size,
+                                                             c_input_size, a_h1_size, c_h1_size, a_lr, c_lr, std_max)
         self.log_prob = None
         self.discount_factor = df
         self.state_value = torch.tensor([0.0], requires_grad=True)
@@ -145,12 +345,23 @@ class ACPolicy(Policy):
         self.masks = []
         self.iteration = 0
         self.mini_batch_size = mini_batch_size
+        # inputs behind state_value / log_prob and the pending mini-batch terms (see ACGraphState)
+        self.critic_input = None
+        self.actor_input = None
+        self.critic_inputs = []
+        self.actor_inputs = []
 
     def get_new_action(self, state):
         state_tensor = torch.tensor(state, dtype=torch.float32)
-        action, self.log_prob = self.actor(state_tensor)
+        action, self.log_prob = self.actor(state_tensor, self.get_noise())
+        self.actor_input = (state_tensor, action)
         return action.item()
 
+    def get_noise(self):
+        if self.streams is None:
+            return None
+        return torch.tensor(self.streams.normal(streams.POLICY_NOISE), dtype=torch.float32)
+
     def printable_action(self, state):
         state_tensor = torch.tensor(state, dtype=torch.float32)
         return self.actor.get_mean_std(state_tensor)
@@ -168,11 +379,13 @@ class ACPolicy(Policy):
 
     def update_policy(self, next_state, reward, update_actor):
         self.c_values.append(self.state_value)
+        self.critic_inputs.append(self.critic_input)
         self.rewards.append(reward)
         self.masks.append(update_actor)
 
         if update_actor:
             self.log_probs.append(self.log_prob)
+            self.actor_inputs.append(self.actor_input)
             self.a_values.append(self.state_value)
 
         next_state_tensor = torch.tensor(next_state, dtype=torch.float32)
@@ -210,8 +423,114 @@ class ACPolicy(Policy):
             self.a_values = []
             self.log_probs = []
             self.masks = []
+            self.critic_inputs = []
+            self.actor_inputs = []
+            self.iteration = 0
+
+        self.critic_input = next_state_tensor
+        self.state_value = self.critic(next_state_tensor)
+
+
+# Actor-Critic policies of num_policies servers with independent weights, updated with one batched
+# forward and backward pass. States, rewards and actions are arrays with one row per server.
+class ACEnsemblePolicy(ACGraphState, Policy):
+    def __init__(self, num_policies, a_input_size, c_input_size, a_h1_size, c_h1_size, a_lr, c_lr, df, std_max,
+                 mini_batch_size=1, server_streams=None):
+        self.num_policies = num_policies
+        self.actor = EnsembleActor(num_policies, a_input_size, a_h1_size, a_lr, std_max)
+        self.critic = EnsembleCritic(num_policies, c_input_size, c_h1_size, c_lr)
+        self.streams = server_streams
+        if server_streams is not None:
+            # same initial weights as the ACPolicy of every server
+            for i, seed in enumerate(server_streams.torch_seeds().tolist()):
+                actor, critic = create_seeded_networks(seed, a_input_size, c_input_size, a_h1_size, c_h1_size,
+                                                       a_lr, c_lr, std_max)
+                self.actor.actor_layer1.copy_model(i, actor.actor_layer1)
+                self.actor.actor_layer2_mean.copy_model(i, actor.actor_layer2_mean)
+                self.critic.critic_layer1.copy_model(i, critic.critic_layer1)
+                self.critic.critic_layer2.copy_model(i, critic.critic_layer2)
+                self.critic.critic_layer3.copy_model(i, critic.critic_layer3)
+        self.log_prob = torch.zeros(num_policies)
+        self.discount_factor = df
+        self.state_value = torch.zeros(num_policies)
+        self.c_values = []
+        self.rewards = []
+        self.log_probs = []
+        self.masks = []
+        self.iteration = 0
+        self.mini_batch_size = mini_batch_size
+        self.critic_input = None
+        self.actor_input = None
+        self.critic_inputs = []
+        self.actor_inputs = []
+
+    def get_new_action(self, state):
+        state_tensor = torch.tensor(state, dtype=torch.float32)
+        action, self.log_prob = self.actor(state_tensor, self.get_noise())
+        self.actor_input = (state_tensor, action)
+        return action.numpy()
+
+    def get_noise(self):
+        if self.streams is None:
+            return None
+        return torch.tensor(self.streams.normal(streams.POLICY_NOISE), dtype=torch.float32)
+
+    def printable_action(self, state):
+        state_tensor = torch.tensor(state, dtype=torch.float32)
+        return self.actor.get_mean_std(state_tensor)
+
+    def compute_returns(self, next_state_value):
+        r = next_state_value
+        returns = []
+        for step in reversed(range(len(self.rewards))):
+            r = self.rewards[step] + self.discount_factor * r
+            returns.insert(0, r)
+        return torch.stack(returns)
+
+    def update_policy(self, next_state, reward, update_actor):
+        self.c_values.append(self.state_value)
+        self.critic_inputs.append(self.critic_input)
+        self.rewards.append(torch.tensor(reward, dtype=torch.float32))
+        self.masks.append(torch.tensor(update_actor, dtype=torch.bool))
+        self.log_probs.append(self.log_prob)
+        self.actor_inputs.append(self.actor_input)
+
+        next_state_tensor = torch.tensor(next_state, dtype=torch.float32)
+        self.iteration += 1
+
+        if self.iteration == self.mini_batch_size:
+            next_state_value = self.critic(next_state_tensor)
+            returns = self.compute_returns(next_state_value).detach()
+            c_values = torch.stack(self.c_values)
+            masks = torch.stack(self.masks)
+            a_counts = masks.sum(dim=0)
+
+            # per-server losses are summed, so every server gets the gradient of its own loss
+            if a_counts.any():
+                a_advantage = torch.where(masks, returns - c_values, torch.zeros_like(c_values))
+                log_probs = torch.where(masks, torch.stack(self.log_probs), torch.zeros_like(c_values))
+                actor_loss = -(log_probs * a_advantage.detach()).sum(dim=0) / a_counts.clamp(min=1)
+
+                self.actor.optimizer.zero_grad()
+                actor_loss.sum().backward()
+                self.actor.optimizer.step(a_counts > 0)
+
+            c_advantage = returns - c_values
+            critic_loss = c_advantage.pow(2).mean(dim=0)
+
+            self.critic.optimizer.zero_grad()
+            critic_loss.sum().backward()
+            self.critic.optimizer.step()
+
+            self.rewards = []
+            self.c_values = []
+            self.log_probs = []
+            self.masks = []
+            self.critic_inputs = []
+            self.actor_inputs = []
             self.iteration = 0
 
+        self.critic_input = next_state_tensor
         self.state_value = self.critic(next_state_tensor)
 
 
@@ -0,0 +1,50 @@
+import json
+import argparse
+
+import numpy as np
+
+import checkpoint
+import multiprocessing_MARL as marl
+import transports
+
+"""
+Remote worker: runs one worker of a simulation whose coordinator was started by multiprocessing_MARL.main with the
+socket transport and spawn_workers set to 0. Start one per worker id, on this or on other hosts, with the same
+config file as the coordinator (socket_address must be reachable from here and num_workers must be set explicitly).
+Results and checkpoints are written under folder_name on this host, so resuming needs the checkpoint folder on a
+shared file system, as does the binary results store.
+"""
+
+
+def main(config_file_name, app_type_id, app_sub_type_id, policy_id, worker_id, threshold_in, resume=False):
+    with open(config_file_name, 'r') as f:
+        config = json.load(f)
+    num_workers = config["num_workers"]
+    assert num_workers > 0 and worker_id < num_workers
+    app_type, app_sub_type, policy_type = marl.get_run_types(config, app_type_id, app_sub_type_id, policy_id)
+    path = marl.get_results_path(config, policy_type, app_type, app_sub_type)
+
+    server_ids = np.array_split(np.arange(0, config["num_servers"]), num_workers)[worker_id]
+    endpoint = transports.SocketWorkerEndpoint(config["socket_address"], worker_id, len(server_ids))
+    if resume:
+        resume_iteration = checkpoint.find_latest_checkpoint(path, num_workers)
+        worker = marl.load_worker(path, resume_iteration, endpoint, worker_id)
+    else:
+        worker = marl.create_worker(config, app_type, app_sub_type, policy_type, threshold_in, server_ids, endpoint,
+                                    worker_id)
+    marl.set_process_resources(config["threads_per_worker"])
+    worker.run_worker(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file')
+    parser.add_argument('app_type_id', type=int)
+    parser.add_argument('app_type_sub_id', type=int)
+    parser.add_argument('policy_id', type=int)
+    parser.add_argument('worker_id', type=int)
+    parser.add_argument('--threshold', type=float, default=-1)
+    parser.add_argument('--resume', action='store_true')
+    args = parser.parse_args()
+    main(args.config_file, args.app_type_id, args.app_type_sub_id, args.policy_id, args.worker_id, args.threshold,
+         args.resume)
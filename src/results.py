@@ -0,0 +1,87 @@
+import json
+import struct
+
+import numpy as np
+
+
+"""
+Binary columnar results store: one file holding a small JSON header and, at 64-byte aligned offsets, the raw
+columns of a run (servers x samples matrices for rewards, app states and actions, the coordinator's
+frac_sprinters series and, in sampled recording mode, every worker's reward sum per sample). Columns are opened
+lazily as np.memmap, so readers can slice them without parsing text, and every worker can write its own rows of
+the server matrices in place. Without sampling a sample is one iteration.
+"""
+
+RESULTS_FILE_NAME = "results.bin"
+MAGIC = b"MARLRES1"
+ALIGNMENT = 64
+
+
+def get_columns(num_servers, num_iterations, num_samples, num_workers):
+    return {
+        "rewards": ("<f4", (num_servers, num_samples)),
+        "app_states": ("<f4", (num_servers, num_samples)),
+        "actions": ("i1", (num_servers, num_samples)),
+        "frac_sprinters": ("<f8", (num_iterations,)),
+        "worker_reward_sums": ("<f8", (num_workers, num_samples)),
+    }
+
+
+def create_results_store(file_path, num_servers, num_iterations, metadata, num_samples=None, num_workers=1):
+    if num_samples is None:
+        num_samples = num_iterations
+    columns = {}
+    offset = 0
+    for name, (dtype, shape) in get_columns(num_servers, num_iterations, num_samples, num_workers).items():
+        columns[name] = {"dtype": dtype, "shape": list(shape), "offset": offset}
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"metadata": metadata, "columns": columns}).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    with open(file_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        file.truncate(data_start + offset)
+
+
+class ResultsStore:
+    def __init__(self, file_path, mode='r'):
+        self.file_path = file_path
+        self.mode = mode
+        with open(file_path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{file_path} is not a results store")
+            header_len = struct.unpack("<Q", file.read(8))[0]
+            header = json.loads(file.read(header_len))
+        self.metadata = header["metadata"]
+        self.columns = header["columns"]
+        self.data_start = -(-(len(MAGIC) + 8 + header_len) // ALIGNMENT) * ALIGNMENT
+        self.arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            column = self.columns[name]
+            self.arrays[name] = np.memmap(self.file_path, dtype=column["dtype"], mode=self.mode,
+                                          offset=self.data_start + column["offset"], shape=tuple(column["shape"]))
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+
+
+# fleet mean reward per sample, from the workers' running sums in sampled mode or from the reward matrix
+def get_mean_rewards(store, sample_indices=None):
+    if store.metadata.get("sample_stride", 1) > 1:
+        mean_rewards = store["worker_reward_sums"].sum(axis=0) / store.metadata["num_servers"]
+    else:
+        mean_rewards = np.asarray(store["rewards"][:, sample_indices], dtype=float).mean(axis=0)
+    return mean_rewards
+
+
+def get_average_reward(mean_rewards, tail_window):
+    return mean_rewards[len(mean_rewards) - tail_window:].mean()
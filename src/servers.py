@@ -3,9 +3,13 @@ import sys
 
 import numpy as np
 
+import streams
+from history import HistoryBuffer
+
 
 class Server:
-    def __init__(self, server_id, period, policy, app, server_config, utility_normalization_factor):
+    def __init__(self, server_id, period, policy, app, server_config, utility_normalization_factor, history_len=0,
+                 history_stride=1, server_streams=None):
         self.server_id = server_id
 
         self.server_state = 0       # initial state: Active
@@ -25,7 +29,14 @@ class Server:
         self.change_iteration = server_config["change_iteration"] * self.period
         self.change_type = server_config["change_type"]
 
-        self.reward_history = []
+        # history_len: preallocated number of recorded iterations, usually total_iterations * period,
+        # history_stride: only every history_stride-th iteration is recorded
+        self.reward_history = HistoryBuffer(history_len, np.float32, stride=history_stride)
+        self.action_history = HistoryBuffer(history_len, np.int8, stride=history_stride)
+        self.app.allocate_history(history_len, history_stride)
+
+        # streams.ServerStreams shared with the app and the policy, None to draw from the process-wide np.random
+        self.streams = server_streams
 
     def get_action_utility_by_threshold(self, threshold):
         if self.server_state == 0 and self.app.get_current_state() >= threshold:
@@ -47,13 +58,18 @@ class Server:
 
         if self.server_state == 1:
             assert self.action == 1
-            if np.random.rand() > self.cooling_prob:    # stay in cooling
+            if self.get_cooling_draw() > self.cooling_prob:    # stay in cooling
                 self.server_state = 0
         elif self.action == 0:     # go to cooling
             self.server_state = 1
 
         self.reward_history.append(self.reward)
 
+    def get_cooling_draw(self):
+        if self.streams is None:
+            return np.random.rand()
+        return self.streams.uniform(streams.COOLING)
+
     def update_policy(self):
         pass
 
@@ -61,27 +77,38 @@ class Server:
         pass
 
     def run_server(self, cost, frac_sprinters, iteration):
+        if self.streams is not None:
+            self.streams.iteration = iteration
         if self.change == 1 and iteration == self.change_iteration:
             self.app.apply_change(self.change_type)
 
         self.update_state(cost, frac_sprinters)
         self.update_policy()
         self.take_action()
+        self.action_history.append(self.action)
         return self.action
 
     # write reward into files
     def print_rewards_and_app_states(self, path):
         file_path = os.path.join(path, f"server_{self.server_id}_rewards.txt")
         with open(file_path, 'w+') as file:
-            for r in self.reward_history:
+            for r in self.reward_history.to_array().tolist():
                 file.write(f"{str(r)}\n")
         self.app.print_state(self.server_id, path)
 
+    # write rewards, app states and actions into this server's row of a results.ResultsStore
+    def write_results(self, store):
+        store["rewards"][self.server_id] = self.reward_history.to_array()
+        store["app_states"][self.server_id] = self.app.get_state_history()
+        store["actions"][self.server_id] = self.action_history.to_array()
+
 
 # Server with Actor-Critic policy
 class ACServer(Server):
-    def __init__(self, server_id, period, policy, app, server_config, state_normalization_factor, utility_normalization_factor):
-        super().__init__(server_id, period, policy, app, server_config, utility_normalization_factor)
+    def __init__(self, server_id, period, policy, app, server_config, state_normalization_factor, utility_normalization_factor,
+                 history_len=0, history_stride=1, server_streams=None):
+        super().__init__(server_id, period, policy, app, server_config, utility_normalization_factor, history_len,
+                         history_stride, server_streams)
         self.state_normalization_factor = state_normalization_factor
         self.update_actor = 0
 
@@ -113,8 +140,10 @@ class ACServer(Server):
 #  Server with threshold policy.
 #  It is a fixed policy, so it doesn't need update policy
 class ThrServer(Server):
-    def __init__(self, server_id, period, policy, app, server_config, utility_normalization_factor):
-        super().__init__(server_id, period, policy, app, server_config, utility_normalization_factor)
+    def __init__(self, server_id, period, policy, app, server_config, utility_normalization_factor, history_len=0,
+                 history_stride=1, server_streams=None):
+        super().__init__(server_id, period, policy, app, server_config, utility_normalization_factor, history_len,
+                         history_stride, server_streams)
 
     def update_policy(self):
         return
@@ -127,8 +156,10 @@ class ThrServer(Server):
 
 
 class QLServer(Server):
-    def __init__(self, server_id, period, policy, app, server_config, utility_normalization_factor):
-        super().__init__(server_id, period, policy, app, server_config, utility_normalization_factor)
+    def __init__(self, server_id, period, policy, app, server_config, utility_normalization_factor, history_len=0,
+                 history_stride=1, server_streams=None):
+        super().__init__(server_id, period, policy, app, server_config, utility_normalization_factor, history_len,
+                         history_stride, server_streams)
         self.old_state = (self.server_state, self.app.get_current_state_index())
         self.new_state = None
 
@@ -154,3 +185,178 @@ class QLServer(Server):
                 print(self.policy.printable_action(state), end="")
             print()
         return super().run_server(cost, frac_sprinters, iteration)
+
+
+"""
+Fleet variants of the servers above: server state, cooling state, rewards and actions of every server of one
+worker are held in NumPy arrays, and the whole fleet is advanced with one batched step per iteration.
+"""
+
+
+class ServerFleet:
+    def __init__(self, server_ids, period, policy, app_fleet, server_config, utility_normalization_factor,
+                 history_len=0, history_stride=1, server_streams=None):
+        self.server_ids = np.array(server_ids)
+        self.num_servers = len(self.server_ids)
+
+        self.server_state = np.zeros(self.num_servers, dtype=int)     # initial state: Active
+        self.action = np.ones(self.num_servers)                       # initial action: Not sprint
+        self.reward = np.zeros(self.num_servers)                      # initial reward: Zero
+        self.utility_normalization_factor = utility_normalization_factor
+
+        self.frac_sprinters = 0
+
+        self.period = period
+
+        self.policy = policy
+        self.app = app_fleet
+
+        self.cooling_prob = server_config["cooling_prob"]
+        self.change = server_config["change"]
+        self.change_iteration = server_config["change_iteration"] * self.period
+        self.change_type = server_config["change_type"]
+
+        self.reward_history = HistoryBuffer(history_len, np.float32, (self.num_servers,), history_stride)
+        self.action_history = HistoryBuffer(history_len, np.int8, (self.num_servers,), history_stride)
+        self.app.allocate_history(history_len, history_stride)
+
+        self.streams = server_streams
+
+    def get_action_utility_by_threshold(self, threshold):
+        sprint = (self.server_state == 0) & (self.app.get_current_state() >= threshold)
+        return self.get_action_utility_by_sprint_mask(sprint)
+
+    def get_action_utility_by_action(self, action):
+        sprint = (self.server_state == 0) & (action == 0)
+        return self.get_action_utility_by_sprint_mask(sprint)
+
+    def get_action_utility_by_sprint_mask(self, sprint):
+        action = np.where(sprint, 0.0, 1.0)
+        utility = np.where(sprint, self.app.get_sprinting_utility(), self.app.get_nominal_utility())
+        return action, utility
+
+    # update application states, server states, and fractional number of sprinters of the whole fleet.
+    def update_state(self, costs, frac_sprinters):
+        self.app.update_state(self.action)
+        self.reward = self.reward - costs
+        self.frac_sprinters = frac_sprinters
+
+        cooling = self.server_state == 1
+        assert np.all(self.action[cooling] == 1)
+        leave_cooling = cooling & (self.get_cooling_draws() > self.cooling_prob)
+        self.server_state = np.where(cooling, 1 - leave_cooling, self.action == 0).astype(int)
+
+        self.reward_history.append(self.reward)
+
+    def get_cooling_draws(self):
+        if self.streams is None:
+            return np.random.rand(self.num_servers)
+        return self.streams.uniform(streams.COOLING)
+
+    def update_policy(self):
+        pass
+
+    def take_action(self):
+        pass
+
+    def run_servers(self, costs, frac_sprinters, iteration):
+        if self.streams is not None:
+            self.streams.iteration = iteration
+        if self.change == 1 and iteration == self.change_iteration:
+            self.app.apply_change(self.change_type)
+
+        self.update_state(costs, frac_sprinters)
+        self.update_policy()
+        self.take_action()
+        self.action_history.append(self.action)
+        return self.action
+
+    # write rewards into files, one file per server as Server does
+    def print_rewards_and_app_states(self, path):
+        history = self.reward_history.to_array().T
+        for server_id, server_history in zip(self.server_ids, history):
+            file_path = os.path.join(path, f"server_{server_id}_rewards.txt")
+            with open(file_path, 'w+') as file:
+                for r in server_history.tolist():
+                    file.write(f"{str(r)}\n")
+        self.app.print_state(self.server_ids, path)
+
+    # write rewards, app states and actions into the fleet's rows of a results.ResultsStore
+    def write_results(self, store):
+        store["rewards"][self.server_ids] = self.reward_history.to_array().T
+        store["app_states"][self.server_ids] = self.app.get_state_history().T
+        store["actions"][self.server_ids] = self.action_history.to_array().T
+
+
+#  Fleet of servers with the same threshold policy.
+class ThrServerFleet(ServerFleet):
+    def __init__(self, server_ids, period, policy, app_fleet, server_config, utility_normalization_factor,
+                 history_len=0, history_stride=1, server_streams=None):
+        super().__init__(server_ids, period, policy, app_fleet, server_config, utility_normalization_factor,
+                         history_len, history_stride, server_streams)
+
+    def update_policy(self):
+        return
+
+    def take_action(self):
+        threshold = self.policy.get_new_action(0)
+        self.action, self.reward = self.get_action_utility_by_threshold(threshold)
+        self.reward = self.reward * self.utility_normalization_factor
+
+
+# Fleet of servers with Actor-Critic policies, sharing one policies.ACEnsemblePolicy
+class ACServerFleet(ServerFleet):
+    def __init__(self, server_ids, period, policy, app_fleet, server_config, state_normalization_factor,
+                 utility_normalization_factor, history_len=0, history_stride=1, server_streams=None):
+        super().__init__(server_ids, period, policy, app_fleet, server_config, utility_normalization_factor,
+                         history_len, history_stride, server_streams)
+        self.state_normalization_factor = state_normalization_factor
+        self.update_actor = np.zeros(self.num_servers, dtype=bool)
+
+    # Update Actor and Critic networks' parameters of all servers
+    def update_policy(self):
+        new_state = self.state_normalization_factor * np.column_stack((self.server_state,
+                                                                      self.app.get_current_state(),
+                                                                      np.full(self.num_servers, self.frac_sprinters)))
+        self.policy.update_policy(new_state, self.reward, self.update_actor)
+
+    # get threshold values from the ensemble actor; servers in cooling keep threshold 1 as ACServer does
+    def take_action(self):
+        self.update_actor = self.server_state == 0
+        state = self.state_normalization_factor * np.full((self.num_servers, 1), self.frac_sprinters)
+        threshold = np.where(self.update_actor, self.policy.get_new_action(state), 1)
+        self.action, self.reward = self.get_action_utility_by_threshold(threshold)
+        self.reward = self.reward * self.utility_normalization_factor
+
+
+# Fleet of servers with Q-learning policies, sharing one policies.QLFleetPolicy
+class QLServerFleet(ServerFleet):
+    def __init__(self, server_ids, period, policy, app_fleet, server_config, utility_normalization_factor,
+                 history_len=0, history_stride=1, server_streams=None):
+        super().__init__(server_ids, period, policy, app_fleet, server_config, utility_normalization_factor,
+                         history_len, history_stride, server_streams)
+        self.old_state = (self.server_state, self.app.get_current_state_index())
+        self.new_state = None
+
+    def update_state(self, costs, frac_sprinters):
+        self.old_state = (self.server_state, self.app.get_current_state_index())
+        super().update_state(costs, frac_sprinters)
+        self.new_state = (self.server_state, self.app.get_current_state_index())
+
+    def update_policy(self):
+        self.policy.update_policy(self.old_state, self.action, self.reward, self.new_state)
+
+    def take_action(self):
+        action = self.policy.get_new_action(self.new_state)
+        self.action, self.reward = self.get_action_utility_by_action(action)
+        self.reward = self.reward * self.utility_normalization_factor
+
+    def run_servers(self, costs, frac_sprinters, iteration):
+        position = np.flatnonzero(self.server_ids == 19)
+        if position.size > 0 and iteration % (5 * self.period) == 0:
+            print(iteration)
+            for j in range(0, self.app.get_state_space_len()):
+                state = (0, j)
+                print(self.policy.printable_action(state)[position[0]], end="")
+            print()
+        return super().run_servers(costs, frac_sprinters, iteration)
@@ -0,0 +1,87 @@
+import numpy as np
+from scipy.stats import poisson
+
+"""
+Per-server random streams: every draw is a hash of (seed, server_id, iteration, slot, index), so what a server draws
+does not depend on which worker runs it, on how many servers share a process, or on whether it is simulated as an
+object or as one row of a fleet. All draws take scalar or array server ids, so fleets draw for all their servers at
+once. Draws made while building a server (initial app states, network weights) use iteration -1.
+"""
+
+# what a draw is used for; distinct slots give independent streams within one iteration
+COOLING = 0
+APP_INITIAL = 1
+APP = 2
+APP_ARRIVAL = 3
+APP_DEPARTURE_NOT_SPRINTING = 4
+APP_DEPARTURE_SPRINTING = 5
+POLICY_EXPLORE = 6
+POLICY_ACTION = 7
+POLICY_NOISE = 8
+TORCH_SEED = 9
+
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+SERVER_MULTIPLIER = np.uint64(0xD1B54A32D192ED03)
+ITERATION_MULTIPLIER = np.uint64(0xAEF17502108EF2D9)
+SLOT_MULTIPLIER = np.uint64(0xF1357AEA2E62A9C5)
+POISSON_TAIL = 1e-16
+
+
+# SplitMix64 finalizer
+def mix64(x):
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def to_uint64(x):
+    return np.asarray(x, dtype=np.int64).astype(np.uint64)
+
+
+def random_bits(seed, server_ids, iteration, slot, index=0):
+    with np.errstate(over="ignore"):
+        key = mix64(to_uint64(seed) + GOLDEN_GAMMA)
+        key = mix64(key ^ (to_uint64(server_ids) + np.uint64(1)) * SERVER_MULTIPLIER)
+        counter = to_uint64(iteration) * ITERATION_MULTIPLIER + to_uint64(2 * slot + index) * SLOT_MULTIPLIER
+        return mix64(mix64(key ^ counter))
+
+
+# uniform in [0, 1) with 53 random bits
+def random_uniform(seed, server_ids, iteration, slot, index=0):
+    return (random_bits(seed, server_ids, iteration, slot, index) >> np.uint64(11)) * 2.0 ** -53
+
+
+# cumulative Poisson probabilities up to the point where the tail is negligible
+def get_poisson_cdf(lam):
+    return poisson.cdf(np.arange(poisson.isf(POISSON_TAIL, lam) + 1), lam)
+
+
+class ServerStreams:
+    # server_ids: one id (Server) or an array of ids (ServerFleet); the owning server sets iteration every step
+    def __init__(self, seed, server_ids):
+        self.seed = seed
+        self.server_ids = server_ids
+        self.iteration = -1
+        self.poisson_cdfs = {}
+
+    def uniform(self, slot, index=0):
+        return random_uniform(self.seed, self.server_ids, self.iteration, slot, index)
+
+    # standard normal by Box-Muller
+    def normal(self, slot):
+        radius = np.sqrt(-2 * np.log1p(-self.uniform(slot, 0)))
+        return radius * np.cos(2 * np.pi * self.uniform(slot, 1))
+
+    def randint(self, high, slot):
+        return np.minimum((self.uniform(slot) * high).astype(np.int64), high - 1)
+
+    # inverse transform sampling on a cached cdf table
+    def poisson(self, lam, slot):
+        if lam not in self.poisson_cdfs:
+            self.poisson_cdfs[lam] = get_poisson_cdf(lam)
+        cdf = self.poisson_cdfs[lam]
+        return np.minimum(np.searchsorted(cdf, self.uniform(slot), side='right'), len(cdf) - 1)
+
+    # seeds for torch generators, e.g. to initialize network weights per server
+    def torch_seeds(self):
+        return (random_bits(self.seed, self.server_ids, -1, TORCH_SEED) >> np.uint64(1)).astype(np.int64)
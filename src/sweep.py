@@ -0,0 +1,136 @@
+import copy
+import itertools
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import cache
+import multiprocessing_MARL as marl
+import results
+import transports
+
+"""
+Sweep: runs a grid of (app_type, sub_type, policy, seed, overrides) simulations on one shared process pool and hands
+the results back in memory. Every run keeps its coordinator and all its servers in one single-threaded process (see
+transports.LocalTransport), so nothing is written to disk and a pool process runs one small simulation after another
+instead of starting a coordinator and worker processes per run. The pool has one process per available core;
+chunksize packs several runs into one task to cut the scheduling overhead of very short runs.
+"""
+
+
+# copy of config with the (nested) keys of overrides replaced
+def merge_config(config, overrides):
+    merged = copy.deepcopy(config)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def make_grid(app_type_ids, app_sub_type_ids, policy_ids, seeds=(None,), overrides_list=({},), threshold=-1):
+    runs = []
+    for app_type_id, app_sub_type_id, policy_id, seed, overrides in itertools.product(
+            app_type_ids, app_sub_type_ids, policy_ids, seeds, overrides_list):
+        runs.append({"app_type_id": app_type_id, "app_sub_type_id": app_sub_type_id, "policy_id": policy_id,
+                     "seed": seed, "overrides": overrides, "threshold": threshold})
+    return runs
+
+
+# run one simulation in this process; seed also keys the per-server streams in rng_mode "server".
+# report(period, average_reward) is called at every period boundary with the average reward so far, computed like
+# the final one over the latest tail_window samples; it may raise to stop the run (e.g. optuna.TrialPruned).
+# Seeded runs are cached (see cache.py); a cached run returns at once without reporting
+def simulate(config, app_type_id, app_sub_type_id, policy_id, threshold_in=-1, seed=None, report=None):
+    config = copy.deepcopy(config)
+    if seed is not None:
+        marl.set_seed(seed)
+        config["rng_seed"] = seed
+    coordinator_config = config["coordinator_config"]
+    coordinator_config["gather_mode"] = "ordered"
+    app_type, app_sub_type, policy_type = marl.get_run_types(config, app_type_id, app_sub_type_id, policy_id)
+    num_servers = config["num_servers"]
+
+    result_cache = cache.create_cache(config) if seed is not None else None
+    if result_cache is not None:
+        key = cache.get_simulation_key("simulate", config, app_type, app_sub_type, policy_type, threshold_in, seed)
+        result = result_cache.get(key)
+        if result is not None:
+            return result
+
+    ids_list = [np.arange(0, num_servers)]
+    transport = transports.LocalTransport(ids_list)
+    coordinator = marl.Coordinator(coordinator_config, transport, 1, num_servers,
+                                   marl.get_sprinters_decay_factor(config, app_type, app_sub_type),
+                                   coordinator_config["var"], noise_seed=marl.get_noise_seed(config, seed))
+    worker = marl.create_worker(config, app_type, app_sub_type, policy_type, threshold_in, ids_list[0], None, 0)
+    transport.attach([worker])
+
+    sample_size = worker.sample_stride if worker.sample_stride > 0 else int(coordinator_config["period"] / 3)
+    tail_window = config["tail_window"]
+    if report is not None:
+        coordinator.period_callback = lambda period: report(
+            period, results.get_average_reward(worker.get_mean_rewards(sample_size, tail_window), tail_window))
+    coordinator.simulate()
+
+    mean_rewards = worker.get_mean_rewards(sample_size)
+    result = {"average_reward": results.get_average_reward(mean_rewards, tail_window),
+              "mean_rewards": mean_rewards, "frac_sprinters": np.array(coordinator.avg_frac_sprinters_list)}
+    if result_cache is not None:
+        result_cache.put(key, result)
+    return result
+
+
+def run_chunk(config, run):
+    result = simulate(merge_config(config, run["overrides"]), run["app_type_id"], run["app_sub_type_id"],
+                      run["policy_id"], run["threshold"], run["seed"])
+    result["run"] = run
+    return result
+
+
+# results of runs in the same order; config is a dict or the name of a config file
+def run_sweep(config, runs, num_processes=0, chunksize=1):
+    if isinstance(config, str):
+        with open(config, 'r') as f:
+            config = json.load(f)
+    if num_processes <= 0:
+        num_processes = len(marl.get_available_cpus())
+    num_processes = min(num_processes, max(len(runs), 1))
+    with ProcessPoolExecutor(num_processes, initializer=marl.set_process_resources, initargs=(1,)) as executor:
+        return list(executor.map(run_chunk, itertools.repeat(config), runs, chunksize=chunksize))
+
+
+def main(config_file_name, app_type_ids, app_sub_type_ids, policy_ids, seeds, overrides_list, threshold_in,
+         num_processes, chunksize, output_file_name=None):
+    runs = make_grid(app_type_ids, app_sub_type_ids, policy_ids, seeds, overrides_list, threshold_in)
+    sweep_results = run_sweep(config_file_name, runs, num_processes, chunksize)
+    for result in sweep_results:
+        run = result["run"]
+        print(f"{run['app_type_id']} {run['app_sub_type_id']} {run['policy_id']} {run['seed']} "
+              f"{json.dumps(run['overrides'])} {result['average_reward']}")
+    if output_file_name is not None:
+        with open(output_file_name, 'w') as f:
+            json.dump([{"run": result["run"], "average_reward": result["average_reward"],
+                        "mean_rewards": result["mean_rewards"].tolist()} for result in sweep_results], f)
+    return sweep_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file')
+    parser.add_argument('--app-types', type=int, nargs='+', required=True)
+    parser.add_argument('--sub-types', type=int, nargs='+', default=[0])
+    parser.add_argument('--policies', type=int, nargs='+', required=True)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[None])
+    # JSON list of override dicts, e.g. '[{"num_servers": 100}, {"coordinator_config": {"add_noise": 1}}]'
+    parser.add_argument('--overrides', type=json.loads, default=[{}])
+    parser.add_argument('--threshold', type=float, default=-1)
+    parser.add_argument('--processes', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    main(args.config_file, args.app_types, args.sub_types, args.policies, args.seeds, args.overrides,
+         args.threshold, args.processes, args.chunksize, args.output)
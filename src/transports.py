@@ -0,0 +1,339 @@
+import os
+import queue
+import socket
+import struct
+import sys
+import time
+from multiprocessing import Barrier, Queue
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+"""
+Transports: carry (frac_sprinters, costs, iteration) from the Coordinator to every Worker and the workers' actions
+back. The coordinator side broadcasts, gathers and stops; every worker uses its own endpoint to receive and send.
+Transports with receive_reply also hand out replies one at a time in arrival order, tagged with the worker id and
+the iteration they answer, so the coordinator can keep going without waiting for a straggler.
+"""
+
+
+class QueueTransport:
+    # one multiprocessing.Queue per worker for the coordinator's messages and one shared by all replies;
+    # every message is pickled
+    def __init__(self, workers_server_ids):
+        self.workers_server_ids = workers_server_ids
+        self.num_workers = len(workers_server_ids)
+        self.w2c_queue = Queue()
+        self.c2w_queues = [Queue() for _ in range(self.num_workers)]
+
+    def broadcast(self, frac_sprinters, costs, iteration):
+        for q, ids in zip(self.c2w_queues, self.workers_server_ids):
+            q.put((frac_sprinters, costs[ids], iteration))
+
+    # actions_array: servers are indexed by the last axis
+    def gather(self, actions_array):
+        for _ in range(self.num_workers):
+            worker_id, _, actions = self.w2c_queue.get()
+            actions_array[..., self.workers_server_ids[worker_id]] = actions
+
+    # next (worker_id, iteration, actions) reply, or None if nothing arrives within timeout seconds (None: block)
+    def receive_reply(self, timeout=None):
+        try:
+            return self.w2c_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        for q in self.c2w_queues:
+            q.put('stop')
+
+    def get_worker_endpoint(self, worker_id):
+        return QueueWorkerEndpoint(worker_id, self.w2c_queue, self.c2w_queues[worker_id])
+
+    def close(self):
+        pass
+
+
+class QueueWorkerEndpoint:
+    def __init__(self, worker_id, w2c_queue, c2w_queue):
+        self.worker_id = worker_id
+        self.w2c_queue = w2c_queue
+        self.c2w_queue = c2w_queue
+        # iteration of the latest message, replies are tagged with it
+        self.iteration = 0
+
+    # returns (frac_sprinters, costs, iteration), or None once the coordinator stops
+    def receive(self):
+        info = self.c2w_queue.get()
+        if info == 'stop':
+            return None
+        self.iteration = info[2]
+        return info
+
+    def send(self, actions):
+        self.w2c_queue.put((self.worker_id, self.iteration, actions))
+
+
+class SharedMemoryTransport:
+    """
+    Costs and actions of all servers live in one shared memory segment. The coordinator writes frac_sprinters,
+    iteration and costs, and every worker writes its actions straight into its slice of the shared actions array;
+    two barrier rounds per iteration separate the writes from the reads, so nothing is pickled.
+    """
+    def __init__(self, workers_server_ids, block_len=1):
+        self.workers_server_ids = workers_server_ids
+        self.num_workers = len(workers_server_ids)
+        self.num_servers = sum(len(ids) for ids in workers_server_ids)
+        # workers reply with block_len rows of actions per message (one per iteration)
+        self.block_len = block_len
+        # header: frac_sprinters, iteration, stop flag
+        self.shm = SharedMemory(create=True, size=8 * (3 + (1 + block_len) * self.num_servers))
+        self.barrier = Barrier(self.num_workers + 1)
+        self.header, self.costs, self.actions = self.get_arrays()
+
+    def get_arrays(self):
+        buffer = np.ndarray((3 + (1 + self.block_len) * self.num_servers,), dtype=np.float64, buffer=self.shm.buf)
+        actions = buffer[3 + self.num_servers:].reshape(self.block_len, self.num_servers)
+        return buffer[:3], buffer[3:3 + self.num_servers], actions
+
+    def broadcast(self, frac_sprinters, costs, iteration):
+        self.header[0] = frac_sprinters
+        self.header[1] = iteration
+        self.costs[:] = costs
+        self.barrier.wait()
+
+    def gather(self, actions_array):
+        self.barrier.wait()
+        actions_array[...] = self.actions.reshape(actions_array.shape)
+
+    def stop(self):
+        self.header[2] = 1
+        self.barrier.wait()
+
+    def get_worker_endpoint(self, worker_id):
+        ids = self.workers_server_ids[worker_id]
+        return SharedMemoryWorkerEndpoint(self, ids[0], ids[-1] + 1)
+
+    def close(self):
+        self.header = self.costs = self.actions = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedMemoryWorkerEndpoint:
+    def __init__(self, transport, start, stop):
+        self.transport = transport
+        self.start = start
+        self.stop = stop
+
+    def receive(self):
+        self.transport.barrier.wait()
+        header = self.transport.header
+        if header[2] == 1:
+            return None
+        # costs are only rewritten after this worker has sent its actions
+        return header[0], self.transport.costs[self.start:self.stop], int(header[1])
+
+    def send(self, actions):
+        self.transport.actions[:, self.start:self.stop] = actions
+        self.transport.barrier.wait()
+
+
+# coordinator -> worker: frac_sprinters, iteration, stop flag, followed by the worker's costs as float64
+SOCKET_HEADER = struct.Struct("<dqB")
+# worker -> coordinator handshake: worker id
+SOCKET_HELLO = struct.Struct("<I")
+# worker -> coordinator: iteration the reply answers, followed by the bit-packed actions
+SOCKET_REPLY_HEADER = struct.Struct("<q")
+SOCKET_CONNECT_TIMEOUT = 60
+
+
+# "unix:/path/to/socket" or "host:port"
+def parse_socket_address(address):
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def recv_exactly(sock, num_bytes):
+    buffer = bytearray(num_bytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < num_bytes:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += n
+    return buffer
+
+
+# actions are 0/1, so a reply carries one bit per server and iteration
+def pack_actions(actions):
+    return np.packbits(np.asarray(actions, dtype=np.uint8).ravel()).tobytes()
+
+
+def unpack_actions(data, num_actions):
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=num_actions)
+
+
+class SocketTransport:
+    """
+    One stream socket per worker (TCP, or a Unix socket on a single host). The coordinator listens on address and
+    workers connect to it, so they can run in separate processes started by hand, including on other hosts. Every
+    message is a small binary frame: SOCKET_HEADER and the worker's costs one way, bit-packed actions the other.
+    """
+    def __init__(self, workers_server_ids, address, block_len=1):
+        self.workers_server_ids = workers_server_ids
+        self.num_workers = len(workers_server_ids)
+        self.address = address
+        self.block_len = block_len
+        family, sock_address = parse_socket_address(address)
+        if family == socket.AF_UNIX and os.path.exists(sock_address):
+            os.unlink(sock_address)
+        # listen before any worker is started, connections wait in the backlog until the coordinator accepts them
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(sock_address)
+        self.listener.listen(self.num_workers)
+        self.connections = None
+
+    # called in the coordinator process on the first broadcast
+    def accept_workers(self):
+        self.connections = [None] * self.num_workers
+        for _ in range(self.num_workers):
+            connection, _ = self.listener.accept()
+            if connection.family == socket.AF_INET:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            worker_id, = SOCKET_HELLO.unpack(recv_exactly(connection, SOCKET_HELLO.size))
+            assert self.connections[worker_id] is None
+            self.connections[worker_id] = connection
+
+    def broadcast(self, frac_sprinters, costs, iteration):
+        if self.connections is None:
+            self.accept_workers()
+        header = SOCKET_HEADER.pack(frac_sprinters, iteration, 0)
+        for connection, ids in zip(self.connections, self.workers_server_ids):
+            connection.sendall(header + np.asarray(costs[ids], dtype="<f8").tobytes())
+
+    def gather(self, actions_array):
+        for worker_id, ids in enumerate(self.workers_server_ids):
+            _, actions = self.read_reply(worker_id)
+            actions_array[..., ids] = actions.reshape(actions_array[..., ids].shape)
+
+    def read_reply(self, worker_id):
+        connection = self.connections[worker_id]
+        iteration, = SOCKET_REPLY_HEADER.unpack(recv_exactly(connection, SOCKET_REPLY_HEADER.size))
+        num_actions = self.block_len * len(self.workers_server_ids[worker_id])
+        actions = unpack_actions(recv_exactly(connection, (num_actions + 7) // 8), num_actions)
+        return iteration, actions.reshape(self.block_len, -1) if self.block_len > 1 else actions
+
+    def receive_reply(self, timeout=None):
+        ready = wait(self.connections, timeout)
+        if not ready:
+            return None
+        worker_id = self.connections.index(ready[0])
+        iteration, actions = self.read_reply(worker_id)
+        return worker_id, iteration, actions
+
+    def stop(self):
+        if self.connections is None:
+            self.accept_workers()
+        for connection in self.connections:
+            connection.sendall(SOCKET_HEADER.pack(0, 0, 1))
+            connection.close()
+
+    def get_worker_endpoint(self, worker_id):
+        return SocketWorkerEndpoint(self.address, worker_id, len(self.workers_server_ids[worker_id]))
+
+    def close(self):
+        self.listener.close()
+        family, sock_address = parse_socket_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(sock_address):
+            os.unlink(sock_address)
+
+
+class SocketWorkerEndpoint:
+    # only needs the coordinator address, so remote workers can build it without the transport
+    def __init__(self, address, worker_id, num_servers):
+        self.address = address
+        self.worker_id = worker_id
+        self.num_servers = num_servers
+        self.sock = None
+        self.iteration = 0
+
+    # the coordinator may not be listening yet when a remote worker starts
+    def connect(self):
+        family, sock_address = parse_socket_address(self.address)
+        deadline = time.time() + SOCKET_CONNECT_TIMEOUT
+        while True:
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(sock_address)
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                self.sock.close()
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(SOCKET_HELLO.pack(self.worker_id))
+
+    def receive(self):
+        if self.sock is None:
+            self.connect()
+        frac_sprinters, iteration, stop = SOCKET_HEADER.unpack(recv_exactly(self.sock, SOCKET_HEADER.size))
+        if stop == 1:
+            self.sock.close()
+            return None
+        costs = np.frombuffer(recv_exactly(self.sock, 8 * self.num_servers), dtype="<f8")
+        self.iteration = iteration
+        return frac_sprinters, costs, iteration
+
+    def send(self, actions):
+        self.sock.sendall(SOCKET_REPLY_HEADER.pack(self.iteration) + pack_actions(actions))
+
+
+class LocalTransport:
+    # coordinator and workers in one process: gather runs every worker's block directly, nothing is copied;
+    # the workers are attached after they are created
+    def __init__(self, workers_server_ids):
+        self.workers_server_ids = workers_server_ids
+        self.num_workers = len(workers_server_ids)
+        self.workers = []
+        self.message = None
+
+    def attach(self, workers):
+        assert len(workers) == self.num_workers
+        self.workers = workers
+
+    def broadcast(self, frac_sprinters, costs, iteration):
+        self.message = (frac_sprinters, costs, iteration)
+
+    def gather(self, actions_array):
+        frac_sprinters, costs, iteration = self.message
+        for worker, ids in zip(self.workers, self.workers_server_ids):
+            actions_array[..., ids] = worker.run_block(frac_sprinters, costs[ids], iteration)
+
+    def stop(self):
+        self.message = None
+
+    def get_worker_endpoint(self, worker_id):
+        return None
+
+    def close(self):
+        pass
+
+
+def create_transport(transport_type, workers_server_ids, block_len=1, address=None):
+    if transport_type == "queue":
+        return QueueTransport(workers_server_ids)
+    elif transport_type == "shared_memory":
+        return SharedMemoryTransport(workers_server_ids, block_len)
+    elif transport_type == "socket":
+        return SocketTransport(workers_server_ids, address, block_len)
+    sys.exit("Wrong transport type!")
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import multiprocessing_MARL as marl  # noqa: E402
+
+MARKOV, M1 = 1, 0
+
+
+def write_config(tmp_path, policy_id, fleet_engine, total_iterations):
+    with open(os.path.join(ROOT, "configs", "config.json"), 'r') as f:
+        config = json.load(f)
+    config.update({"folder_name": str(tmp_path / f"{policy_id}_{fleet_engine}"), "num_servers": 10, "num_workers": 2,
+                   "fleet_engine": fleet_engine, "checkpoint_interval": 1, "cache_size_mb": 0})
+    config["coordinator_config"].update({"total_iterations": total_iterations, "add_noise": 1, "var": 0.0001})
+    config_file_name = str(tmp_path / "config.json")
+    with open(config_file_name, 'w') as f:
+        json.dump(config, f)
+    _, _, policy_type = marl.get_run_types(config, MARKOV, M1, policy_id)
+    return config_file_name, marl.get_results_path(config, policy_type, "markov", "m1")
+
+
+def read_results(path):
+    files = {}
+    for file_name in sorted(os.listdir(path)):
+        if os.path.isfile(os.path.join(path, file_name)):
+            with open(os.path.join(path, file_name), 'rb') as f:
+                files[file_name] = f.read()
+    return files
+
+
+# ac per server and as a fleet, thr and ql
+@pytest.mark.parametrize("policy_id, fleet_engine", [(0, 0), (0, 1), (1, 0), (3, 0)])
+def test_resume_reproduces_uninterrupted_run(monkeypatch, tmp_path, policy_id, fleet_engine):
+    monkeypatch.chdir(ROOT)
+    config_file_name, path = write_config(tmp_path, policy_id, fleet_engine, 4)
+    marl.main(config_file_name, MARKOV, M1, policy_id, -1, seed=3)
+    reference = read_results(path)
+    assert "frac_sprinters.txt" in reference
+
+    # stop after 2 periods and extend the run from its last checkpoint, with other generator states
+    config_file_name, path = write_config(tmp_path, policy_id, fleet_engine, 2)
+    marl.main(config_file_name, MARKOV, M1, policy_id, -1, seed=3)
+    config_file_name, path = write_config(tmp_path, policy_id, fleet_engine, 4)
+    marl.main(config_file_name, MARKOV, M1, policy_id, -1, resume=True, seed=99)
+    assert read_results(path) == reference
@@ -0,0 +1,142 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.stats import skellam
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import dp  # noqa: E402
+import multiprocessing_MARL as marl  # noqa: E402
+
+APPS = [("uniform", "u1"), ("markov", "m1"), ("markov", "m4"), ("queue", "q1"), ("queue", "q3"), ("spark", "s1")]
+
+
+@pytest.fixture
+def config(monkeypatch):
+    # spark apps read data/gain.txt
+    monkeypatch.chdir(ROOT)
+    with open(os.path.join(ROOT, "configs", "config.json"), 'r') as f:
+        return json.load(f)
+
+
+def get_problem(config, app_type, app_sub_type):
+    app = dp.get_app(config, app_type, app_sub_type)
+    return dp.DPProblem(app, config["ac_discount_factor"][app_type][app_sub_type],
+                        config["servers_config"]["cooling_prob"], config["coordinator_config"]["min_frac"],
+                        config["coordinator_config"]["max_frac"], "direct")
+
+
+# one sweep of the value iteration loop of run_dp before it was vectorized
+def loop_bellman_update(app, v, total_cost, discount_factor, prob_cooling):
+    trans = app.get_tran_prob()
+    app_state_len = app.get_app_state_len()
+    new_v = np.zeros(v.shape)
+    actions = np.ones(app_state_len)
+    for s1 in range(app_state_len):
+        next_active_ns = 0
+        next_inactive_s = 0
+        next_inactive_ns = 0
+        for s2 in range(app_state_len):
+            next_active_ns += trans[s2][s1][1] * v[0][s2]
+            next_inactive_s += trans[s2][s1][0] * v[1][s2]
+            next_inactive_ns += trans[s2][s1][1] * v[1][s2]
+
+        q_s = app.get_sprinting_utility(s1) - total_cost + discount_factor * next_inactive_s
+        q_ns = app.get_nominal_utility(s1) - total_cost + discount_factor * next_active_ns
+
+        new_v[1][s1] = app.get_nominal_utility(s1) - total_cost
+        new_v[1][s1] += discount_factor * (prob_cooling * next_inactive_ns + (1 - prob_cooling) * next_active_ns)
+
+        if q_s > q_ns:
+            new_v[0][s1] = q_s
+            actions[s1] = 0
+        else:
+            new_v[0][s1] = q_ns
+    return new_v, actions
+
+
+# one step p <- P p of the loop in calculate_app_state_probs before it was vectorized
+def loop_chain_step(app, p, action, prob_cooling):
+    trans = app.get_tran_prob()
+    new_p = np.zeros(p.shape)
+    for s2 in range(app.get_app_state_len()):
+        for s1 in range(app.get_app_state_len()):
+            new_p[0][s2] += p[0][s1] * action[s1] * trans[s2][s1][int(action[s1])]
+            new_p[0][s2] += p[1][s1] * (1 - prob_cooling) * trans[s2][s1][1]
+            new_p[1][s2] += p[0][s1] * (1 - action[s1]) * trans[s2][s1][int(action[s1])]
+            new_p[1][s2] += p[1][s1] * prob_cooling * trans[s2][s1][1]
+    return new_p
+
+
+@pytest.mark.parametrize("app_type, app_sub_type", APPS)
+def test_bellman_update_matches_loop(config, app_type, app_sub_type):
+    problem = get_problem(config, app_type, app_sub_type)
+    rng = np.random.default_rng(0)
+    for total_cost in [0.0, 0.3]:
+        v = rng.normal(size=(dp.server_state_len, problem.app_state_len))
+        new_v, actions = problem.bellman_update(v, total_cost)
+        loop_v, loop_actions = loop_bellman_update(problem.app, v, total_cost, problem.discount_factor,
+                                                   problem.prob_cooling)
+        assert np.array_equal(new_v, loop_v)
+        assert np.array_equal(actions, loop_actions)
+
+
+@pytest.mark.parametrize("app_type, app_sub_type", APPS)
+def test_policy_chain_matches_loop(config, app_type, app_sub_type):
+    problem = get_problem(config, app_type, app_sub_type)
+    app = problem.app
+    rng = np.random.default_rng(1)
+    p = rng.random((dp.server_state_len, problem.app_state_len))
+    p /= p.sum()
+    # a threshold policy: nominal below the middle state, sprinting from it on
+    action = (np.arange(problem.app_state_len) < problem.app_state_len // 2).astype(float)
+    chain = app.get_policy_chain(action, problem.prob_cooling)
+    new_p = (chain @ p.ravel()).reshape(p.shape)
+    assert np.allclose(new_p, loop_chain_step(app, p, action, problem.prob_cooling), rtol=0, atol=1e-15)
+
+
+# transition tensor of dp.Queue as it was built with scalar Skellam evaluations
+def loop_queue_tran_prob(arrival_tps, sprinting_tps, nominal_tps, app_state_len):
+    tran_prob = np.zeros((app_state_len, app_state_len, 2))
+    for i in range(app_state_len):
+        for j in range(app_state_len):
+            tran_prob[j][i][0] += skellam.pmf(j - i, arrival_tps, sprinting_tps)
+            tran_prob[j][i][1] += skellam.pmf(j - i, arrival_tps, nominal_tps)
+        tran_prob[0][i][0] += skellam.cdf(- i - 1, arrival_tps, sprinting_tps)
+        tran_prob[0][i][1] += skellam.cdf(- i - 1, arrival_tps, nominal_tps)
+        tran_prob[-1][i][0] += skellam.sf(app_state_len - i - 1, arrival_tps, sprinting_tps)
+        tran_prob[-1][i][1] += skellam.sf(app_state_len - i - 1, arrival_tps, nominal_tps)
+    return tran_prob
+
+
+@pytest.mark.parametrize("app_sub_type", ["q1", "q2", "q3", "q4"])
+@pytest.mark.parametrize("arrival_key", ["queue_app_arrival_tps", "queue_app_arrival_tps_change"])
+def test_queue_tran_prob_matches_scalar_skellam(config, app_sub_type, arrival_key):
+    arrival_tps = config[arrival_key][app_sub_type]
+    sprinting_tps = config["queue_app_sprinting_tps"][app_sub_type]
+    nominal_tps = config["queue_app_nominal_tps"][app_sub_type]
+    for app_state_len in [1, 2, 12]:
+        app = dp.Queue(arrival_tps, sprinting_tps, nominal_tps, app_state_len, 1)
+        assert np.array_equal(app.get_tran_prob(),
+                              loop_queue_tran_prob(arrival_tps, sprinting_tps, nominal_tps, app_state_len))
+
+
+def test_never_sprinting_threshold_round_trip(config, tmp_path):
+    # without sprinting utilities sprinting never pays off
+    config["app_utilities"] = [0] * len(config["app_utilities"])
+    config_file_name = str(tmp_path / "config.json")
+    with open(config_file_name, 'w') as f:
+        json.dump(config, f)
+    output_file_name = str(tmp_path / "dp_results.json")
+    dp.solve_all(config_file_name, [0], 1, output_file_name)
+
+    with open(output_file_name, 'r') as f:
+        dp_results = json.load(f)
+    assert dp_results["dp_threshold"]["uniform"]["u1"] is None
+    assert dp_results["dp_threshold_change"]["uniform"]["u1"] is None
+    config["dp_results_file"] = output_file_name
+    assert marl.get_threshold(config, "dp_policy", "uniform", "u1", -1) == float("inf")
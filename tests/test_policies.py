@@ -0,0 +1,25 @@
+import os
+import pickle
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import policies  # noqa: E402
+
+
+def test_actor_methods():
+    assert hasattr(policies.Actor, "get_log_prob")
+    assert hasattr(policies.Actor, "get_mean_std")
+
+
+def test_ac_policy_pickle_round_trip():
+    policy = policies.ACPolicy(2, 2, 8, 8, 0.001, 0.001, 0.99, 0.1)
+    state = [0.5, 1.0]
+    policy.get_new_action(state)
+    restored = pickle.loads(pickle.dumps(policy))
+    mean, std = restored.printable_action(state)
+    expected_mean, expected_std = policy.printable_action(state)
+    assert torch.equal(mean, expected_mean)
+    assert std == expected_std
@@ -0,0 +1,68 @@
+import json
+import os
+import socket
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import multiprocessing_MARL as marl  # noqa: E402
+import sweep  # noqa: E402
+
+MARKOV, M1 = 1, 0
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    with open(os.path.join(ROOT, "configs", "config.json"), 'r') as f:
+        config = json.load(f)
+    config.update({"num_servers": 20, "rng_mode": "server", "cache_size_mb": 0})
+    config["coordinator_config"].update({"total_iterations": 2, "add_noise": 1, "var": 0.0001})
+    return config
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# contents of the text results of a main() run
+def run_main(config, tmp_path, name, policy_id, **overrides):
+    config = dict(config, folder_name=str(tmp_path / name), **overrides)
+    config_file_name = str(tmp_path / f"{name}.json")
+    with open(config_file_name, 'w') as f:
+        json.dump(config, f)
+    marl.main(config_file_name, MARKOV, M1, policy_id, -1, seed=4)
+    _, _, policy_type = marl.get_run_types(config, MARKOV, M1, policy_id)
+    path = marl.get_results_path(config, policy_type, "markov", "m1")
+    files = {}
+    for file_name in sorted(os.listdir(path)):
+        if os.path.isfile(os.path.join(path, file_name)):
+            with open(os.path.join(path, file_name), 'rb') as f:
+                files[file_name] = f.read()
+    return files
+
+
+# ac, thr, dp and ql
+@pytest.mark.parametrize("policy_id", [0, 1, 2, 3])
+def test_fleet_engine_matches_object_engine(config, policy_id):
+    results = [sweep.simulate(dict(config, fleet_engine=fleet_engine), MARKOV, M1, policy_id, seed=5)
+               for fleet_engine in [0, 1]]
+    assert np.array_equal(results[0]["frac_sprinters"], results[1]["frac_sprinters"])
+    assert np.array_equal(results[0]["mean_rewards"], results[1]["mean_rewards"])
+
+
+# thr and ql
+@pytest.mark.parametrize("policy_id", [1, 3])
+def test_results_independent_of_worker_layout(config, tmp_path, policy_id):
+    reference = run_main(config, tmp_path, "one_worker", policy_id, num_workers=1)
+    assert "frac_sprinters.txt" in reference
+    assert run_main(config, tmp_path, "queue", policy_id, num_workers=3) == reference
+    assert run_main(config, tmp_path, "shared_memory", policy_id, num_workers=3, transport="shared_memory") == reference
+    assert run_main(config, tmp_path, "socket", policy_id, num_workers=2, transport="socket",
+                    socket_address=f"127.0.0.1:{get_free_port()}") == reference
@@ -0,0 +1,56 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import multiprocessing_MARL as marl  # noqa: E402
+import sweep  # noqa: E402
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configs", "config.json")
+
+
+def load_config(**coordinator_overrides):
+    with open(CONFIG_FILE, 'r') as f:
+        config = json.load(f)
+    config["num_servers"] = 50
+    config["cache_size_mb"] = 0
+    config["coordinator_config"].update({"total_iterations": 120, "period": 60, "add_noise": 1})
+    config["coordinator_config"].update(coordinator_overrides)
+    return config
+
+
+def test_period_sync_matches_iteration_sync_with_noise():
+    # markov m1 with the threshold policy
+    iteration = sweep.simulate(load_config(sync_mode="iteration"), 1, 0, 1, seed=3)
+    period = sweep.simulate(load_config(sync_mode="period"), 1, 0, 1, seed=3)
+    assert np.array_equal(iteration["frac_sprinters"], period["frac_sprinters"])
+    assert np.array_equal(iteration["mean_rewards"], period["mean_rewards"])
+    assert iteration["average_reward"] == period["average_reward"]
+
+
+# text results of a main() run of markov m1 with the threshold policy
+def run_main(tmp_path, name, **coordinator_overrides):
+    config = load_config(**coordinator_overrides)
+    config.update({"folder_name": str(tmp_path / name), "num_workers": 3})
+    config_file_name = str(tmp_path / f"{name}.json")
+    with open(config_file_name, 'w') as f:
+        json.dump(config, f)
+    marl.main(config_file_name, 1, 0, 1, -1, seed=3)
+    path = marl.get_results_path(config, "thr_policy", "markov", "m1")
+    files = {}
+    for file_name in sorted(os.listdir(path)):
+        if file_name.startswith("server_") or file_name == "frac_sprinters.txt":
+            with open(os.path.join(path, file_name), 'rb') as f:
+                files[file_name] = f.read()
+    return files
+
+
+def test_as_completed_gather_without_timeout_matches_ordered(tmp_path):
+    for sync_mode in ["iteration", "period"]:
+        ordered = run_main(tmp_path, f"ordered_{sync_mode}", sync_mode=sync_mode, total_iterations=4)
+        assert "frac_sprinters.txt" in ordered
+        assert run_main(tmp_path, f"as_completed_{sync_mode}", sync_mode=sync_mode, total_iterations=4,
+                        gather_mode="as_completed") == ordered